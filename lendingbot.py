@@ -14,6 +14,7 @@ import modules.Configuration as Config
 import modules.Data as Data
 import modules.Lending as Lending
 import modules.MaxToLend as MaxToLend
+import modules.Notify as Notify
 from modules.Logger import Logger
 import modules.PluginsManager as PluginsManager
 from modules.ExchangeApiFactory import ExchangeApiFactory
@@ -65,6 +66,8 @@ if web_server_enabled:
 
 # Configure logging
 log = Logger(jsonfile, Decimal(Config.get('BOT', 'jsonlogsize', 200)), exchange)
+if web_server_enabled:
+    WebServer.set_json_output(log.output)
 
 # initialize the remaining stuff
 api = ExchangeApiFactory.createApi(exchange, Config, log)
@@ -170,7 +173,10 @@ try:
 except KeyboardInterrupt:
     if web_server_enabled:
         WebServer.stop_web_server()
+    if analysis:
+        analysis.flush_market_data()
     PluginsManager.on_bot_exit()
+    Notify.flush_notifications()
     logging.debug('bye')
     print('bye')
     os._exit(0)  # Ad-hoc solution in place of 'exit(0)' TODO: Find out why non-daemon thread(s) are hanging on exit
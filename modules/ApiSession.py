@@ -0,0 +1,137 @@
+# coding=utf-8
+"""
+Keep-alive HTTP session shared by the exchange api clients, with per request timings
+"""
+
+import socket
+import sys
+import threading
+import time
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+from urllib3.util import connection
+from urllib3.util.connection import allowed_gai_family
+from urllib3.util.retry import Retry
+
+PHASES = ['dns', 'connect', 'tls', 'server', 'read']
+# Bad gateway responses from Cloudflare, worth another try for public requests
+RETRY_STATUS = [502] + list(range(520, 527))
+
+_current = threading.local()  # Phases of the request in flight on this thread
+
+
+def _add_phase(phase, seconds):
+    phases = getattr(_current, 'phases', None)
+    if phases is not None:
+        phases[phase] += seconds
+
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    """
+    Records how long name resolution, the TCP connect and the TLS handshake take when a new connection is opened
+    """
+    def _new_conn(self):
+        """
+        Resolves the host once, timing it, then connects to the addresses it resolved to the way urllib3 does
+        """
+        start = time.time()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e)
+        resolved = time.time()
+        _add_phase('dns', resolved - start)
+        error = None
+        for address in addresses:
+            try:
+                # An address needs no lookup, urllib3 only sets the timeout and socket options
+                sock = connection.create_connection(address[4][:2], self.timeout, source_address=self.source_address,
+                                                    socket_options=self.socket_options)
+                break
+            except socket.timeout as e:
+                error = ConnectTimeoutError(self, "Connection to {0} timed out. (connect timeout={1})".format(
+                    self.host, self.timeout))
+                error.__cause__ = e
+            except OSError as e:
+                error = NewConnectionError(self, "Failed to establish a new connection: {0}".format(e))
+                error.__cause__ = e
+        else:
+            raise error or NewConnectionError(self, "Failed to establish a new connection: no address for {0}"
+                                              .format(self.host))
+        _add_phase('connect', time.time() - resolved)
+        sys.audit("http.client.connect", self, self.host, self.port)
+        return sock
+
+    def connect(self):
+        phases = getattr(_current, 'phases', None)
+        before = (phases['dns'] + phases['connect']) if phases is not None else 0
+        start = time.time()
+        super(TimedHTTPSConnection, self).connect()
+        after = (phases['dns'] + phases['connect']) if phases is not None else 0
+        _add_phase('tls', time.time() - start - (after - before))
+
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': urllib3.HTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+
+class ApiSession(object):
+    """
+    A requests session keeping connections to the exchange open between calls. Only public (GET) requests are retried
+    after the server answered, signed requests are only retried when the connection could not be made.
+    """
+    def __init__(self, cfg):
+        pool_size = int(cfg.get('BOT', 'api_pool_size', 10, 1, 100))
+        retries = int(cfg.get('BOT', 'api_retries', 2, 0, 10))
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=float(cfg.get('BOT', 'api_retry_backoff', 0.5, 0, 30)),
+                      status_forcelist=RETRY_STATUS, allowed_methods=frozenset(['GET']), raise_on_status=False)
+        self.session = requests.Session()
+        self.session.mount('https://', PooledAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        self.lock = threading.Lock()
+        self.timings = {phase: 0.0 for phase in PHASES}
+        self.requests = 0
+        self.new_connections = 0
+
+    def request(self, method, url, **kwargs):
+        _current.phases = {phase: 0.0 for phase in PHASES}
+        start = time.time()
+        try:
+            r = self.session.request(method, url, **kwargs)
+        finally:
+            phases = _current.phases
+            _current.phases = None
+        total = time.time() - start
+        # elapsed covers everything up to the response headers, the body is read after that
+        headers = r.elapsed.total_seconds()
+        phases['server'] = max(headers - phases['dns'] - phases['connect'] - phases['tls'], 0)
+        phases['read'] = max(total - headers, 0)
+        with self.lock:
+            self.requests += 1
+            if phases['connect'] > 0:
+                self.new_connections += 1
+            for phase in PHASES:
+                self.timings[phase] += phases[phase]
+        return r
+
+    def get_timings(self):
+        """
+        Returns the average time in milliseconds spent in each phase of a request, and how many requests had to open
+        a new connection.
+        """
+        with self.lock:
+            count = max(self.requests, 1)
+            timings = {phase: round(self.timings[phase] * 1000 / count, 1) for phase in PHASES}
+            timings['requests'] = self.requests
+            timings['newConnections'] = self.new_connections
+        return timings
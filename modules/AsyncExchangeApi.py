@@ -0,0 +1,143 @@
+# coding=utf-8
+"""
+Asyncio clients for the public market data requests of the exchanges, so the books of many currencies can be polled
+from one event loop instead of one thread per currency. Signed requests stay with the synchronous api, they are
+serialized by their nonce anyway.
+"""
+import abc
+import asyncio
+import threading
+import time
+
+try:
+    import aiohttp
+    AIOHTTP_LOADED = True
+except ImportError:
+    AIOHTTP_LOADED = False
+
+from modules.Bitfinex2Poloniex import Bitfinex2Poloniex
+from modules.ExchangeApi import ApiError
+from modules.RequestScheduler import PRIORITY_MARKET_DATA
+
+
+class AsyncExchangeApi(object, metaclass=abc.ABCMeta):
+    """
+    Coroutine versions of the public ExchangeApi methods. They share the request scheduler and request timer of the
+    synchronous api they are created from, so both together still keep the exchange's rate limit.
+    """
+    def __init__(self, api):
+        if not AIOHTTP_LOADED:
+            raise ImportError("aiohttp is needed for the asyncio exchange client, install it with pip install aiohttp")
+        self.api = api
+        self.session = None
+
+    async def limit_request_rate(self, priority=PRIORITY_MARKET_DATA):
+        while True:
+            wait = self.api.request_scheduler.reserve(priority)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def _get(self, url, params=None):
+        await self.limit_request_rate()
+        if self.session is None:
+            # The session belongs to the loop it is created on, which is the loop running this coroutine
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.api.timeout))
+        try:
+            async with self.session.get(url, params=params) as r:
+                if r.status != 200:
+                    if r.status == 502 or r.status in range(520, 527, 1):
+                        raise ApiError('API Error ' + str(r.status) +
+                                       ': The web server reported a bad gateway or gateway timeout error.')
+                    elif r.status == 429:
+                        self.api.increase_request_timer()
+                    raise ApiError('API Error ' + str(r.status) + ': ' + await r.text())
+                data = await r.json(content_type=None)
+        except ApiError:
+            raise
+        except Exception as ex:
+            raise RuntimeError(f'{str(ex)} - Requesting {url}')
+        # Check in case something has gone wrong and the timer is too big
+        self.api.reset_request_timer()
+        return data
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @abc.abstractmethod
+    async def return_loan_orders(self, currency, limit=0):
+        """
+        Returns the list of loan offers and demands for a given currency, like ExchangeApi.return_loan_orders
+        """
+
+
+class AsyncPoloniex(AsyncExchangeApi):
+    async def return_loan_orders(self, currency, limit=0):
+        params = {'command': 'returnLoanOrders', 'currency': currency}
+        if limit > 0:
+            params['limit'] = str(limit)
+        resp = await self._get('https://poloniex.com/public', params)
+        if 'error' in resp:
+            raise ApiError(resp['error'])
+        return resp
+
+
+class AsyncBitfinex(AsyncExchangeApi):
+    async def return_loan_orders(self, currency, limit=0):
+        params = {'limit_asks': str(limit), 'limit_bids': str(limit)}
+        bfx_resp = await self._get('{}/{}/lendbook/{}'.format(self.api.url, self.api.apiVersion, currency), params)
+        return Bitfinex2Poloniex.convertLoanOrders(bfx_resp)
+
+
+class SyncFacade(object):
+    """
+    Runs an AsyncExchangeApi on an event loop in a thread of its own and offers its coroutines as blocking calls to
+    the threaded code of the bot.
+    """
+    def __init__(self, async_api):
+        self.async_api = async_api
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='exchange-event-loop')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def return_loan_orders(self, currency, limit=0):
+        return self.run(self.async_api.return_loan_orders(currency, limit))
+
+    def return_loan_orders_many(self, currencies, limit=0):
+        """
+        Fetches the books of all currencies at once, the requests still go out at the pace of the rate limit.
+
+        :param currencies: The currencies to fetch the books of
+        :param limit: The number of offers wanted per currency, 0 for the whole book
+        :return: A dict of currency to (fetch time, book or the exception raised while fetching it)
+        """
+        async def fetch(currency):
+            fetched_at = time.time()
+            try:
+                loans = await self.async_api.return_loan_orders(currency, limit)
+            except Exception as ex:
+                loans = ex
+            return currency, (fetched_at, loans)
+
+        async def fetch_all():
+            return dict(await asyncio.gather(*[fetch(currency) for currency in currencies]))
+
+        return self.run(fetch_all())
+
+    def close(self):
+        self.run(self.async_api.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def create_async_api(api):
+    """
+    Returns the SyncFacade of the asyncio client matching api, a Poloniex or Bitfinex instance.
+    """
+    clients = {'Poloniex': AsyncPoloniex, 'Bitfinex': AsyncBitfinex}
+    return SyncFacade(clients[type(api).__name__](api))
@@ -3,15 +3,18 @@ import hashlib
 import hmac
 import base64
 import json
-import requests
 import time
 import threading
 import sys
 
+from modules.ApiSession import ApiSession
 from modules.ExchangeApi import ExchangeApi
 from modules.ExchangeApi import ApiError
 from modules.Bitfinex2Poloniex import Bitfinex2Poloniex
-from modules.RingBuffer import RingBuffer
+from modules.RequestScheduler import RequestScheduler, PRIORITY_ORDER, PRIORITY_BALANCE, PRIORITY_MARKET_DATA
+
+# Signed commands that place or move funds, these go before balance reads and market data
+ORDER_COMMANDS = ['offer/new', 'offer/cancel', 'transfer']
 
 
 class Bitfinex(ExchangeApi):
@@ -23,7 +26,8 @@ class Bitfinex(ExchangeApi):
         self.req_per_period = 1
         self.default_req_period = 5000  # milliseconds, 1000 = 60/min
         self.req_period = self.default_req_period
-        self.req_time_log = RingBuffer(self.req_per_period)
+        self.request_scheduler = RequestScheduler(self)
+        self.session = ApiSession(self.cfg)
         self.url = 'https://api.bitfinex.com'
         self.key = self.cfg.get("API", "apikey", None)
         self.secret = self.cfg.get("API", "secret", None)
@@ -31,6 +35,7 @@ class Bitfinex(ExchangeApi):
         self.symbols = []
         self.ticker = {}
         self.tickerTime = 0
+        self.ticker_cache_seconds = int(self.cfg.get("BITFINEX", "ticker_cache_seconds", 60, 0, 3600))
         self.baseCurrencies = ['USD', 'BTC', 'ETH']
         self.all_currencies = self.cfg.get_all_currencies()
         self.usedCurrencies = []
@@ -47,8 +52,8 @@ class Bitfinex(ExchangeApi):
         """
         return str(int(time.time() * 100000))
 
-    def limit_request_rate(self):
-        super(Bitfinex, self).limit_request_rate()
+    def limit_request_rate(self, priority=PRIORITY_MARKET_DATA):
+        super(Bitfinex, self).limit_request_rate(priority)
 
     def increase_request_timer(self):
         super(Bitfinex, self).increase_request_timer()
@@ -68,8 +73,7 @@ class Bitfinex(ExchangeApi):
         return {
             "X-BFX-APIKEY": self.key,
             "X-BFX-SIGNATURE": signature,
-            "X-BFX-PAYLOAD": data,
-            "Connection": "close"
+            "X-BFX-PAYLOAD": data
         }
 
     def _request(self, method, request, payload=None, verify=True):
@@ -78,9 +82,9 @@ class Bitfinex(ExchangeApi):
             r = {}
             url = '{}{}'.format(self.url, request)
             if method == 'get':
-                r = requests.get(url, timeout=self.timeout, headers={'Connection': 'close'})
+                r = self.session.request('GET', url, timeout=self.timeout)
             else:
-                r = requests.post(url, headers=payload, verify=verify, timeout=self.timeout)
+                r = self.session.request('POST', url, headers=payload, verify=verify, timeout=self.timeout)
 
             if r.status_code != 200:
                 if r.status_code == 502 or r.status_code in range(520, 527, 1):
@@ -98,21 +102,22 @@ class Bitfinex(ExchangeApi):
             tt, vv, tb = sys.exc_info()
             raise RuntimeError(f'{str(ex)} - Requesting {self.url + request}')
 
-    @ExchangeApi.synchronized
     def _post(self, command, payload=None, verify=True):
-        # keep the request per minute limit
-        self.limit_request_rate()
+        # keep the request per minute limit, the wait for a slot happens before taking the lock
+        self.limit_request_rate(PRIORITY_ORDER if command in ORDER_COMMANDS else PRIORITY_BALANCE)
+        return self._signed_post(command, payload, verify)
 
+    @ExchangeApi.synchronized
+    def _signed_post(self, command, payload, verify):
         payload = payload or {}
         payload['request'] = '/{}/{}'.format(self.apiVersion, command)
         payload['nonce'] = self._nonce
         signed_payload = self._sign_payload(payload)
         return self._request('post', payload['request'], signed_payload, verify)
 
-    @ExchangeApi.synchronized
     def _get(self, command, apiVersion=None):
-        # keep the request per minute limit
-        self.limit_request_rate()
+        # keep the request per minute limit, public requests carry no nonce so they never need the lock
+        self.limit_request_rate(PRIORITY_MARKET_DATA)
 
         if apiVersion is None:
             apiVersion = self.apiVersion
@@ -163,49 +168,54 @@ class Bitfinex(ExchangeApi):
 
     def return_ticker(self):
         """
-        The ticker is a high level overview of the state of the market
-        https://bitfinex.readme.io/v1/reference#rest-public-ticker
+        The ticker is a high level overview of the state of the market. The pairs of the used currencies are fetched
+        with a single request and kept for ticker_cache_seconds.
+        https://docs.bitfinex.com/reference#rest-public-tickers
         """
         t = int(time.time())
-        if t - self.tickerTime < 60:
+        if t - self.tickerTime < self.ticker_cache_seconds:
             return self.ticker
 
-        set_ticker_time = True
-
+        symbols = {}
         for symbol in self._get_symbols():
             base = symbol[3:].upper()
             curr = symbol[:3].upper()
             if ( base in self.baseCurrencies ) and (curr == 'BTC' or curr in self.usedCurrencies):
-                couple = (base + '_' + curr)
-                couple_reverse = (curr + '_' + base)
-
-                try:
-                    ticker = self._get('pubticker/' + symbol)
-
-                    if 'message' in ticker:
-                        raise ApiError("Error: {} ({})".format(ticker['message'], symbol))
-
-                    self.ticker[couple] = {
-                        "last": ticker['last_price'],
-                        "lowestAsk": ticker['ask'],
-                        "highestBid": ticker['bid'],
-                        "percentChange": "",
-                        "baseVolume": str(float(ticker['volume']) * float(ticker['mid'])),
-                        "quoteVolume": ticker['volume']
-                    }
-                    self.ticker[couple_reverse] = {
-                        "last": 1 / float(self.ticker[couple]['last']),
-                        "lowestAsk": 1 / float(self.ticker[couple]['lowestAsk']),
-                        "highestBid": 1 / float(self.ticker[couple]['highestBid'])
-                    }
-
-                except Exception as ex:
-                    self.log.log_error('Error retrieving ticker for {}: {}. Continue with next currency.'
-                                       .format(symbol, ex.message))
-                    set_ticker_time = False
-                    continue
-
-        if set_ticker_time and len(self.ticker) > 2:  # USD_BTC and BTC_USD are always in
+                symbols['t' + symbol.upper()] = (base, curr)
+
+        try:
+            tickers = self._get('tickers?symbols=' + ','.join(symbols), 'v2')
+        except Exception as ex:
+            self.log.log_error('Error retrieving ticker: {}. Using the previous one.'.format(str(ex)))
+            return self.ticker
+
+        for ticker in tickers:
+            if ticker[0] not in symbols:
+                continue
+            base, curr = symbols[ticker[0]]
+            couple = (base + '_' + curr)
+            couple_reverse = (curr + '_' + base)
+            # [SYMBOL, BID, BID_SIZE, ASK, ASK_SIZE, DAILY_CHANGE, DAILY_CHANGE_RELATIVE, LAST_PRICE, VOLUME, HIGH, LOW]
+            bid, ask, last, volume = float(ticker[1]), float(ticker[3]), float(ticker[7]), float(ticker[8])
+            try:
+                self.ticker[couple] = {
+                    "last": str(last),
+                    "lowestAsk": str(ask),
+                    "highestBid": str(bid),
+                    "percentChange": "",
+                    "baseVolume": str(volume * (bid + ask) / 2),
+                    "quoteVolume": str(volume)
+                }
+                self.ticker[couple_reverse] = {
+                    "last": 1 / last,
+                    "lowestAsk": 1 / ask,
+                    "highestBid": 1 / bid
+                }
+            except ZeroDivisionError:
+                self.log.log_error('Error retrieving ticker for {}: no price. Continue with next currency.'
+                                   .format(ticker[0]))
+
+        if len(self.ticker) > 2:  # USD_BTC and BTC_USD are always in
             self.tickerTime = t
 
         return self.ticker
@@ -356,11 +366,37 @@ class Bitfinex(ExchangeApi):
 
         return history
 
+    def return_funding_tickers(self, currencies=None):
+        """
+        Retrieves the funding market of several currencies in a single request: the flash return rate and the best
+        offer (ask) and demand (bid) of each. Rates are daily rates like the ones of return_loan_orders.
+        https://docs.bitfinex.com/reference#rest-public-tickers
+
+        :param currencies: The currencies to fetch, defaults to all configured currencies
+        :return: A dict of currency to {'frr', 'bid', 'bidPeriod', 'bidSize', 'ask', 'askPeriod', 'askSize'}
+        """
+        if currencies is None:
+            currencies = self.all_currencies
+        command = 'tickers?symbols=' + ','.join('f' + currency for currency in currencies)
+        resp = self._get(command, 'v2')
+        tickers = {}
+        for ticker in resp:
+            if not ticker[0].startswith('f'):
+                continue
+            tickers[ticker[0][1:]] = {
+                'frr': float(ticker[1]),
+                'bid': float(ticker[2]),
+                'bidPeriod': int(ticker[3]),
+                'bidSize': float(ticker[4]),
+                'ask': float(ticker[5]),
+                'askPeriod': int(ticker[6]),
+                'askSize': float(ticker[7])
+            }
+        return tickers
+
     def get_frr(self, currency):
         """
         Retrieves the flash return rate for the given currency
         https://bitfinex.readme.io/v2/reference#rest-public-platform-status
         """
-        command = 'tickers?symbols=f' + currency
-        resp = self._get(command, 'v2')
-        return float(resp[0][1])
+        return self.return_funding_tickers([currency])[currency]['frr']
@@ -0,0 +1,159 @@
+# coding=utf-8
+import os
+import threading
+import time
+
+import numpy
+
+
+class ColumnStore(object):
+    """
+    On disk history of the recorded market samples of one currency in fixed width column files, one directory per
+    currency and one file per column and day (UTC): uint32 unixtime, samples and duration, float32 rates and amounts.
+    Appending a sample adds a few bytes at the end of each file, reading maps the files into numpy arrays without
+    parsing or copying them. A row can stand for a run of identical samples like in the DB, see record_changes_only.
+    Levels missing from the book are stored as NaN.
+    """
+    def __init__(self, directory, levels, max_run_seconds):
+        """
+        :param directory: The directory of the currency's files, created if missing
+        :param levels: The depth of offered rates in each sample
+        :param max_run_seconds: The longest a run of samples stored as one row can last
+        """
+        self.directory = directory
+        self.levels = levels
+        self.max_run_seconds = max_run_seconds
+        self.value_columns = []
+        for level in range(levels):
+            self.value_columns.extend(['rate{0}'.format(level), 'amnt{0}'.format(level)])
+        self.columns = dict((column, numpy.uint32) for column in ['unixtime', 'samples', 'duration'])
+        self.columns.update((column, numpy.float32) for column in self.value_columns)
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def get_day(unixtime):
+        return time.strftime('%Y%m%d', time.gmtime(unixtime))
+
+    def get_path(self, day, column):
+        return os.path.join(self.directory, '{0}.{1}'.format(day, column))
+
+    def get_days(self):
+        """
+        Returns the days that have samples, oldest first.
+        """
+        return sorted(set(name.split('.')[0] for name in os.listdir(self.directory) if name.endswith('.unixtime')))
+
+    def append(self, rows):
+        """
+        Adds samples in time order.
+
+        :param rows: Lists of unixtime, rate0, amnt0, rate1, ..., percentile, and for runs of samples the number of
+                     samples and the seconds from the first to the last one
+        """
+        days = {}
+        for row in rows:
+            days.setdefault(self.get_day(row[0]), []).append(row)
+        with self.lock:
+            for day, day_rows in days.items():
+                data = {'unixtime': [row[0] for row in day_rows],
+                        'samples': [row[self.levels * 2 + 2] if len(row) > self.levels * 2 + 2 else 1
+                                    for row in day_rows],
+                        'duration': [row[self.levels * 2 + 3] if len(row) > self.levels * 2 + 3 else 0
+                                     for row in day_rows]}
+                for i, column in enumerate(self.value_columns):
+                    data[column] = [numpy.nan if row[i + 1] is None else row[i + 1] for row in day_rows]
+                # A crash between two columns leaves some a bit longer than others, read only uses the common length
+                for column, dtype in self.columns.items():
+                    with open(self.get_path(day, column), 'ab') as f:
+                        f.write(numpy.asarray(data[column], dtype=dtype).tobytes())
+
+    def map_day(self, day, columns):
+        """
+        Maps the files of a day into memory.
+
+        :return: A dict of column to its numpy array, all of the same length
+        """
+        sizes = dict((column, os.path.getsize(self.get_path(day, column)) // numpy.dtype(self.columns[column]).itemsize)
+                     for column in columns)
+        length = min(sizes.values())
+        if length == 0:
+            return dict((column, numpy.zeros(0, dtype=self.columns[column])) for column in columns)
+        return dict((column, numpy.memmap(self.get_path(day, column), dtype=self.columns[column], mode='r',
+                                          shape=(length,)))
+                    for column in columns)
+
+    def get_window(self, from_date=None, columns=None):
+        """
+        Returns the samples newer than from_date, with the runs of identical samples expanded back into samples spread
+        evenly over the run. A window within one day of single samples comes straight from the mapped files.
+
+        :param from_date: The earliest data you want, specified in unix time (seconds since epoch), None for all
+        :param columns: The indexes of the value columns to return (0 is rate0, 1 is amnt0, 2 is rate1...), None for all
+        :return: A (times, values) tuple of numpy arrays, values has a column per requested column
+        """
+        names = self.value_columns if columns is None else [self.value_columns[i] for i in columns]
+        first_date = None if from_date is None else from_date - self.max_run_seconds
+        first_day = None if first_date is None else self.get_day(first_date)
+        parts = []
+        with self.lock:
+            for day in self.get_days():
+                if first_day is not None and day < first_day:
+                    continue
+                data = self.map_day(day, ['unixtime', 'samples', 'duration'] + names)
+                start = 0 if first_date is None else numpy.searchsorted(data['unixtime'], first_date, side='right')
+                parts.append(dict((column, values[start:]) for column, values in data.items()))
+        if len(parts) == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, len(names)), dtype=numpy.float32)
+        data = parts[0] if len(parts) == 1 else dict((column, numpy.concatenate([part[column] for part in parts]))
+                                                     for column in parts[0])
+        values = numpy.column_stack([data[column] for column in names]) if len(names) > 1 else \
+            data[names[0]].reshape(-1, 1)
+        times, values = self.expand_runs(data['unixtime'], values, data['samples'], data['duration'])
+        if from_date is not None:
+            keep = numpy.searchsorted(times, from_date, side='right')
+            times, values = times[keep:], values[keep:]
+        return times, values
+
+    @staticmethod
+    def expand_runs(times, values, samples, durations):
+        """
+        Expands the rows that stand for runs of identical samples into samples spread evenly over the run.
+
+        :return: The (times, values) of the samples
+        """
+        if len(times) == 0 or samples.max() <= 1:
+            return times, values
+        counts = numpy.maximum(samples.astype(numpy.int64), 1)
+        rows = numpy.repeat(numpy.arange(len(counts)), counts)
+        steps = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        times = times[rows].astype(numpy.int64) + \
+            durations[rows].astype(numpy.int64) * steps // numpy.maximum(counts[rows] - 1, 1)
+        return times, values[rows]
+
+    @staticmethod
+    def to_float64(values):
+        """
+        Converts float32 values read from the files to float64, rounded to the 7 significant digits float32 keeps, so
+        a rate of 0.0002 comes back as 0.0002 and not as 0.000199999995 which truncating to 6 decimals would turn into
+        0.000199.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            digits = 6 - numpy.floor(numpy.log10(numpy.abs(values)))
+            scale = numpy.where(numpy.isfinite(digits), 10.0 ** digits, 1.0)
+        return numpy.round(values * scale) / scale
+
+    def delete_before(self, unixtime):
+        """
+        Deletes the files of the days before the day of unixtime, samples of that day are filtered out when read.
+        """
+        oldest_day = self.get_day(unixtime)
+        with self.lock:
+            for day in self.get_days():
+                if day < oldest_day:
+                    for column in self.columns:
+                        path = self.get_path(day, column)
+                        if os.path.exists(path):
+                            os.remove(path)
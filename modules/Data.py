@@ -1,4 +1,6 @@
 import datetime
+import threading
+import time
 from decimal import Decimal
 from urllib.request import urlopen
 import json
@@ -7,6 +9,13 @@ import json
 api = None
 log = None
 
+# Loan order books fetched during the current lending cycle, see get_loan_orders()
+order_book_snapshot = {}
+order_book_stats = {'hits': 0, 'misses': 0}
+funding_stats = {'hits': 0, 'misses': 0}  # Counted apart, one funding request serves every currency
+order_book_lock = threading.Lock()
+funding_snapshot = {}
+
 
 def init(api1, log1):
     global api, log
@@ -23,6 +32,118 @@ def get_on_order_balances():
     return on_order_balances
 
 
+def clear_order_books():
+    '''
+    Drops the order book and funding snapshots, called at the start of every lending cycle
+    '''
+    with order_book_lock:
+        order_book_snapshot.clear()
+        funding_snapshot.clear()
+
+
+def _snapshot_covers(snapshot, limit):
+    if snapshot['limit'] == 0 or len(snapshot['loans'].get('offers', [])) < snapshot['limit']:
+        return True  # Unlimited request or the whole book fitted in the response
+    return 0 < limit <= snapshot['limit']
+
+
+def get_cached_loan_orders(currency, limit=0, max_age=None):
+    '''
+    Returns the snapshot of the book of currency when it is deep and fresh enough for the caller, None otherwise.
+
+    :param currency: The currency of the loan book
+    :param limit: The number of offers wanted, 0 for the whole book
+    :param max_age: Seconds after which a snapshot is too old for the caller, None keeps it for the whole cycle
+    '''
+    now = time.time()
+    with order_book_lock:
+        snapshot = order_book_snapshot.get(currency)
+        if snapshot is not None and _snapshot_covers(snapshot, limit) and \
+                (max_age is None or now - snapshot['time'] <= max_age):
+            order_book_stats['hits'] += 1
+            loans = snapshot['loans']
+            if limit == 0 or len(loans) == 0:
+                return loans
+            return {'offers': loans['offers'][:limit], 'demands': loans['demands'][:limit]}
+        order_book_stats['misses'] += 1
+    return None
+
+
+def store_loan_orders(currency, limit, loans, fetched_at):
+    '''
+    Keeps the book returned by api.return_loan_orders(currency, limit) at fetched_at for the next callers. A deeper
+    book of the current cycle is kept instead of a shallower one, as the market recorder fetches only a few levels.
+    '''
+    snapshot = {'limit': limit, 'time': fetched_at, 'loans': loans}
+    with order_book_lock:
+        current = order_book_snapshot.get(currency)
+        if current is None or _snapshot_covers(snapshot, current['limit']):
+            order_book_snapshot[currency] = snapshot
+
+
+def get_loan_orders(currency, limit=0, max_age=None):
+    '''
+    Returns api.return_loan_orders(currency, limit), reusing the book already fetched for this currency when it is
+    deep enough, so every caller within a cycle shares a single request.
+
+    :param currency: The currency of the loan book
+    :param limit: The number of offers wanted, 0 for the whole book
+    :param max_age: Seconds after which a snapshot is too old for the caller, None keeps it for the whole cycle
+    '''
+    loans = get_cached_loan_orders(currency, limit, max_age)
+    if loans is not None:
+        return loans
+    now = time.time()
+    loans = api.return_loan_orders(currency, limit)
+    store_loan_orders(currency, limit, loans, now)
+    return loans
+
+
+def get_funding_snapshot(max_age=None):
+    '''
+    Returns api.return_funding_tickers() for all configured currencies, fetched with a single request and shared by
+    every caller until the next cycle. Only Bitfinex has a batched funding ticker.
+
+    :param max_age: Seconds after which the snapshot is too old for the caller, None keeps it for the whole cycle
+    :return: A dict of currency to its funding ticker
+    '''
+    now = time.time()
+    with order_book_lock:
+        if funding_snapshot and (max_age is None or now - funding_snapshot['time'] <= max_age):
+            funding_stats['hits'] += 1
+            return funding_snapshot['tickers']
+        funding_stats['misses'] += 1
+    tickers = api.return_funding_tickers()
+    with order_book_lock:
+        funding_snapshot['time'] = now
+        funding_snapshot['tickers'] = tickers
+    return tickers
+
+
+def get_funding_top_of_book(currency, max_age=None):
+    '''
+    Returns the best offer and demand of currency from the funding snapshot, shaped like a one level
+    api.return_loan_orders(currency, 1), or None if the snapshot does not have currency.
+    '''
+    ticker = get_funding_snapshot(max_age).get(currency)
+    if ticker is None:
+        return None
+    return {'offers': [{'rate': '{0:0.8f}'.format(ticker['ask']), 'amount': str(ticker['askSize']),
+                        'rangeMin': '2', 'rangeMax': ticker['askPeriod']}],
+            'demands': [{'rate': '{0:0.8f}'.format(ticker['bid']), 'amount': str(ticker['bidSize']),
+                         'rangeMin': '2', 'rangeMax': ticker['bidPeriod']}]}
+
+
+def get_order_book_stats():
+    with order_book_lock:
+        return dict(order_book_stats)
+
+
+def get_funding_stats():
+    with order_book_lock:
+        return dict(funding_stats)
+
+
 def get_max_duration(end_date, context):
     if not end_date:
         return ""
@@ -111,7 +232,8 @@ def update_conversion_rates(output_currency, json_output_enabled):
         if not output_currency_found:  # fetch output currency rate from blockchain.info
             url = "https://blockchain.info/tobtc?currency={0}&value=1".format(output_currency)
             try:
-                highest_bid = json.loads(urlopen(url).read())
+                # The exchange's timeout option, there is no default socket timeout to fall back on
+                highest_bid = json.loads(urlopen(url, timeout=api.timeout).read())
                 log.updateOutputCurrency('highestBid', 1 / float(highest_bid))
                 log.updateOutputCurrency('currency', output_currency)
             except ValueError:
@@ -6,6 +6,8 @@ import abc
 import calendar
 import time
 
+from modules.RequestScheduler import PRIORITY_MARKET_DATA
+
 
 class ExchangeApi(object):
     __metaclass__ = abc.ABCMeta
@@ -37,18 +39,8 @@ class ExchangeApi(object):
         """
 
     @abc.abstractmethod
-    def limit_request_rate(self):
-        now = time.time() * 1000  # milliseconds
-        # Start throttling only when the queue is full
-        if len(self.req_time_log) == self.req_per_period:
-            time_since_oldest_req = now - self.req_time_log[0]
-            if time_since_oldest_req < self.req_period:
-                sleep = (self.req_period - time_since_oldest_req) / 1000
-                self.req_time_log.append(now + self.req_period - time_since_oldest_req)
-                time.sleep(sleep)
-                return
-
-        self.req_time_log.append(now)
+    def limit_request_rate(self, priority=PRIORITY_MARKET_DATA):
+        self.request_scheduler.acquire(priority)
 
     @abc.abstractmethod
     def increase_request_timer(self):
@@ -154,6 +146,13 @@ class ExchangeApi(object):
         Transfers values from one account/wallet to another
         """
 
+    def get_request_timings(self):
+        """
+        Returns the average time in milliseconds each phase of a request to the exchange took (dns, connect, tls,
+        server, read) and how many requests were made and had to open a new connection.
+        """
+        return self.session.get_timings()
+
 
 class ApiError(Exception):
     pass
@@ -1,8 +1,17 @@
 # coding=utf-8
 from decimal import Decimal
+from itertools import accumulate
+import bisect
+import json
 import sched
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import numpy
+    use_numpy = True
+except ImportError:
+    use_numpy = False
 Config = None
 api = None
 log = None
@@ -41,10 +50,18 @@ scheduler = None
 exchange = None
 frrasmin = False
 frrdelta = 0.0
-
-# limit of orders to request
+lending_workers = 1
+gap_debug_log = False
+reconcile_orders = False
+open_loan_offers = {}  # Own open offers of the current cycle, only used when reconciling orders
+unreconciled_currencies = set()  # Currencies with open offers that lend_all did not reconcile yet this cycle
+reconcile_stats = {'requestsSaved': 0, 'requestsSavedTotal': 0}
+
+# limit of orders to request, learned limits are kept in loanOrdersRequestLimitFile across bot restarts
 loanOrdersRequestLimit = {}
+loanOrdersRequestLimitLock = threading.Lock()  # The lending workers raise the limits and save them concurrently
 defaultLoanOrdersRequestLimit = 100
+loanOrdersRequestLimitFile = 'market_data/loan_orders_limits.json'
 
 
 def init(cfg, api1, log1, data, maxtolend, dry_run1, analysis, notify_conf1):
@@ -60,7 +77,8 @@ def init(cfg, api1, log1, data, maxtolend, dry_run1, analysis, notify_conf1):
     global sleep_time, sleep_time_active, sleep_time_inactive, min_daily_rate, max_daily_rate, spread_lend, \
         gap_bottom_default, gap_top_default, xday_threshold, xday_spread, xdays, min_loan_size, end_date, coin_cfg, \
         min_loan_sizes, dry_run, transferable_currencies, keep_stuck_orders, hide_coins, scheduler, gap_mode_default, \
-        exchange, analysis_method, currencies_to_analyse, all_currencies, frrasmin, frrdelta
+        exchange, analysis_method, currencies_to_analyse, all_currencies, frrasmin, frrdelta, lending_workers, \
+        gap_debug_log, reconcile_orders
 
     exchange = Config.get_exchange()
 
@@ -89,11 +107,16 @@ def init(cfg, api1, log1, data, maxtolend, dry_run1, analysis, notify_conf1):
     hide_coins = Config.getboolean('BOT', 'hideCoins', True)
     frrasmin = Config.getboolean('BOT', 'frrasmin', False)
     frrdelta = Decimal(Config.get('BOT', 'frrdelta', 0.0000))
+    lending_workers = int(Config.get('BOT', 'lendingWorkers', 1, 1, 16))
+    gap_debug_log = Config.getboolean('BOT', 'gap_debug_log', False)
+    reconcile_orders = Config.getboolean('BOT', 'reconcileOrders', False)
     analysis_method = Config.get('Daily_min', 'method', 'percentile')
-    if analysis_method not in ['percentile', 'MACD']:
-        raise ValueError("analysis_method: \"{0}\" is not valid, must be percentile or MACD".format(analysis_method))
+    if analysis_method not in ['percentile', 'MACD', 'volumeWeighted', 'dustFiltered']:
+        raise ValueError("analysis_method: \"{0}\" is not valid, must be percentile, MACD, volumeWeighted or "
+                         "dustFiltered".format(analysis_method))
 
     sleep_time = sleep_time_active  # Start with active mode
+    load_loan_orders_request_limits()
 
     # create the scheduler thread
     scheduler = sched.scheduler(time.time, time.sleep)
@@ -164,7 +187,12 @@ def get_min_loan_size(currency):
     return Decimal(min_loan_sizes[currency])
 
 
-def create_lend_offer(currency, amt, rate):
+def get_offer_terms(amt, rate):
+    """
+    Works out the amount, rate and duration that create_lend_offer will offer at.
+
+    :return: A tuple (amount, rate, days)
+    """
     days = '2'
     if float(rate) > 0.0001:
         rate = float(rate) - 0.000001  # lend offer just bellow the competing one
@@ -188,6 +216,11 @@ def create_lend_offer(currency, amt, rate):
             exit(0)
         if int(days) > days_remaining:
             days = str(days_remaining)
+    return amt, rate, days
+
+
+def create_lend_offer(currency, amt, rate):
+    amt, rate, days = get_offer_terms(amt, rate)
     if not dry_run:
         msg = api.create_loan_offer(currency, amt, days, 0, rate)
         if days == xdays and notify_conf['notify_xday_threshold']:
@@ -197,45 +230,111 @@ def create_lend_offer(currency, amt, rate):
 
 
 def cancel_all():
+    if reconcile_orders:
+        return  # lend_all only cancels the offers that changed
     loan_offers = api.return_open_loan_offers()
     available_balances = api.return_available_account_balances('lending')
     for CUR in loan_offers:
-        if CUR in coin_cfg and coin_cfg[CUR]['maxactive'] == 0:
-            # don't cancel disabled coin
-            continue
-        if keep_stuck_orders:
-            lending_balances = available_balances['lending']
-            if isinstance(lending_balances, dict) and CUR in lending_balances:
-                cur_sum = float(available_balances['lending'][CUR])
-            else:
-                cur_sum = 0
-            for offer in loan_offers[CUR]:
-                cur_sum += float(offer['amount'])
+        lending_balances = available_balances['lending']
+        if isinstance(lending_balances, dict) and CUR in lending_balances:
+            cur_sum = float(available_balances['lending'][CUR])
         else:
-            cur_sum = float(get_min_loan_size(CUR)) + 1
-        if cur_sum >= float(get_min_loan_size(CUR)):
-            for offer in loan_offers[CUR]:
-                if not dry_run:
-                    try:
-                        msg = api.cancel_loan_offer(CUR, offer['id'])
-                        log.cancelOrder(CUR, msg)
-                    except Exception as ex:
-                        ex.message = ex.message if ex.message else str(ex)
-                        log.log("Error canceling loan offer: {0}".format(ex.message))
+            cur_sum = 0
+        for offer in loan_offers[CUR]:
+            cur_sum += float(offer['amount'])
+        if can_cancel_offers(CUR, cur_sum):
+            cancel_offers(CUR, loan_offers[CUR])
+
+
+def can_cancel_offers(cur, cur_sum):
+    """
+    Checks whether the open offers of cur may be cancelled: not for a disabled coin, and with keep_stuck_orders not
+    when the balance and the offers together are below the min loan size, as they could not be lent again.
+
+    :param cur_sum: The available lending balance of cur plus the amount of its open offers
+    """
+    if cur in coin_cfg and coin_cfg[cur]['maxactive'] == 0:
+        # don't cancel disabled coin
+        return False
+    if keep_stuck_orders and cur_sum < float(get_min_loan_size(cur)):
+        print("Not enough " + cur + " to lend if bot canceled open orders. Not cancelling.")
+        return False
+    return True
+
+
+def cancel_offers(cur, offers):
+    for offer in offers:
+        if not dry_run:
+            try:
+                msg = api.cancel_loan_offer(cur, offer['id'])
+                log.cancelOrder(cur, msg)
+            except Exception as ex:
+                ex.message = ex.message if ex.message else str(ex)
+                log.log("Error canceling loan offer: {0}".format(ex.message))
+
+
+def offer_matches(offer, amt, rate, days):
+    """
+    Checks whether an open offer is the same as the one get_offer_terms worked out. Rates are compared to 9 decimal
+    places as Bitfinex sends them back converted from yearly rates.
+    """
+    return Decimal(offer['amount']) == Decimal(amt) and int(offer['duration']) == int(days) and \
+        abs(Decimal(offer['rate']) - Decimal(str(rate))) < Decimal('0.000000001')
+
+
+def reconcile_offers(active_cur, offers, lending_balances):
+    """
+    Keeps the open offers of active_cur that are identical to a wanted offer and cancels the others, unless
+    can_cancel_offers says they must stay.
+
+    :param offers: The wanted offers as (amount, rate) tuples
+    :param lending_balances: The lending balances of lend_all, open offers included
+    :return: The wanted offers that still have to be created
+    """
+    unreconciled_currencies.discard(active_cur)
+    cur_open_offers = open_loan_offers.get(active_cur, [])
+    kept_offers = []
+    new_offers = []
+    for amt, rate in offers:
+        terms = get_offer_terms(amt, rate)
+        match = next((offer for offer in cur_open_offers
+                      if offer not in kept_offers and offer_matches(offer, *terms)), None)
+        if match is None:
+            new_offers.append((amt, rate))
         else:
-            print("Not enough " + CUR + " to lend if bot canceled open orders. Not cancelling.")
+            kept_offers.append(match)
+    stale_offers = [offer for offer in cur_open_offers if offer not in kept_offers]
+    if stale_offers and not can_cancel_offers(active_cur, float(lending_balances.get(active_cur, 0))):
+        return []
+    # Cancel before creating so the freed balance can be lent again
+    cancel_offers(active_cur, stale_offers)
+    open_loan_offers[active_cur] = kept_offers
+    reconcile_stats['requestsSaved'] += 2 * len(kept_offers)  # One cancel and one create each
+    return new_offers
 
 
 def lend_all():
+    global open_loan_offers
+    Data.clear_order_books()
     total_lent = Data.get_total_lent()[0]
     lending_balances = api.return_available_account_balances("lending")['lending']
     if dry_run:  # just fake some numbers, if dryrun (testing)
         lending_balances = Data.get_on_order_balances()
+    elif reconcile_orders:
+        # Open offers are not cancelled beforehand, so they count as lendable balance
+        open_loan_offers = api.return_open_loan_offers()
+        reconcile_stats['requestsSaved'] = 0
+        unreconciled_currencies.clear()
+        unreconciled_currencies.update(open_loan_offers)
+        lending_balances = dict(lending_balances)
+        for cur in open_loan_offers:
+            on_order = sum(Decimal(offer['amount']) for offer in open_loan_offers[cur])
+            lending_balances[cur] = Decimal(lending_balances.get(cur, 0)) + on_order
 
     # Fill the (maxToLend) balances on the botlog.json for display it on the web
     for cur in sorted(total_lent):
         if len(lending_balances) == 0 or cur not in lending_balances:
-            MaxToLend.amount_to_lend(total_lent[cur], cur, 0, 0)
+            MaxToLend.amount_to_lend(total_lent[cur], cur, 0, get_lowest_offer_rate(cur))
     usable_currencies = 0
     global sleep_time  # We need global var to edit sleeptime
     if gap_mode_default == "rawbtc":
@@ -246,13 +345,42 @@ def lend_all():
             if "rawbtc" in cur1:
                 ticker = api.return_ticker()
             break
-    try:
-        for cur in lending_balances:
-            if cur in all_currencies:
-                usable_currencies += lend_cur(cur, total_lent, lending_balances, ticker)
-    except StopIteration:  # Restart lending if we stop to raise the request limit.
-        lend_all()
+    lend_currencies = [cur for cur in lending_balances if cur in all_currencies]
+    if lending_workers > 1:
+        usable_currencies += lend_concurrently(lend_currencies, total_lent, lending_balances, ticker)
+    else:
+        for cur in lend_currencies:
+            usable_currencies += lend_cur(cur, total_lent, lending_balances, ticker)
+    if reconcile_orders:
+        # Currencies that had nothing to lend this cycle or are no longer lent keep no stale offers
+        for cur in sorted(unreconciled_currencies):
+            reconcile_offers(cur, [], lending_balances)
     set_sleep_time(usable_currencies)
+    for key, value in Data.get_order_book_stats().items():
+        log.addSectionLog("orderBookCache", key, value)
+    for key, value in Data.get_funding_stats().items():
+        log.addSectionLog("fundingCache", key, value)
+    if reconcile_orders:
+        reconcile_stats['requestsSavedTotal'] += reconcile_stats['requestsSaved']
+        for key, value in reconcile_stats.items():
+            log.addSectionLog("orderReconciler", key, value)
+    for key, value in api.get_request_timings().items():
+        log.addSectionLog("apiTimings", key, value)
+
+
+def lend_concurrently(currencies, total_lent, lending_balances, ticker):
+    """
+    Prepares the orders of every currency on a pool of lending_workers threads, which only make public requests, while
+    this thread places them in the original currency order so the signed requests keep their nonce order.
+
+    :return: The number of currencies that had enough to lend
+    """
+    usable_currencies = 0
+    with ThreadPoolExecutor(max_workers=lending_workers) as executor:
+        futures = [(cur, executor.submit(prepare_cur, cur, total_lent, lending_balances, ticker)) for cur in currencies]
+        for cur, future in futures:
+            usable_currencies += place_cur_orders(cur, future.result(), total_lent, lending_balances, ticker)
+    return usable_currencies
 
 
 def get_frr_or_min_daily_rate(cur):
@@ -273,7 +401,9 @@ def get_frr_or_min_daily_rate(cur):
         frrdelta = Decimal(Config.get('BOT', 'frrdelta', 0.0000))
 
     if exchange == 'BITFINEX' and frrasmin:
-        frr_rate = Decimal(api.get_frr(cur)) + frrdelta
+        funding_ticker = Data.get_funding_snapshot().get(cur)
+        frr = funding_ticker['frr'] if funding_ticker else api.get_frr(cur)
+        frr_rate = Decimal(frr) + frrdelta
         if frr_rate > min_daily_rate:
             log.log("Using FRR as mindailyrate {0}% for {1}".format(frr_rate * 100, cur))
             return frr_rate
@@ -281,6 +411,24 @@ def get_frr_or_min_daily_rate(cur):
     return min_daily_rate
 
 
+def get_lowest_offer_rate(cur):
+    """
+    Returns the best offered rate of cur from the funding snapshot, so the max to lend of currencies that are not
+    lending this cycle can be shown without fetching their order books. Only Bitfinex has the snapshot.
+
+    :param cur: The currency which to check
+    :return: The lowest offered rate, 0 when it is not known
+    """
+    if exchange != 'BITFINEX':
+        return 0
+    try:
+        funding_ticker = Data.get_funding_snapshot().get(cur)
+    except Exception as ex:
+        log.log_error("Could not get the funding snapshot: {0}".format(str(ex)))
+        return 0
+    return Decimal(str(funding_ticker['ask'])) if funding_ticker else 0
+
+
 def get_min_daily_rate(cur):
     cur_min_daily_rate = get_frr_or_min_daily_rate(cur)
     if cur in coin_cfg:
@@ -302,10 +450,10 @@ def get_min_daily_rate(cur):
 
 def construct_order_book(active_cur):
     # make sure we have a request limit for this currency
-    if active_cur not in loanOrdersRequestLimit:
-        loanOrdersRequestLimit[active_cur] = defaultLoanOrdersRequestLimit
+    with loanOrdersRequestLimitLock:
+        limit = loanOrdersRequestLimit.setdefault(active_cur, defaultLoanOrdersRequestLimit)
 
-    loans = api.return_loan_orders(active_cur, loanOrdersRequestLimit[active_cur])
+    loans = Data.get_loan_orders(active_cur, limit)
     if len(loans) == 0:
         return False
 
@@ -317,6 +465,75 @@ def construct_order_book(active_cur):
     return {'rates': rate_book, 'volumes': volume_book}
 
 
+def load_loan_orders_request_limits():
+    try:
+        with open(loanOrdersRequestLimitFile) as f:
+            loanOrdersRequestLimit.update(json.load(f))
+    except (IOError, ValueError):
+        pass  # Nothing learned yet, every currency starts with the default limit
+
+
+def save_loan_orders_request_limits():
+    try:
+        with loanOrdersRequestLimitLock:
+            with open(loanOrdersRequestLimitFile, 'w') as f:
+                json.dump(dict(loanOrdersRequestLimit), f)
+    except IOError as ex:
+        log.log_error("Could not save loan order request limits: {0}".format(ex))
+
+
+def extend_order_book(active_cur, order_book):
+    """
+    Raises the request limit of active_cur and appends the deeper offers to order_book, so a walk through the book can
+    carry on where it ran out instead of starting again.
+
+    :return: False if the book had no more offers to add
+    """
+    with loanOrdersRequestLimitLock:
+        loanOrdersRequestLimit[active_cur] += defaultLoanOrdersRequestLimit
+        limit = loanOrdersRequestLimit[active_cur]
+    log.log(active_cur + ': Not enough offers in response, adjusting request limit to ' + str(limit))
+    save_loan_orders_request_limits()
+    deeper_book = construct_order_book(active_cur)
+    if not deeper_book or len(deeper_book['rates']) <= len(order_book['rates']):
+        return False
+    order_book['rates'].extend(deeper_book['rates'][len(order_book['rates']):])
+    order_book['volumes'].extend(deeper_book['volumes'][len(order_book['volumes']):])
+    return True
+
+
+def get_gap_sums(order_book, cur_min_daily_rate):
+    """
+    Returns the cumulative gap volume at every level of order_book, the volume of offers above cur_min_daily_rate counts
+    twice. This is built once per book and min rate and shared by the gap bottom and gap top lookups.
+    """
+    cached = order_book.get('gap_sums')
+    if cached is not None and cached[0] == cur_min_daily_rate and len(cached[1]) == len(order_book['volumes']):
+        return cached[1]
+    min_rate = float(cur_min_daily_rate)
+    if use_numpy:
+        rates = numpy.array(order_book['rates'], dtype=float)
+        volumes = numpy.array(order_book['volumes'], dtype=float)
+        cum_volume = numpy.cumsum(volumes)
+        # Only add the sum if rate is higher than the min, optimizes spreadlend experience
+        cum_volume_above_min = numpy.cumsum(numpy.where(rates > min_rate, volumes, 0))
+        gap_sums = cum_volume + cum_volume_above_min
+    else:
+        gap_sums = list(accumulate(float(volume) * (2 if float(rate) > min_rate else 1)
+                                   for rate, volume in zip(order_book['rates'], order_book['volumes'])))
+    order_book['gap_sums'] = (cur_min_daily_rate, gap_sums)
+    return gap_sums
+
+
+def find_gap_level(gap_sums, gap_expected):
+    """
+    Returns the index of the first level at which the cumulative gap volume reaches gap_expected
+    """
+    if use_numpy:
+        return int(numpy.searchsorted(gap_sums, gap_expected, side='left'))
+    return bisect.bisect_left(gap_sums, gap_expected)
+
+
 def get_gap_rate(active_cur, gap, order_book, cur_total_balance, raw=False):
     # min daily rate can be changed per currency
     cur_min_daily_rate = get_min_daily_rate(active_cur)
@@ -324,22 +541,19 @@ def get_gap_rate(active_cur, gap, order_book, cur_total_balance, raw=False):
         gap_expected = gap
     else:
         gap_expected = gap * cur_total_balance / Decimal(100.0)
-    gap_sum = 0
-    i = 0
-    while gap_sum < gap_expected:
-        if i == len(order_book['volumes']) - 1 and len(order_book['volumes']) == loanOrdersRequestLimit[active_cur]:
-            loanOrdersRequestLimit[active_cur] += defaultLoanOrdersRequestLimit
-            log.log(active_cur + ': Not enough offers in response, adjusting request limit to ' + str(
-                loanOrdersRequestLimit[active_cur]))
-            raise StopIteration
-        elif i == len(order_book['volumes']) - 1:
+    while True:
+        gap_sums = get_gap_sums(order_book, cur_min_daily_rate)
+        i = find_gap_level(gap_sums, float(gap_expected))
+        if i < len(gap_sums) - 1:
+            break
+        # The gap goes past the end of the book, look deeper if the response was cut off by the request limit
+        if len(gap_sums) < loanOrdersRequestLimit[active_cur] or not extend_order_book(active_cur, order_book):
             return max_daily_rate
-        gap_sum += float(order_book['volumes'][i])
-        if Decimal(order_book['rates'][i]) > cur_min_daily_rate: # Only add the sum if rate is higher than the min, optimizes spreadlend experience
-            gap_sum += float(order_book['volumes'][i])
-        log.log("Checking ({0}) rate {1}% for gap_sum {2} {3}".format(i, Decimal(order_book['rates'][i]) * 100, gap_sum, active_cur))
-        i += 1
-    return Decimal(order_book['rates'][i-1]) # order i can be a large amount and we want to place before and not after, so we have to increment
+    if gap_debug_log:
+        for level in range(i + 1):
+            log.log("Checking ({0}) rate {1}% for gap_sum {2} {3}".format(
+                level, Decimal(order_book['rates'][level]) * 100, gap_sums[level], active_cur))
+    return Decimal(order_book['rates'][i])  # order i can be a large amount and we want to place before and not after
 
 
 def get_cur_spread(spread, cur_active_bal, active_cur):
@@ -429,7 +643,17 @@ def get_gap_mode_rates(cur, cur_active_bal, cur_total_balance, ticker):
 
 
 def lend_cur(active_cur, total_lent, lending_balances, ticker):
+    prepared = prepare_cur(active_cur, total_lent, lending_balances, ticker)
+    return place_cur_orders(active_cur, prepared, total_lent, lending_balances, ticker)
+
+
+def prepare_cur(active_cur, total_lent, lending_balances, ticker):
+    """
+    Works out the orders to place for a currency. Only public requests are made here so it is safe to run for several
+    currencies at once.
 
+    :return: A dict with the currency's 'min_daily_rate' and 'orders', or None if there is nothing to lend
+    """
     active_cur_total_balance = Decimal(lending_balances[active_cur])
     if active_cur in total_lent:
         active_cur_total_balance += Decimal(total_lent[active_cur])
@@ -441,32 +665,47 @@ def lend_cur(active_cur, total_lent, lending_balances, ticker):
     log.updateStatusValue(active_cur, "totalCoins", (Decimal(active_cur_total_balance)))
     order_book = construct_order_book(active_cur)
     if not order_book or len(order_book['rates']) == 0 or not cur_min_daily_rate:
-        return 0
+        return None
 
     active_bal = MaxToLend.amount_to_lend(active_cur_total_balance, active_cur, Decimal(lending_balances[active_cur]),
                                           Decimal(order_book['rates'][0]))
 
-    if float(active_bal) >= get_min_loan_size(active_cur):  # Make sure sleeptimer is set to active if any cur can lend.
-        currency_usable = 1
-    else:
-        return 0  # Return early to end function.
+    if float(active_bal) < get_min_loan_size(active_cur):
+        return None  # Return early to end function.
 
     orders = construct_orders(active_cur, active_bal, active_cur_total_balance, ticker)  # Build all potential orders
+    return {'min_daily_rate': cur_min_daily_rate, 'orders': orders}
+
+
+def place_cur_orders(active_cur, prepared, total_lent, lending_balances, ticker):
+    if prepared is None:
+        return 0
+    currency_usable = 1  # Make sure sleeptimer is set to active if any cur can lend.
+    cur_min_daily_rate = prepared['min_daily_rate']
+    orders = prepared['orders']
+    offers = []
     i = 0
-    while i < len(orders['amounts']):  # Iterate through prepped orders and create them if they work
+    while i < len(orders['amounts']):  # Iterate through prepped orders and keep the ones that work
         below_min = Decimal(orders['rates'][i]) < Decimal(cur_min_daily_rate)
 
         if hide_coins and below_min:
             log.log("Not lending {:s} due to rate below {:.4f}% (actual: {:.4f}%)"
                     .format(active_cur, (cur_min_daily_rate * 100), (orders['rates'][i] * 100)))
+            if reconcile_orders:
+                reconcile_offers(active_cur, [], lending_balances)  # Hide the coins that are already on offer too
             return 0
         elif below_min:
             rate = str(cur_min_daily_rate - Decimal(orders['rates'][0]) + Decimal(orders['rates'][i]))
         else:
             rate = orders['rates'][i]
+        offers.append((orders['amounts'][i], rate))
+        i += 1  # Finally, move to next order.
 
+    if reconcile_orders:
+        offers = reconcile_offers(active_cur, offers, lending_balances)
+    for amount, rate in offers:
         try:
-            create_lend_offer(active_cur, orders['amounts'][i], rate)
+            create_lend_offer(active_cur, amount, rate)
         except Exception as msg:
             if "Amount must be at least " in str(msg):
                 import re
@@ -478,8 +717,6 @@ def lend_cur(active_cur, total_lent, lending_balances, ticker):
                 return lend_cur(active_cur, total_lent, lending_balances, ticker)  # Redo cur with new min.
             else:
                 raise msg
-
-        i += 1  # Finally, move to next order.
     return currency_usable
 
 
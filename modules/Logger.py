@@ -1,15 +1,20 @@
 # coding=utf-8
 import atexit
 import datetime
+import gzip
+import hashlib
 import io
 import json
+import os
+import queue
 import sys
+import threading
 import time
 
 import modules.ConsoleUtils as ConsoleUtils
 import modules.Configuration as Config
 from modules.RingBuffer import RingBuffer
-from modules.Notify import send_notification
+from modules.Notify import queue_notification
 
 
 class ConsoleOutput(object):
@@ -41,14 +46,49 @@ class ConsoleOutput(object):
         sys.stderr.write(update)
 
 
+def write_atomically(path, text):
+    """
+    Writes text to path through a temporary file renamed over it, so readers see either the old or the new file and
+    never a half written one.
+    """
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
 class JsonOutput(object):
+    """
+    Publishes the status to jsonOutputFile and the log lines in numbered segment files next to it, <name>-log-<n>.json
+    holding the lines numbered n * LOG_SEGMENT_SIZE and up. Only the segments that got new lines are written, the
+    status file tells the last line number so the dashboard only fetches the segments it has not seen. The status also
+    holds the newest LOG_SEGMENT_SIZE lines for a dashboard reading it as a local file.
+    The new log lines and statuses are also pushed to the subscribers, the event streams of the web server.
+    """
+    LOG_SEGMENT_SIZE = 50
+    EVENT_QUEUE_SIZE = 1000  # Events a subscriber can fall behind by before it is dropped
+
     def __init__(self, file, logLimit, exchange=''):
         self.jsonOutputFile = file
         self.jsonOutput = {}
         self.clearStatusValues()
-        self.jsonOutputLog = RingBuffer(logLimit)
+        self.jsonOutputLog = RingBuffer(logLimit)  # (number, line) of the newest lines
+        self.logSeq = -1  # Number of the newest line
+        self.logWrittenSeq = -1  # Number of the newest line written to its segment
+        self.logFirstSegment = 0  # Oldest segment that may still be on disk
+        self.publishedStatus = None  # (ETag, body, gzipped body) of the last status written, for the web server
+        self.logLock = threading.Lock()
+        self.subscribers = []
+        self.subscribersLock = threading.Lock()
+        self.logPrefix = os.path.splitext(os.path.basename(file))[0] + '-log-'
         self.jsonOutput['exchange'] = exchange
         self.jsonOutput['label'] = Config.get("BOT", "label", "Lending Bot")
+        self.jsonOutput['log_id'] = int(time.time())  # Line numbers start over when the bot restarts
+        self.jsonOutput['log_prefix'] = self.logPrefix
+        self.jsonOutput['log_segment_size'] = self.LOG_SEGMENT_SIZE
+        self.jsonOutput['log_size'] = int(logLimit)
+        for segment in self.getSegmentFiles():  # Left by the last run
+            os.remove(segment)
 
     def status(self, status, time, days_remaining_msg):
         self.jsonOutput["last_update"] = time + days_remaining_msg
@@ -56,12 +96,115 @@ class JsonOutput(object):
 
     def printline(self, line):
         line = line.replace("\n", ' | ')
-        self.jsonOutputLog.append(line)
+        with self.logLock:
+            self.logSeq += 1
+            self.jsonOutputLog.append((self.logSeq, line))
+            seq = self.logSeq
+        self.publishEvent('log', json.dumps({'log_id': self.jsonOutput['log_id'], 'seq': seq, 'line': line},
+                                            ensure_ascii=True), seq)
+
+    def getSegmentPath(self, segment):
+        return os.path.join(os.path.dirname(self.jsonOutputFile), '{0}{1}.json'.format(self.logPrefix, segment))
+
+    def getSegmentFiles(self):
+        directory = os.path.dirname(self.jsonOutputFile) or '.'
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in os.listdir(directory)
+                if name.startswith(self.logPrefix) and name.endswith('.json')]
+
+    def writeLogSegments(self):
+        """
+        Writes the segments that got new lines since the last call and deletes the ones that only hold lines older
+        than the newest logLimit lines.
+
+        :return: The numbers of the first and last lines kept
+        """
+        with self.logLock:
+            lines = list(self.jsonOutputLog)
+            last_seq = self.logSeq
+        first_seq = lines[0][0] if lines else last_seq + 1
+        size = self.LOG_SEGMENT_SIZE
+        for segment in range(max(self.logWrittenSeq + 1, first_seq) // size, last_seq // size + 1):
+            segment_lines = [line for seq, line in lines if seq // size == segment]
+            segment_first = max(segment * size, first_seq)
+            write_atomically(self.getSegmentPath(segment),
+                             json.dumps({'first_seq': segment_first, 'lines': segment_lines}, ensure_ascii=True))
+        self.logWrittenSeq = last_seq
+        for segment in range(self.logFirstSegment, first_seq // size):
+            if os.path.exists(self.getSegmentPath(segment)):
+                os.remove(self.getSegmentPath(segment))
+        self.logFirstSegment = max(self.logFirstSegment, first_seq // size)
+        return first_seq, last_seq
 
     def writeJsonFile(self):
-        with io.open(self.jsonOutputFile, 'w', encoding='utf-8') as f:
-            self.jsonOutput["log"] = self.jsonOutputLog.get()
-            f.write(json.dumps(self.jsonOutput, ensure_ascii=True, sort_keys=True))
+        first_seq, last_seq = self.writeLogSegments()
+        self.jsonOutput['log_first_seq'] = first_seq
+        self.jsonOutput['log_seq'] = last_seq
+        # The newest lines, for the dashboard opening the file from disk as it cannot read the segments then
+        with self.logLock:
+            lines = [line for seq, line in self.jsonOutputLog if seq <= last_seq]
+        self.jsonOutput['log'] = lines[-self.LOG_SEGMENT_SIZE:]
+        status = json.dumps(self.jsonOutput, ensure_ascii=True)
+        write_atomically(self.jsonOutputFile, status)
+        self.publishStatus(status)
+
+    def publishStatus(self, status):
+        """
+        Keeps the serialized status in memory with its ETag and gzipped body, so the web server answers status
+        requests without serializing, compressing or reading anything.
+        """
+        body = status.encode('utf-8')
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        if self.publishedStatus is not None and self.publishedStatus[0] == etag:
+            return
+        self.publishedStatus = (etag, body, gzip.compress(body))
+        self.publishEvent('status', status)
+
+    def subscribe(self):
+        """
+        Starts pushing the events to a new queue of (event, data, id) tuples. A subscriber that falls
+        EVENT_QUEUE_SIZE events behind is unsubscribed and its queue gets the dropped attribute set.
+
+        :return: The queue
+        """
+        events = queue.Queue(self.EVENT_QUEUE_SIZE)
+        events.dropped = False
+        with self.subscribersLock:
+            self.subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self.subscribersLock:
+            if events in self.subscribers:
+                self.subscribers.remove(events)
+
+    def publishEvent(self, event, data, event_id=None):
+        """
+        :param event: The name of the event, log or status
+        :param data: The event's JSON, on one line
+        :param event_id: The number of the log line, None for other events
+        """
+        with self.subscribersLock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait((event, data, event_id))
+            except queue.Full:
+                self.unsubscribe(events)
+                events.dropped = True
+
+    def getLogSince(self, seq):
+        """
+        Returns the log lines numbered after seq, for the web server.
+
+        :param seq: The number of the newest line the caller has
+        :return: A dict with the log_id, the number of the first line returned and the lines
+        """
+        with self.logLock:
+            lines = [(line_seq, line) for line_seq, line in self.jsonOutputLog if line_seq > seq]
+            first_seq = lines[0][0] if lines else self.logSeq + 1
+        return {'log_id': self.jsonOutput['log_id'], 'first_seq': first_seq, 'lines': [line for _, line in lines]}
 
     def addSectionLog(self, section, key, value):
         if section not in self.jsonOutput:
@@ -164,4 +307,4 @@ class Logger(object):
     @staticmethod
     def notify(msg, notify_conf):
         if notify_conf['enable_notifications']:
-            send_notification(msg, notify_conf)
+            queue_notification(msg, notify_conf)
@@ -1,3 +1,4 @@
+import heapq
 import os
 import sys
 import threading
@@ -7,11 +8,16 @@ import datetime
 import pandas as pd
 import sqlite3 as sqlite
 from sqlite3 import Error
-from modules.ExchangeApi import ApiError
+from modules.AsyncExchangeApi import AIOHTTP_LOADED, create_async_api
 
 # Bot libs
 import modules.Configuration as Config
+import modules.Data as Data
 from modules.Data import truncate
+from modules.ColumnStore import ColumnStore
+from modules.RateHistory import RateHistory
+from modules.StreamingRateStats import StreamingRateStats
+from modules.TimeWeightedRates import TimeWeightedRates
 try:
     import numpy
     use_numpy = True
@@ -22,8 +28,8 @@ except ImportError as ex:
     use_numpy = False
 
 # Improvements
-# [ ] Provide something that takes into account dust offers. (The golden cross works well on BTC, not slower markets)
-# [ ] RE: above. Weighted rate.
+# [x] Provide something that takes into account dust offers. (The golden cross works well on BTC, not slower markets)
+# [x] RE: above. Weighted rate.
 # [ ] Add docstring to everything
 # [ ] Unit tests
 
@@ -32,6 +38,20 @@ except ImportError as ex:
 #   total available, ignore it as dust.
 
 
+# The longest run of unchanged samples stored as one row, runs are cut after db_flush_seconds which is never longer
+MAX_RUN_SECONDS = 3600
+
+# How long a currency is not polled after the exchange answered one of its requests with 429 Too Many Requests
+RATE_LIMIT_SECONDS = 130
+
+
+# Daily_min methods computed from all recorded levels, the percentile of their rate is taken like for percentile
+DEPTH_METHODS = ['volumeWeighted', 'dustFiltered']
+
+ANALYSIS_ERROR_MSG = "WARN: Exception found when analysing markets, if this happens for more than a couple minutes " \
+                     "please create a Github issue so we can fix it. Otherwise, you can ignore it. Error"
+
+
 class MarketDataException(Exception):
     pass
 
@@ -70,11 +90,52 @@ class MarketAnalysis(object):
                                                      1,
                                                      self.MACD_long_win_seconds / 2))
         self.daily_min_multiplier = float(config.get('Daily_min', 'multiplier', 1.05, 1))
+        self.dust_percent = float(config.get('MarketAnalysis', 'dust_percent', 5, 0, 100))
+        # Suggestions are reused until a new sample of the currency is recorded or they are this old
+        self.suggestion_cache_seconds = float(config.get('MarketAnalysis', 'suggestion_cache_seconds', 60, 0, 3600))
+        self.latest_sample_times = {}
+        self.suggestion_cache = {}  # (currency, method) to (latest sample time, calculation time, suggestion)
+        self.suggestion_cache_hits = 0
+        self.suggestion_cache_misses = 0
+        self.suggestion_lock = threading.Lock()
         self.delete_thread_sleep = float(config.get('MarketAnalysis', 'delete_thread_sleep',
                                                     self.keep_history_seconds / 2,
                                                     60,
                                                     60 * 60 * 2))
         self.exchange = config.get_exchange()
+        self.rate_histories = {}  # In memory copy of the recorded samples, the DB is only read at start up
+        self.engine = config.get('MarketAnalysis', 'engine', 'weighted').lower()
+        if self.engine not in ['weighted', 'pandas', 'streaming']:
+            raise ValueError("engine: \"{0}\" is not valid, must be weighted, pandas or streaming".format(self.engine))
+        self.rate_stats = {}  # Streaming statistics of each recorded currency per method, for the streaming engine
+        # Only the method Lending asks for gets streaming statistics, the others are computed like the weighted engine
+        self.analysis_method = config.get('Daily_min', 'method', 'percentile')
+        self.rate_stats_lock = threading.Lock()
+        # Samples are written to the DB in batches, every db_flush_rows samples or db_flush_seconds
+        self.db_flush_rows = int(config.get('MarketAnalysis', 'db_flush_rows', 12, 1, 1000))
+        self.db_flush_seconds = float(config.get('MarketAnalysis', 'db_flush_seconds', 60, 0, MAX_RUN_SECONDS))
+        self.pending_rows = {}
+        self.last_flush = {}
+        self.pending_lock = threading.Lock()
+        # Only store a sample when the recorded levels move, with the number of samples it stood for and how long
+        self.record_changes_only = config.getboolean('MarketAnalysis', 'record_changes_only')
+        self.open_runs = {}  # The samples not stored yet of each currency, [unixtime, values, samples, last unixtime]
+        self.storage = config.get('MarketAnalysis', 'storage', 'sqlite').lower()
+        if self.storage not in ['sqlite', 'columns']:
+            raise ValueError("storage: \"{0}\" is not valid, must be sqlite or columns".format(self.storage))
+        if self.storage == 'columns' and not use_numpy:
+            raise ImportError("storage = columns needs the numpy module, install it with pip install numpy")
+        self.column_stores = {}  # The column files of each recorded currency, with storage = columns
+        self.partition_by_day = config.getboolean('MarketAnalysis', 'partition_by_day')
+        # Share of the exchange's request rate the recorder may use, it sets the shortest poll interval of a currency
+        self.recorder_rate_share = float(config.get('MarketAnalysis', 'recorder_rate_share', 0.5, 0.1, 1))
+        # A currency whose book does not change is polled less and less often, down to once every max_poll_interval
+        self.max_poll_interval = float(config.get('MarketAnalysis', 'max_poll_interval', 30, 5, 300))
+        self.async_polling = config.getboolean('MarketAnalysis', 'asyncPolling')
+        if self.async_polling and not AIOHTTP_LOADED:
+            print("WARN: Module aiohttp not found, requesting the market of one currency at a time instead. "
+                  "Install it with pip install aiohttp to use asyncPolling.")
+            self.async_polling = False
 
         if len(self.currencies_to_analyse) != 0:
             for currency in self.currencies_to_analyse:
@@ -90,56 +151,61 @@ class MarketAnalysis(object):
         Main entry point to start recording data. This starts all the other threads.
         """
         for cur in self.currencies_to_analyse:
+            if self.storage == 'columns':
+                self.column_stores[cur] = self.create_column_store(cur)
+                if self.engine == 'streaming':
+                    self.rate_stats[cur] = self.create_rate_stats(None, cur)
+                continue
             db_con = self.create_connection(cur)
             self.create_rate_table(db_con, self.recorded_levels)
+            if self.partition_by_day:
+                self.move_rows_to_day_tables(db_con, self.recorded_levels)
+            if use_numpy:
+                self.rate_histories[cur] = self.load_rate_history(db_con)
+            if self.engine == 'streaming':
+                self.rate_stats[cur] = self.create_rate_stats(db_con)
             db_con.close()
         self.run_threads()
-        self.run_del_threads()
 
-    def run_threads(self):
-        """
-        Start threads for each currency we want to record. (should be configurable later)
+    def create_column_store(self, cur):
         """
-        for _ in ['thread1']:
-            for cur in self.currencies_to_analyse:
-                thread = threading.Thread(target=self.update_market_thread, args=(cur,))
-                thread.deamon = True
-                thread.start()
+        Opens the column files of a currency. When there are none yet the samples of its DB are copied over, so
+        switching to storage = columns keeps the recorded history.
 
-    def run_del_threads(self):
-        """
-        Start thread to start the DB cleaning threads.
+        :param cur: The currency to open the files of
+        :return: A ColumnStore
         """
-        for _ in ['thread1']:
-            for cur in self.currencies_to_analyse:
-                del_thread = threading.Thread(target=self.delete_old_data_thread, args=(cur, self.keep_history_seconds))
-                del_thread.daemon = False
-                del_thread.start()
+        directory = os.path.join(self.db_dir, '{0}-{1}'.format(Config.get_exchange(), cur))
+        store = ColumnStore(directory, self.recorded_levels, MAX_RUN_SECONDS)
+        db_path = os.path.join(self.db_dir, '{0}-{1}.db'.format(Config.get_exchange(), cur))
+        if not store.get_days() and os.path.exists(db_path):
+            db_con = self.create_connection(cur)
+            try:
+                self.create_rate_table(db_con, self.recorded_levels)
+                rows = self.get_rates_from_db(db_con, from_date=time.time() - self.keep_history_seconds,
+                                              price_levels=self.get_columns(self.recorded_levels)[1:-3])
+                store.append([list(row) + [0] for row in rows])
+            except Exception as ex:
+                self.print_traceback(ex, "Error copying market data from DB")
+            db_con.close()
+        return store
 
-    def delete_old_data_thread(self, cur, seconds):
+    def run_threads(self):
         """
-        Thread to clean the DB.
+        Start the thread that records the market of every currency and cleans the DBs.
         """
-        while True:
-            try:
-                db_con = self.create_connection(cur)
-                self.delete_old_data(db_con, seconds)
-            except Exception as ex:
-                ex.message = ex.message if ex.message else str(ex)
-                print("Error in MarketAnalysis: {0}".format(ex.message))
-                traceback.print_exc()
-            time.sleep(self.delete_thread_sleep)
+        thread = threading.Thread(target=self.record_markets_thread)
+        thread.daemon = True
+        thread.start()
 
     @staticmethod
     def print_traceback(ex, log_message):
-        ex.message = ex.message if ex.message else str(ex)
-        print("{0}: {1}".format(log_message, ex.message))
+        print("{0}: {1}".format(log_message, str(ex)))
         traceback.print_exc()
 
     @staticmethod
     def print_exception_error(ex, log_message, debug=False):
-        ex.message = ex.message if ex.message else str(ex)
-        print("{0}: {1}".format(log_message, ex.message))
+        print("{0}: {1}".format(log_message, str(ex)))
         if debug:
             import traceback
             ex_type, value, tb = sys.exc_info()
@@ -147,60 +213,364 @@ class MarketAnalysis(object):
             print("DEBUG: Type:{0} Value:{1} LineNo:{2}".format(ex_type, value, tb.tb_lineno))
             traceback.print_exc()
 
-    def update_market_thread(self, cur, levels=None):
+    def record_markets_thread(self, levels=None):
         """
-        This is where the main work is done for recording the market data. The loop will not exit and continuously
-        polls exchange for the current loans in the book.
+        This is where the main work is done for recording the market data. A single thread polls the currencies in
+        turn, each one when it is due, and cleans the DBs every delete_thread_sleep seconds. The loop will not exit.
 
-        :param cur: The currency (database) to remove data from
         :param levels: The depth of offered rates to store
         """
         if levels is None:
             levels = self.recorded_levels
-        db_con = self.create_connection(cur)
+        async_api = create_async_api(self.api) if self.async_polling else None
+        db_cons = {cur: None if cur in self.column_stores else self.create_connection(cur)
+                   for cur in self.currencies_to_analyse}
+        min_interval = self.get_min_poll_interval(levels)
+        intervals = dict((cur, min_interval) for cur in self.currencies_to_analyse)
+        last_samples = {}
+        schedule = [(time.time(), cur) for cur in self.currencies_to_analyse]  # Heap of (next poll time, currency)
+        next_cleanup = time.time()
         while True:
+            now = time.time()
+            due = []
             try:
-                raw_data = self.api.return_loan_orders(cur, levels)['offers']
-            except ApiError as ex:
-                if '429' in str(ex):
-                    if self.ma_debug_log:
-                        print("Caught ERR_RATE_LIMIT, sleeping capture and increasing request delay. Current"
-                              " {0}ms".format(self.api.req_period))
-                    time.sleep(130)
+                if now >= next_cleanup:
+                    next_cleanup = now + self.delete_thread_sleep
+                    self.delete_old_data_all(db_cons)
+                while schedule and schedule[0][0] <= now:
+                    due.append(heapq.heappop(schedule)[1])
+                if not due:
+                    time.sleep(max(min(schedule[0][0], next_cleanup) - now, 0))
+                    continue
+                delays = {}
+                books = self.get_market_data(due, levels, min_interval / 2, async_api, delays)
+                for cur in due:
+                    if cur in books:
+                        try:
+                            sample = self.record_market_data(cur, db_cons[cur], books[cur], levels)
+                        except Exception as ex:
+                            self.print_exception_error(ex, "Error in recording market data of {0}".format(cur),
+                                                       debug=self.ma_debug_log)
+                        else:
+                            # Back off while the book stays the same, go back to the shortest interval when it moves
+                            if sample == last_samples.get(cur):
+                                intervals[cur] = min(intervals[cur] * 2, max(self.max_poll_interval, min_interval))
+                            else:
+                                intervals[cur] = min_interval
+                            last_samples[cur] = sample
+                    heapq.heappush(schedule, (now + delays.get(cur, intervals[cur]), cur))
             except Exception as ex:
-                if self.ma_debug_log:
-                    self.print_traceback(ex, "Error in returning data from exchange")
-                else:
-                    print("Error in returning data from exchange, ignoring")
+                # One bad response must not stop the recording of every currency
+                self.print_exception_error(ex, "Error in recording market data", debug=self.ma_debug_log)
+                scheduled = set(cur for _, cur in schedule)
+                for cur in due:
+                    if cur not in scheduled:
+                        heapq.heappush(schedule, (now + intervals[cur], cur))
+                time.sleep(1)
 
-            market_data = []
-            for i in range(levels):
+    def get_min_poll_interval(self, levels):
+        """
+        Returns the shortest interval in seconds at which a currency can be polled, so that polling all of them takes
+        no more than recorder_rate_share of the exchange's request rate. Never less than 5 seconds.
+
+        :param levels: The depth of offered rates recorded
+        """
+        if self.exchange == 'BITFINEX' and levels == 1:
+            requests_per_round = 1  # The funding snapshot has the top of the book of all currencies
+        else:
+            requests_per_round = len(self.currencies_to_analyse)
+        requests_per_second = self.api.req_per_period / (self.api.default_req_period / 1000.0)
+        return max(5.0, requests_per_round / (requests_per_second * self.recorder_rate_share))
+
+    def get_market_data(self, currencies, levels, max_age, async_api=None, delays=None):
+        """
+        Returns the best offers of the books of currencies. Reuses the lending cycle's book if it was fetched since
+        our last sample. On Bitfinex a single recorded level comes from the funding snapshot that all currencies share.
+        The other books are requested together on the event loop of async_api if given, otherwise one by one.
+
+        :param currencies: The currencies of the books
+        :param levels: The depth of offered rates wanted
+        :param max_age: Seconds after which a book fetched before is too old, less than the poll interval so a book is
+                        never recorded twice
+        :param async_api: The SyncFacade of the asyncio exchange client, or None
+        :param delays: A dict that gets the seconds to wait before polling again for the currencies that hit the
+                       exchange's rate limit, the others are polled again at their usual interval
+        :return: A dict of currency to its offers, currencies whose book could not be fetched are left out
+        """
+        delays = {} if delays is None else delays
+        books = {}
+        missing = []
+        for cur in currencies:
+            try:
+                if self.exchange == 'BITFINEX' and levels == 1:
+                    books[cur] = Data.get_funding_top_of_book(cur, max_age=max_age)
+                if books.get(cur) is None:
+                    books[cur] = Data.get_cached_loan_orders(cur, levels, max_age=max_age)
+                if books[cur] is None:
+                    del books[cur]
+                    missing.append(cur)
+            except Exception as ex:
+                self.print_market_data_error(cur, ex, delays)
+        if async_api is not None and missing:
+            try:
+                fetched = async_api.return_loan_orders_many(missing, levels)
+            except Exception as ex:
+                for cur in missing:
+                    self.print_market_data_error(cur, ex, delays)
+                fetched = {}
+            for cur, (fetched_at, loans) in fetched.items():
+                if isinstance(loans, Exception):
+                    self.print_market_data_error(cur, loans, delays)
+                    continue
+                Data.store_loan_orders(cur, levels, loans, fetched_at)
+                books[cur] = loans
+        else:
+            for cur in missing:
+                if delays:
+                    continue  # Rate limited, the others wait for their next poll instead of asking now
                 try:
-                    market_data.append(str(raw_data[i]['rate']))
-                    market_data.append(str(raw_data[i]['amount']))
-                except IndexError:
-                    market_data.append("5")
-                    market_data.append("0.1")
-            market_data.append('0')  # Percentile field not being filled yet.
-            self.insert_into_db(db_con, market_data)
-            time.sleep(5)
+                    books[cur] = Data.get_loan_orders(cur, levels, max_age=max_age)
+                except Exception as ex:
+                    self.print_market_data_error(cur, ex, delays)
+        offers = {}
+        for cur, loans in books.items():
+            try:
+                offers[cur] = loans['offers']
+            except Exception as ex:
+                self.print_market_data_error(cur, ex, delays)
+        return offers
 
-    def insert_into_db(self, db_con, market_data, levels=None):
-            if levels is None:
-                levels = self.recorded_levels
-            insert_sql = "INSERT INTO loans ("
-            for level in range(levels):
-                insert_sql += "rate{0}, amnt{0}, ".format(level)
-            insert_sql += "percentile) VALUES ({0});".format(','.join(market_data))  # percentile = 0
+    def print_market_data_error(self, cur, ex, delays):
+        """
+        :param delays: The dict of get_market_data, a currency that hit the rate limit is not polled for
+                       RATE_LIMIT_SECONDS
+        """
+        if '429' in str(ex):
+            if self.ma_debug_log:
+                print("Caught ERR_RATE_LIMIT for {0}, not polling it for {1}s".format(cur, RATE_LIMIT_SECONDS))
+            delays[cur] = RATE_LIMIT_SECONDS
+        elif self.ma_debug_log:
+            self.print_traceback(ex, "Error in returning data from exchange for {0}".format(cur))
+        else:
+            print("Error in returning data from exchange, ignoring")
+
+    def delete_old_data_all(self, db_cons):
+        """
+        Cleans the DBs of all currencies.
+
+        :param db_cons: A dict of currency to the connection to its database
+        """
+        for cur, db_con in db_cons.items():
+            try:
+                if cur in self.column_stores:
+                    self.column_stores[cur].delete_before(int(time.time()) - self.keep_history_seconds)
+                else:
+                    self.delete_old_data(db_con, self.keep_history_seconds)
+            except Exception as ex:
+                print("Error in MarketAnalysis: {0}".format(str(ex)))
+                traceback.print_exc()
+
+    def record_market_data(self, cur, db_con, raw_data, levels):
+        """
+        Stores one sample of the top levels of the book. Levels missing from the book are stored as NULL. With
+        record_changes_only the sample only goes to the DB when it differs from the one before, see record_run.
+
+        :param cur: The currency of the book
+        :param db_con: Connection to the database of the currency
+        :param raw_data: The offers of the book, best rate first
+        :param levels: The depth of offered rates to store
+        :return: The recorded rates and amounts, rate0, amnt0, rate1, ...
+        """
+        market_data = []
+        for i in range(levels):
+            try:
+                market_data.append(float(raw_data[i]['rate']))
+                market_data.append(float(raw_data[i]['amount']))
+            except IndexError:
+                market_data.append(None)
+                market_data.append(None)
+        now = int(time.time())
+        if self.record_changes_only:
+            self.record_run(cur, db_con, now, market_data, levels)
+        else:
+            self.queue_market_data(cur, db_con, [now] + market_data + [0], levels)  # Percentile field not filled yet.
+        if cur in self.rate_histories:
+            self.rate_histories[cur].append(now, market_data)
+        if cur in self.rate_stats and market_data[0] is not None:
+            with self.rate_stats_lock:
+                for stats in self.rate_stats[cur].values():
+                    stats.add(now, market_data[0])
+        # Set last, a suggestion calculated before the sample is in the history must not be cached under its time
+        self.latest_sample_times[cur] = time.time()
+        return market_data
+
+    def record_run(self, cur, db_con, unixtime, market_data, levels):
+        """
+        Counts a sample into the run of identical samples of the currency. The run is queued for the DB as a single
+        row once a different sample comes in, or once it lasted db_flush_seconds so a quiet market still reaches the DB.
+
+        :param cur: The currency of the sample
+        :param db_con: Connection to the database of the currency, owned by the calling thread
+        :param unixtime: The time of the sample
+        :param market_data: rate0, amnt0, rate1, ... of the sample
+        :param levels: The depth of offered rates in the sample
+        """
+        with self.pending_lock:
+            run = self.open_runs.get(cur)
+            if run is not None and run[1] == market_data and unixtime - run[0] <= self.db_flush_seconds:
+                run[2] += 1
+                run[3] = unixtime
+                return
+            self.open_runs[cur] = [unixtime, market_data, 1, unixtime]
+        if run is not None:
+            self.queue_market_data(cur, db_con, self.get_run_row(run), levels)
+
+    @staticmethod
+    def get_run_row(run):
+        """
+        Returns the DB row of a run: unixtime, rate0, amnt0, rate1, ..., percentile, samples, duration
+        """
+        unixtime, market_data, samples, last = run
+        return [unixtime] + market_data + [0, samples, last - unixtime]
+
+    def create_rate_stats(self, db_con, cur=None):
+        """
+        Creates the streaming statistics of a currency for the analysis method Lending uses, fed with the samples
+        already in its database or column files. The depth methods read every level of the samples and get none.
+
+        :param db_con: Connection to the database of the currency, None for the column files of cur
+        :param cur: The currency, needed with storage = columns
+        :return: A dict of method to StreamingRateStats
+        """
+        rate_stats = {}
+        if self.analysis_method in ['percentile', 'MACD']:
+            # The same window get_rate_list requests from the DB
+            rate_stats[self.analysis_method] = StreamingRateStats(
+                int(self.get_analysis_seconds(self.analysis_method) * 1.1))
+        if not rate_stats:
+            return rate_stats
+        try:
+            from_date = time.time() - max(s.window_seconds for s in rate_stats.values())
+            if db_con is None:
+                times, values = self.column_stores[cur].get_window(from_date, columns=[0])
+                rates = zip(times.tolist(), ColumnStore.to_float64(values[:, 0]).tolist())
+            else:
+                rates = self.get_rates_from_db(db_con, from_date=from_date)
+            for unixtime, rate in rates:
+                if rate is None or rate != rate:  # NULL in the DB, NaN in the column files
+                    continue
+                for stats in rate_stats.values():
+                    stats.add(unixtime, rate)
+        except Exception as ex:
+            self.print_traceback(ex, "Error loading market data from DB")
+        return rate_stats
+
+    def load_rate_history(self, db_con):
+        """
+        Creates the in memory history of a currency from the samples already in its database, from then on it is fed
+        by the recording thread.
+
+        :param db_con: Connection to the database of the currency
+        :return: A RateHistory holding keep_history_seconds worth of samples
+        """
+        # One sample every 5 seconds, with some room for the ones the lending cycle adds
+        history = RateHistory(self.recorded_levels, self.keep_history_seconds / 5 * 1.1)
+        price_levels = []
+        for level in range(self.recorded_levels):
+            price_levels.extend(['rate{0}'.format(level), 'amnt{0}'.format(level)])
+        try:
+            history.extend(self.get_rates_from_db(db_con, from_date=time.time() - self.keep_history_seconds,
+                                                  price_levels=price_levels))
+        except Exception as ex:
+            self.print_traceback(ex, "Error loading market data from DB")
+        return history
+
+    def queue_market_data(self, cur, db_con, row, levels):
+        """
+        Keeps a sample until enough of them are waiting or the oldest has waited long enough, then writes them all at
+        once to the DB.
+
+        :param cur: The currency of the sample
+        :param db_con: Connection to the database of the currency, owned by the calling thread
+        :param row: unixtime, rate0, amnt0, rate1, ..., percentile
+        :param levels: The depth of offered rates in the sample
+        """
+        with self.pending_lock:
+            rows = self.pending_rows.setdefault(cur, [])
+            rows.append(row)
+            last_flush = self.last_flush.setdefault(cur, row[0])
+            if len(rows) < self.db_flush_rows and row[0] - last_flush < self.db_flush_seconds:
+                return
+            self.pending_rows[cur] = []
+            self.last_flush[cur] = row[0]
+            if cur in self.column_stores:
+                # Under the lock, so get_column_samples sees the rows either waiting or in the files
+                self.column_stores[cur].append(rows)
+                return
+        self.insert_rows_into_db(db_con, rows, levels)
+
+    def flush_market_data(self):
+        """
+        Writes the samples still waiting to their DBs, called when the bot exits.
+        """
+        with self.pending_lock:
+            pending_rows = self.pending_rows
+            self.pending_rows = {}
+            for cur, run in self.open_runs.items():
+                pending_rows.setdefault(cur, []).append(self.get_run_row(run))
+            self.open_runs = {}
+        for cur, rows in pending_rows.items():
+            if rows and cur in self.column_stores:
+                self.column_stores[cur].append(rows)
+            elif rows:
+                db_con = self.create_connection(cur)
+                self.insert_rows_into_db(db_con, rows)
+                db_con.close()
+
+    def insert_rows_into_db(self, db_con, rows, levels=None):
+        """
+        Inserts samples with a single prepared statement in one transaction.
+
+        :param db_con: Connection to the database
+        :param rows: Lists of unixtime, rate0, amnt0, rate1, ..., percentile, and for runs of samples the number of
+                     samples and the seconds from the first to the last one
+        :param levels: The depth of offered rates in the samples
+        """
+        if levels is None:
+            levels = self.recorded_levels
+        columns = self.get_columns(levels)
+        tables = {}
+        for row in rows:
+            row = list(row) + [None] * (len(columns) - len(row))  # A single sample leaves samples and duration NULL
+            tables.setdefault(self.get_table_name(row[0]), []).append(row)
+        for table, table_rows in tables.items():
+            if self.partition_by_day:
+                self.create_rate_table(db_con, levels, table)
+            insert_sql = "INSERT INTO {0} ({1}) VALUES ({2});".format(table, ','.join(columns),
+                                                                      ','.join('?' * len(columns)))
             with db_con:
                 try:
-                    db_con.execute(insert_sql)
+                    db_con.executemany(insert_sql, table_rows)
                 except Exception as ex:
                     self.print_traceback(ex, "Error inserting market data into DB")
 
+    @staticmethod
+    def get_columns(levels):
+        """
+        Returns the columns of the rate table that are written, all but id.
+        """
+        columns = ['unixtime']
+        for level in range(levels):
+            columns.extend(['rate{0}'.format(level), 'amnt{0}'.format(level)])
+        return columns + ['percentile', 'samples', 'duration']
+
+    def insert_into_db(self, db_con, market_data, levels=None):
+        self.insert_rows_into_db(db_con, [[int(time.time())] + list(market_data)], levels)
+
     def delete_old_data(self, db_con, seconds):
         """
-        Delete old data from the database
+        Delete old data from the database. With partition_by_day the tables of whole days are dropped and only the
+        oldest day left is cleaned row by row.
 
         :param db_con: Connection to the database
         :param cur: The currency (database) to remove data from
@@ -208,9 +578,58 @@ class MarketAnalysis(object):
         """
         del_time = int(time.time()) - seconds
         with db_con:
-            query = "DELETE FROM loans WHERE unixtime < {0};".format(del_time)
             cursor = db_con.cursor()
-            cursor.execute(query)
+            if self.partition_by_day:
+                oldest_table = self.get_table_name(del_time)
+                for table in self.get_day_tables(db_con):
+                    if table < oldest_table:
+                        cursor.execute("DROP TABLE {0};".format(table))
+                    elif table == oldest_table:
+                        cursor.execute("DELETE FROM {0} WHERE unixtime < {1};".format(table, del_time))
+            else:
+                query = "DELETE FROM loans WHERE unixtime < {0};".format(del_time)
+                cursor.execute(query)
+
+    def get_table_name(self, unixtime):
+        """
+        Returns the table of the samples taken at unixtime, loans or loans_YYYYMMDD (UTC) with partition_by_day.
+        """
+        if not self.partition_by_day:
+            return 'loans'
+        return time.strftime('loans_%Y%m%d', time.gmtime(unixtime))
+
+    @staticmethod
+    def get_day_tables(db_con):
+        """
+        Returns the names of the per day tables of the DB, oldest first.
+        """
+        cursor = db_con.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'loans_[0-9]*' "
+                       "ORDER BY name;")
+        return [row[0] for row in cursor.fetchall()]
+
+    def move_rows_to_day_tables(self, db_con, levels):
+        """
+        Moves the samples recorded before partition_by_day was turned on from the loans table to the per day tables.
+
+        :param db_con: Connection to the database
+        :param levels: The depth of offered rates stored
+        """
+        columns = self.get_columns(levels)
+        with db_con:
+            cursor = db_con.cursor()
+            cursor.execute("SELECT MIN(unixtime), MAX(unixtime) FROM loans;")
+            first, last = cursor.fetchone()
+            if first is None:
+                return
+            day_start = first - first % 86400
+            while day_start <= last:
+                table = self.get_table_name(day_start)
+                self.create_rate_table(db_con, levels, table)
+                cursor.execute("INSERT INTO {0} ({1}) SELECT {1} FROM loans WHERE unixtime >= {2} AND unixtime < {3};"
+                               .format(table, ','.join(columns), day_start, day_start + 86400))
+                day_start += 86400
+            cursor.execute("DELETE FROM loans;")
 
     @staticmethod
     def get_day_difference(date_time):  # Will be a number of seconds since epoch
@@ -225,17 +644,20 @@ class MarketAnalysis(object):
         diff_days = (now - date1).days
         return diff_days
 
-    def get_rate_list(self, cur, seconds):
+    def get_samples(self, cur, seconds, columns):
         """
-        Query the database (cur) for rates that are within the supplied number of seconds and now.
+        Query the database (cur) for the samples that are within the supplied number of seconds and now. Currencies
+        being recorded are read from their in memory history or their column files instead of the database.
 
-        :param cur: The currency (database) to remove data from
-        :param seconds: The number of seconds between the oldest order returned and now.
+        :param cur: The currency (database) to get the samples of
+        :param seconds: The number of seconds between the oldest sample returned and now.
+        :param columns: The indexes of the columns wanted (0 is rate0, 1 is amnt0, 2 is rate1...)
 
-        :return: A pandas DataFrame object with named columns ('time', 'rate0', 'rate1',...)
+        :return: A (times, values) tuple of numpy arrays, values has a column per requested column and NaN for levels
+                 the book did not have. None if the currency is not analysed
         """
         # Request more data from the DB than we need to allow for skipped seconds
-        request_seconds = int(seconds * 1.1)
+        from_date = time.time() - int(seconds * 1.1)
         full_list = Config.get_all_currencies()
         if isinstance(cur, sqlite.Connection):
             db_con = cur
@@ -243,25 +665,97 @@ class MarketAnalysis(object):
             if cur not in full_list:
                 raise ValueError("{0} is not a valid currency, must be one of {1}".format(cur, full_list))
             if cur not in self.currencies_to_analyse:
-                return []
-            db_con = self.create_connection(cur)
+                return None
+            in_memory = cur in self.rate_histories or cur in self.column_stores
+            db_con = None if in_memory else self.create_connection(cur)
 
-        price_levels = ['rate0']
-        rates = self.get_rates_from_db(db_con, from_date=time.time() - request_seconds, price_levels=price_levels)
-        if len(rates) == 0:
-            return []
+        if db_con is None and cur in self.rate_histories:
+            return self.rate_histories[cur].get_window(from_date, columns=columns)
+        if db_con is None:
+            return self.get_column_samples(cur, from_date, columns)
+        names = [self.get_columns(self.recorded_levels)[1 + column] for column in columns]
+        samples = numpy.array(self.get_rates_from_db(db_con, from_date=from_date, price_levels=names),
+                              dtype=numpy.float64).reshape(-1, 1 + len(columns))
+        return samples[:, 0], samples[:, 1:]
 
-        df = pd.DataFrame(rates)
+    def get_column_samples(self, cur, from_date, columns):
+        """
+        Returns the samples of a currency recorded with storage = columns that are newer than from_date: the ones in its
+        column files, then the ones still waiting to be written and the open run, so suggestions do not lag behind
+        db_flush_rows and db_flush_seconds.
 
-        columns = ['time']
-        columns.extend(price_levels)
-        try:
-            df.columns = columns
-        except:
-            if self.ma_debug_log:
-                print("DEBUG:get_rate_list: cols: {0} rates:{1} db:{2}".format(columns, rates, db_con))
-            raise
+        :return: A (times, values) tuple of numpy arrays like get_samples
+        """
+        with self.pending_lock:
+            times, values = self.column_stores[cur].get_window(from_date, columns=columns)
+            rows = list(self.pending_rows.get(cur, []))
+            if cur in self.open_runs:
+                rows.append(self.get_run_row(self.open_runs[cur]))
+        values = ColumnStore.to_float64(values)
+        if not rows:
+            return times, values
+        levels = self.recorded_levels
+        unwritten = numpy.array([[numpy.nan if value is None else value for value in row[1:levels * 2 + 1]]
+                                 for row in rows], dtype=numpy.float64)[:, columns]
+        unwritten_times, unwritten = ColumnStore.expand_runs(
+            numpy.array([row[0] for row in rows], dtype=numpy.int64), unwritten,
+            numpy.array([row[levels * 2 + 2] if len(row) > levels * 2 + 2 else 1 for row in rows]),
+            numpy.array([row[levels * 2 + 3] if len(row) > levels * 2 + 3 else 0 for row in rows]))
+        keep = unwritten_times > from_date
+        return (numpy.concatenate([times.astype(numpy.int64), unwritten_times[keep]]),
+                numpy.concatenate([values, unwritten[keep]]))
+
+    def get_rate_samples(self, cur, seconds, method='percentile'):
+        """
+        Returns the best rate of the samples that are within the supplied number of seconds and now, see get_samples.
+        Samples of an empty book have no rate and are left out.
+
+        With the volumeWeighted method the rate of a sample is the average rate of its recorded levels weighted by
+        their amounts. With dustFiltered it is the best rate of the levels offering at least dust_percent of the amount
+        of all recorded levels, so a few coins offered cheaply do not set the rate.
+
+        :param cur: The currency (database) to get the rates of
+        :param seconds: The number of seconds between the oldest sample returned and now.
+        :param method: The analysis method the rates are for
 
+        :return: A (times, rates) tuple of numpy arrays, None if the currency is not analysed
+        """
+        if method not in DEPTH_METHODS:
+            samples = self.get_samples(cur, seconds, [0])
+            if samples is None:
+                return None
+            times, rates = samples[0], samples[1][:, 0]
+        else:
+            samples = self.get_samples(cur, seconds, list(range(self.recorded_levels * 2)))
+            if samples is None:
+                return None
+            times, values = samples
+            level_rates, amounts = values[:, 0::2], numpy.nan_to_num(values[:, 1::2])
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                if method == 'volumeWeighted':
+                    rates = numpy.nansum(level_rates * amounts, axis=1) / amounts.sum(axis=1)
+                else:
+                    big_enough = amounts >= amounts.sum(axis=1, keepdims=True) * (self.dust_percent / 100.0)
+                    big_enough &= ~numpy.isnan(level_rates)
+                    rates = level_rates[numpy.arange(len(times)), numpy.argmax(big_enough, axis=1)]
+                    rates[~big_enough.any(axis=1)] = numpy.nan
+        has_rate = ~numpy.isnan(rates)
+        return times[has_rate], rates[has_rate]
+
+    def get_rate_list(self, cur, seconds):
+        """
+        Query the database (cur) for rates that are within the supplied number of seconds and now, see
+        get_rate_samples.
+
+        :param cur: The currency (database) to get the rates of
+        :param seconds: The number of seconds between the oldest order returned and now.
+
+        :return: A pandas DataFrame object with named columns ('time', 'rate0')
+        """
+        samples = self.get_rate_samples(cur, seconds)
+        if samples is None or len(samples[0]) == 0:
+            return []
+        df = pd.DataFrame({'time': samples[0], 'rate0': samples[1]})
         # convert unixtimes to datetimes so we can resample
         df.time = pd.to_datetime(df.time, unit='s')
         # If we don't have enough data return df, otherwise the resample will fill out all values with the same data.
@@ -277,7 +771,7 @@ class MarketAnalysis(object):
         """
         Gets the correct number of seconds to use for anylsing data depeding on the method being used.
         """
-        if method == 'percentile':
+        if method == 'percentile' or method in DEPTH_METHODS:
             return self.percentile_seconds
         elif method == 'MACD':
             return self.MACD_long_win_seconds
@@ -294,8 +788,35 @@ class MarketAnalysis(object):
 
         :return: A float with the suggested rate for the currency.
         """
-        error_msg = "WARN: Exception found when analysing markets, if this happens for more than a couple minutes " +\
-                    "please create a Github issue so we can fix it. Otherwise, you can ignore it. Error"
+        latest_sample_time = self.latest_sample_times.get(cur) if rates is None else None
+        if latest_sample_time is None:
+            return self.calculate_rate_suggestion(cur, rates, method)
+        # The suggestion only changes with a new sample, or slowly as old ones leave the window
+        key = (cur, method)
+        with self.suggestion_lock:
+            cached = self.suggestion_cache.get(key)
+            if cached is not None and cached[0] == latest_sample_time \
+                    and time.time() - cached[1] < self.suggestion_cache_seconds:
+                self.suggestion_cache_hits += 1
+                return cached[2]
+            self.suggestion_cache_misses += 1
+        suggestion = self.calculate_rate_suggestion(cur, rates, method)
+        with self.suggestion_lock:
+            self.suggestion_cache[key] = (latest_sample_time, time.time(), suggestion)
+            if self.ma_debug_log:
+                print("DEBUG:Suggestion cache: {0} {1} recalculated, {2} hits, {3} misses".format(
+                    cur, method, self.suggestion_cache_hits, self.suggestion_cache_misses))
+        return suggestion
+
+    def calculate_rate_suggestion(self, cur, rates=None, method='percentile'):
+        """
+        Calculates the suggestion get_rate_suggestion returns, without the cache.
+        """
+        # The streaming statistics only follow rate0 for the configured method, the others read the samples
+        if rates is None and cur in self.rate_stats and method in self.rate_stats[cur]:
+            return self.get_streaming_rate_suggestion(cur, method)
+        if rates is None and (self.engine != 'pandas' or method in DEPTH_METHODS):
+            return self.get_weighted_rate_suggestion(cur, method)
 
         try:
             rates = self.get_rate_list(cur, self.get_analysis_seconds(method)) if rates is None else rates
@@ -322,9 +843,70 @@ class MarketAnalysis(object):
             else:
                 raise
         except Exception as ex:
-            self.print_exception_error(ex, error_msg, debug=self.ma_debug_log)
+            self.print_exception_error(ex, ANALYSIS_ERROR_MSG, debug=self.ma_debug_log)
             return 0
 
+    def get_streaming_rate_suggestion(self, cur, method):
+        """
+        Same as get_rate_suggestion, computed from the streaming statistics of the currency instead of its rate list.
+
+        :param cur: The currency to get the suggestion for
+        :param method: The method by which you want to calculate the suggestion.
+
+        :return: A float with the suggested rate for the currency.
+        """
+        with self.rate_stats_lock:
+            stats = self.rate_stats[cur][method]
+            stats.expire(time.time())
+            return self.get_stats_rate_suggestion(cur, method, stats)
+
+    def get_weighted_rate_suggestion(self, cur, method):
+        """
+        Same as get_rate_suggestion, computed on the samples of the currency weighted by how long each was held instead
+        of on the resampled rate list.
+
+        :param cur: The currency to get the suggestion for
+        :param method: The method by which you want to calculate the suggestion.
+
+        :return: A float with the suggested rate for the currency.
+        """
+        try:
+            samples = self.get_rate_samples(cur, self.get_analysis_seconds(method), method)
+            if samples is None:
+                print("Rate list not populated")
+                return 0
+            return self.get_stats_rate_suggestion(cur, method, TimeWeightedRates(*samples))
+        except Exception as ex:
+            self.print_exception_error(ex, ANALYSIS_ERROR_MSG, debug=self.ma_debug_log)
+            return 0
+
+    def get_stats_rate_suggestion(self, cur, method, stats):
+        """
+        Picks the suggestion of method from the statistics of a window of rates, a StreamingRateStats or a
+        TimeWeightedRates, the way get_rate_suggestion does from the rate list.
+        """
+        # get_rate_list only resamples the rates once there are enough of them
+        min_records = self.get_analysis_seconds(method) * (self.data_tolerance / 100)
+        resampled = stats.get_sample_count() >= min_records
+        if stats.get_sample_count() == 0:
+            print("Rate list not populated")
+            return 0
+        if method != 'MACD':
+            return truncate(stats.get_percentile(self.lending_style, resampled), 6)
+        records = stats.get_resampled_length() if resampled else stats.get_sample_count()
+        if records < min_records:
+            print("{0} : Need more data for analysis, still collecting. I have {1}/{2} records"
+                  .format(cur, records, int(min_records)))
+            print("Caught exception during {0} analysis, using percentile for now".format(method))
+            return truncate(stats.get_percentile(self.lending_style, resampled), 6)
+        short_rate = stats.get_tail_mean(self.MACD_short_win_seconds)
+        long_rate = stats.get_tail_mean(self.MACD_long_win_seconds)
+        macd_rate = truncate(self.get_MACD_suggestion(short_rate, long_rate, stats.get_last_rate()), 6)
+        if self.ma_debug_log:
+            print("Cur:{0}, MACD:{1:.6f}, Perc:{2:.6f}, Best:{3:.6f}"
+                  .format(cur, macd_rate, stats.get_percentile(self.lending_style, resampled), stats.get_last_rate()))
+        return macd_rate
+
     @staticmethod
     def percentile(N, percent, key=lambda x: x):
         """
@@ -381,15 +963,20 @@ class MarketAnalysis(object):
 
         short_rate = rates_df.rate0.tail(self.MACD_short_win_seconds).mean()
         long_rate = rates_df.rate0.tail(self.MACD_long_win_seconds).mean()
+        return self.get_MACD_suggestion(short_rate, long_rate, rates_df.rate0.iloc[-1])
 
+    def get_MACD_suggestion(self, short_rate, long_rate, last_rate):
+        """
+        Picks the suggested rate from the short and long moving averages and the latest rate.
+        """
         if self.ma_debug_log:
             sys.stdout.write("Short higher: ") if short_rate > long_rate else sys.stdout.write("Long  higher: ")
 
         if short_rate > long_rate:
-            if rates_df.rate0.iloc[-1] < short_rate:
+            if last_rate < short_rate:
                 return short_rate * self.daily_min_multiplier
             else:
-                return rates_df.rate0.iloc[-1] * self.daily_min_multiplier
+                return last_rate * self.daily_min_multiplier
         else:
             return long_rate * self.daily_min_multiplier
 
@@ -411,39 +998,68 @@ class MarketAnalysis(object):
         except Error as ex:
             print(ex.message)
 
-    def create_rate_table(self, db_con, levels):
+    def create_rate_table(self, db_con, levels, table='loans'):
         """
-        Create a new table to hold rate data.
+        Create a new table to hold rate data, with an index on unixtime for the time range queries and deletes. The
+        index and the samples and duration columns of change only recording are added to existing tables as well.
 
         :param db_con: Connection to the database
         :param cur: The currency being stored in the DB. There's a table for each currency.
         :param levels: The depth of offered rates to store
+        :param table: The name of the table, loans or one of the per day tables
         """
         with db_con:
             cursor = db_con.cursor()
-            create_table_sql = "CREATE TABLE IF NOT EXISTS loans (id INTEGER PRIMARY KEY AUTOINCREMENT," + \
+            create_table_sql = "CREATE TABLE IF NOT EXISTS {0} (id INTEGER PRIMARY KEY AUTOINCREMENT,".format(table) + \
                                "unixtime integer(4) not null default (strftime('%s','now')),"
             for level in range(levels):
                 create_table_sql += "rate{0} FLOAT, ".format(level)
                 create_table_sql += "amnt{0} FLOAT, ".format(level)
-            create_table_sql += "percentile FLOAT);"
+            create_table_sql += "percentile FLOAT, samples INTEGER, duration INTEGER);"
             cursor.execute("PRAGMA journal_mode=wal")
             cursor.execute(create_table_sql)
+            existing = [row[1] for row in cursor.execute("PRAGMA table_info({0});".format(table)).fetchall()]
+            for column in ['samples', 'duration']:
+                if column not in existing:
+                    cursor.execute("ALTER TABLE {0} ADD COLUMN {1} INTEGER;".format(table, column))
+            cursor.execute("CREATE INDEX IF NOT EXISTS {0}_unixtime ON {0} (unixtime);".format(table))
 
     def get_rates_from_db(self, db_con, from_date=None, price_levels=['rate0']):
         """
-        Query the DB for all rates for a particular currency
+        Query the DB for all rates for a particular currency. Rows standing for a run of identical samples are
+        expanded back into the samples, spread evenly over the run, so the step series comes out as it was recorded.
 
         :param db_con: Connection to the database
         :param cur: The currency you want to get the rates for
         :param from_date: The earliest data you want, specified in unix time (seconds since epoch)
         :price_level: We record multiple price levels in the DB, the best offer being rate0
         """
+        # A run starting before from_date can reach into the requested time
+        first_date = None if from_date is None else from_date - MAX_RUN_SECONDS
         with db_con:
             cursor = db_con.cursor()
-            query = "SELECT unixtime, {0} FROM loans ".format(",".join(price_levels))
-            if from_date is not None:
-                query += "WHERE unixtime > {0}".format(from_date)
-            query += ";"
-            cursor.execute(query)
-            return cursor.fetchall()
+            tables = ['loans']
+            if self.partition_by_day:
+                oldest_table = None if from_date is None else self.get_table_name(first_date)
+                tables = [table for table in self.get_day_tables(db_con)
+                          if oldest_table is None or table >= oldest_table]
+                if len(tables) == 0:
+                    return []
+            queries = []
+            for table in tables:
+                query = "SELECT unixtime, {0}, samples, duration FROM {1} ".format(",".join(price_levels), table)
+                if from_date is not None:
+                    query += "WHERE unixtime > {0} AND unixtime + IFNULL(duration, 0) > {1}".format(first_date,
+                                                                                                   from_date)
+                queries.append(query)
+            cursor.execute(" UNION ALL ".join(queries) + ";")
+            rows = cursor.fetchall()
+        rates = []
+        for row in rows:
+            unixtime, samples, duration = row[0], row[-2], row[-1]
+            if samples is None or samples < 2:
+                times = [unixtime]
+            else:
+                times = [unixtime + duration * i // (samples - 1) for i in range(samples)]
+            rates.extend((t,) + row[1:-2] for t in times if from_date is None or t > from_date)
+        return rates
@@ -1,7 +1,11 @@
 # coding=utf-8
-import urllib
-import json
+import atexit
+import queue
 import smtplib
+import threading
+import time
+
+import requests
 try:
     from irc import client
     IRC_LOADED = True
@@ -10,28 +14,26 @@ except ImportError:
 
 IRC_CLIENT = None
 IRC_SERVER = None
+SMTP_SERVER = None  # Connection kept from one email to the next, with the settings it was opened with
+HTTP_SESSION = requests.Session()  # Keeps the connections to Slack, Telegram and Pushbullet alive
+HTTP_TIMEOUT = 30
 
-
-# Slack post data needs to be encoded in UTF-8
-def encoded_dict(in_dict):
-    out_dict = {}
-    for k, v in in_dict.iteritems():
-        if isinstance(v, unicode):
-            v = v.encode('utf8')
-        elif isinstance(v, str):
-            # Must be encoded in UTF-8
-            v.decode('utf8')
-        out_dict[k] = v
-    return out_dict
+QUEUE_SIZE = 100  # Notifications waiting to be sent, newer ones are dropped when it is full
+COALESCE_SECONDS = 5  # Notifications queued within this long of the first one are sent as one message
+MAX_COALESCED = 20  # Most notifications sent as one message
+RETRIES = 3  # Attempts after the first for a platform that fails, with RETRY_SECONDS doubling between them
+RETRY_SECONDS = 10
+FLUSH_SECONDS = 15  # How long the bot waits on exit for the queued notifications to be sent
+WORKER = None
+WORKER_LOCK = threading.Lock()
 
 
 class NotificationException(Exception):
     pass
 
 
-def check_urlib_response(response, platform):
-    response_str = response.read()
-    response_obj = json.loads(response_str)
+def check_response(response, platform):
+    response_obj = response.json()
     if not response_obj['ok']:
         msg = "Error connecting to {0}, got response: {1}".format(platform, response_obj)
         raise NotificationException(msg)
@@ -40,22 +42,51 @@ def check_urlib_response(response, platform):
 def post_to_slack(msg, channels, token, username):
     for channel in channels:
         post_data = {'text': msg, 'channel': channel, 'token': token, 'username': username}
-        enc_post_data = urllib.parse.urlencode(encoded_dict(post_data))
         url = 'https://{}/api/{}'.format('slack.com', 'chat.postMessage')
-        response = urllib.urlopen(url, enc_post_data)
-        check_urlib_response(response, 'slack')
+        response = HTTP_SESSION.post(url, data=post_data, timeout=HTTP_TIMEOUT)
+        check_response(response, 'slack')
 
 
 def post_to_telegram(msg, chat_ids, bot_id):
     for chat_id in chat_ids:
         post_data = {"chat_id": chat_id, "text": msg}
         url = "https://api.telegram.org/bot" + bot_id + "/sendMessage"
-        try:
-            response = urllib.urlopen(url, urllib.parse.urlencode(post_data))
-            check_urlib_response(response, 'telegram')
-        except urllib.HTTPError as e:
+        response = HTTP_SESSION.post(url, data=post_data, timeout=HTTP_TIMEOUT)
+        if response.status_code in [401, 404]:
             msg = "Your bot id is probably configured incorrectly"
-            raise NotificationException("{0}\n{1}".format(e, msg))
+            raise NotificationException("{0}\n{1}".format(response.text, msg))
+        check_response(response, 'telegram')
+
+
+def connect_smtp(email_login_address, email_login_password, email_smtp_server, email_smtp_port, email_smtp_starttls):
+    """
+    Returns the connection to the SMTP server, logged in, opening it unless the last email left it open.
+    """
+    global SMTP_SERVER
+    settings = (email_login_address, email_smtp_server, email_smtp_port, email_smtp_starttls)
+    if SMTP_SERVER is not None and SMTP_SERVER[0] == settings:
+        return SMTP_SERVER[1]
+    close_smtp()
+    if email_smtp_starttls:
+        server = smtplib.SMTP(email_smtp_server, email_smtp_port, timeout=HTTP_TIMEOUT)
+        server.ehlo()
+        server.starttls()
+    else:
+        server = smtplib.SMTP_SSL(email_smtp_server, email_smtp_port, timeout=HTTP_TIMEOUT)
+    server.ehlo()
+    server.login(email_login_address, email_login_password)
+    SMTP_SERVER = (settings, server)
+    return server
+
+
+def close_smtp():
+    global SMTP_SERVER
+    if SMTP_SERVER is not None:
+        try:
+            SMTP_SERVER[1].quit()
+        except Exception:
+            pass  # Already closed by the server
+        SMTP_SERVER = None
 
 
 def send_email(msg, email_login_address, email_login_password, email_smtp_server, email_smtp_port,
@@ -68,30 +99,27 @@ def send_email(msg, email_login_address, email_login_password, email_smtp_server
                               "",
                               "{0}".format(msg)
                               ])
+    settings = (email_login_address, email_login_password, email_smtp_server, email_smtp_port, email_smtp_starttls)
 
     try:
-        if email_smtp_starttls:
-            server = smtplib.SMTP(email_smtp_server, email_smtp_port)
-            server.ehlo()
-            server.starttls()
-        else:
-            server = smtplib.SMTP_SSL(email_smtp_server, email_smtp_port)
-        server.ehlo()
-        server.login(email_login_address, email_login_password)
-        server.sendmail(email_login_address, email_to_addresses, email_text)
-        server.close()
+        try:
+            connect_smtp(*settings).sendmail(email_login_address, email_to_addresses, email_text)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed the connection while it was idle
+            close_smtp()
+            connect_smtp(*settings).sendmail(email_login_address, email_to_addresses, email_text)
     except Exception as e:
+        close_smtp()
         print("Could not send email, got error {0}".format(e))
         raise NotificationException(e)
 
 
 def post_to_pushbullet(msg, token, deviceid):
     post_data = {'body': msg, 'device_iden': deviceid, 'title': 'Poloniex Bot', 'type': 'note'}
-    opener = urllib2.build_opener()
-    req = urllib2.Request('https://api.pushbullet.com/v2/pushes', data=json.dumps(post_data),
-                          headers={'Content-Type': 'application/json', 'Access-Token': token})
     try:
-        opener.open(req)
+        response = HTTP_SESSION.post('https://api.pushbullet.com/v2/pushes', json=post_data,
+                                     headers={'Access-Token': token}, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
     except Exception as e:
         print("Could not send pushbullet, got error {0}".format(e))
         raise NotificationException(e)
@@ -106,29 +134,165 @@ def post_to_irc(msg, host, port, nick, ident, realname, target):
         IRC_CLIENT = client.Reactor()
         IRC_SERVER = IRC_CLIENT.server()
 
-    IRC_SERVER.connect(host, port, nick)
+    if not IRC_SERVER.is_connected():
+        IRC_SERVER.connect(host, port, nick)
     if client.is_channel(target):
         IRC_SERVER.join(target)
     for line in msg.splitlines():
         IRC_SERVER.privmsg(target, line)
 
 
-def send_notification(_msg, notify_conf):
-    nc = notify_conf
-    msg = _msg if ('notify_prefix' not in nc) else "{} {}".format(nc['notify_prefix'], _msg)
-
+def get_senders(nc):
+    """
+    :param nc: The notification config
+    :return: A list of (platform, function sending a message to it) of the enabled platforms, a Slack channel or a
+             Telegram chat id counting as a platform
+    """
+    senders = []
     if nc['email']:
-        send_email(msg, nc['email_login_address'], nc['email_login_password'], nc['email_smtp_server'],
-                   nc['email_smtp_port'], nc['email_to_addresses'], nc['email_smtp_starttls'])
+        senders.append(('email', lambda msg: send_email(
+            msg, nc['email_login_address'], nc['email_login_password'], nc['email_smtp_server'],
+            nc['email_smtp_port'], nc['email_to_addresses'], nc['email_smtp_starttls'])))
+    # One sender per channel and chat id, so a retry does not send again to the ones that got the message
     if nc['slack']:
-        post_to_slack(msg, nc['slack_channels'], nc['slack_token'], nc['slack_username'])
+        for channel in nc['slack_channels']:
+            senders.append(('slack ' + channel, lambda msg, channel=channel: post_to_slack(
+                msg, [channel], nc['slack_token'], nc['slack_username'])))
     if nc['telegram']:
-        post_to_telegram(msg, nc['telegram_chat_ids'], nc['telegram_bot_id'])
+        for chat_id in nc['telegram_chat_ids']:
+            senders.append(('telegram ' + chat_id, lambda msg, chat_id=chat_id: post_to_telegram(
+                msg, [chat_id], nc['telegram_bot_id'])))
     if nc['pushbullet']:
-        post_to_pushbullet(msg, nc['pushbullet_token'], nc['pushbullet_deviceid'])
+        senders.append(('pushbullet', lambda msg: post_to_pushbullet(msg, nc['pushbullet_token'],
+                                                                     nc['pushbullet_deviceid'])))
     if nc['irc']:
         if IRC_LOADED:
-            post_to_irc(msg, nc['irc_host'], nc['irc_port'], nc['irc_nick'], nc['irc_ident'], nc['irc_realname'],
-                        nc['irc_target'])
+            senders.append(('irc', lambda msg: post_to_irc(msg, nc['irc_host'], nc['irc_port'], nc['irc_nick'],
+                                                           nc['irc_ident'], nc['irc_realname'], nc['irc_target'])))
         else:
             print("IRC module not available, please run 'pip install irc'")
+    return senders
+
+
+def add_prefix(msg, nc):
+    return msg if ('notify_prefix' not in nc) else "{} {}".format(nc['notify_prefix'], msg)
+
+
+def send_notification(_msg, notify_conf):
+    msg = add_prefix(_msg, notify_conf)
+    for _, send in get_senders(notify_conf):
+        send(msg)
+
+
+class NotificationWorker(object):
+    """
+    Sends the notifications from a background thread, so a slow or unreachable platform never holds up lending.
+    Notifications queued within coalesce_seconds of each other, or while the last ones were being sent, go out as one
+    message. A platform that fails is tried again after a delay doubling each time, without sending the message again
+    to the platforms that got it.
+    """
+    def __init__(self, queue_size=QUEUE_SIZE, coalesce_seconds=COALESCE_SECONDS, retries=RETRIES,
+                 retry_seconds=RETRY_SECONDS):
+        self.queue = queue.Queue(queue_size)
+        self.coalesce_seconds = coalesce_seconds
+        self.retries = retries
+        self.retry_seconds = retry_seconds
+        self.next_item = None  # Notification taken from the queue for the next message, it has another config
+        self.dropped = 0
+        self.flushing = False  # Set on exit, the queued notifications go out without waiting for more
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def put(self, msg, notify_conf):
+        try:
+            self.queue.put_nowait((msg, notify_conf))
+        except queue.Full:
+            self.dropped += 1
+            print("Notification queue full, dropped {0} notifications so far: {1}".format(self.dropped, msg))
+
+    def get_batch(self):
+        """
+        Waits for a notification and takes the ones following it within coalesce_seconds.
+
+        :return: The messages and their notification config
+        """
+        first = self.next_item or self.queue.get()
+        self.next_item = None
+        messages = [first[0]]
+        deadline = time.time() + self.coalesce_seconds
+        while len(messages) < MAX_COALESCED:
+            remaining = 0 if self.flushing else deadline - time.time()
+            try:
+                # Short waits, so a flush does not wait for the end of the coalescing
+                item = self.queue.get(timeout=max(min(remaining, 0.1), 0.001))
+            except queue.Empty:
+                if remaining > 0.1:
+                    continue
+                break
+            if item[1] is not first[1]:
+                self.next_item = item
+                break
+            messages.append(item[0])
+        return messages, first[1]
+
+    def run(self):
+        while True:
+            messages, notify_conf = self.get_batch()
+            try:
+                self.deliver(add_prefix("\n\n".join(messages), notify_conf), notify_conf)
+            except Exception as ex:
+                print("Could not send notification, got error {0}".format(ex))
+            for _ in messages:
+                self.queue.task_done()
+
+    def deliver(self, msg, notify_conf):
+        senders = get_senders(notify_conf)
+        delay = self.retry_seconds
+        for attempt in range(self.retries + 1):
+            failed = []
+            for platform, send in senders:
+                try:
+                    send(msg)
+                except Exception as ex:
+                    failed.append((platform, send))
+                    error = ex
+            if not failed:
+                return
+            senders = failed
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        print("Could not send notification to {0}, got error {1}".format(
+            ', '.join(platform for platform, _ in senders), error))
+
+    def flush(self, timeout):
+        """
+        Waits for the queued notifications to be sent, at most timeout seconds.
+        """
+        deadline = time.time() + timeout
+        self.flushing = True
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and time.time() < deadline:
+                self.queue.all_tasks_done.wait(deadline - time.time())
+
+
+def flush_notifications():
+    """
+    Waits up to FLUSH_SECONDS for the queued notifications to be sent, for the exit of the bot as os._exit skips the
+    atexit handlers.
+    """
+    if WORKER is not None:
+        WORKER.flush(FLUSH_SECONDS)
+
+
+def queue_notification(msg, notify_conf):
+    """
+    Sends the notification in the background, starting the worker the first time.
+    """
+    global WORKER
+    with WORKER_LOCK:
+        if WORKER is None:
+            WORKER = NotificationWorker()
+            atexit.register(WORKER.flush, FLUSH_SECONDS)
+    WORKER.put(msg, notify_conf)
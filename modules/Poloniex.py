@@ -1,16 +1,13 @@
 # coding=utf-8
-import sys
 import hashlib
 import hmac
-import json
-import socket
 import time
-import urllib
+import urllib.parse
 import threading
-from urllib.error import HTTPError
 
 import modules.Configuration as Config
-from modules.RingBuffer import RingBuffer
+from modules.ApiSession import ApiSession
+from modules.RequestScheduler import RequestScheduler, PRIORITY_ORDER, PRIORITY_BALANCE, PRIORITY_MARKET_DATA
 from modules.ExchangeApi import ExchangeApi
 from modules.ExchangeApi import ApiError
 
@@ -32,6 +29,12 @@ def post_process(before):
     return after
 
 
+PUBLIC_COMMANDS = ["returnTicker", "return24hVolume", "returnOrderBook", "returnMarketTradeHistory", "returnLoanOrders"]
+# Signed commands that place or move funds, these go before balance reads and market data
+ORDER_COMMANDS = ["createLoanOffer", "cancelLoanOffer", "transferBalance", "toggleAutoRenew", "buy", "sell",
+                  "cancelOrder", "withdraw"]
+
+
 class Poloniex(ExchangeApi):
     def __init__(self, cfg, log):
         super(Poloniex, self).__init__(cfg, log)
@@ -42,13 +45,14 @@ class Poloniex(ExchangeApi):
         self.req_per_period = 6
         self.default_req_period = 1000  # milliseconds
         self.req_period = self.default_req_period
-        self.req_time_log = RingBuffer(self.req_per_period)
+        self.request_scheduler = RequestScheduler(self)
         self.lock = threading.RLock()
-        socket.setdefaulttimeout(int(Config.get("BOT", "timeout", 30, 1, 180)))
+        self.session = ApiSession(self.cfg)
+        self.timeout = int(Config.get("BOT", "timeout", 30, 1, 180))
         self.api_debug_log = self.cfg.getboolean("BOT", "api_debug_log")
 
-    def limit_request_rate(self):
-        super(Poloniex, self).limit_request_rate()
+    def limit_request_rate(self, priority=PRIORITY_MARKET_DATA):
+        super(Poloniex, self).limit_request_rate(priority)
 
     def increase_request_timer(self):
         super(Poloniex, self).increase_request_timer()
@@ -59,45 +63,33 @@ class Poloniex(ExchangeApi):
     def reset_request_timer(self):
         super(Poloniex, self).reset_request_timer()
 
-    @ExchangeApi.synchronized
     def api_query(self, command, req=None):
-        # keep the 6 request per sec limit
-        self.limit_request_rate()
+        if command in PUBLIC_COMMANDS:
+            # keep the 6 request per sec limit, public requests carry no nonce so they never need the lock
+            self.limit_request_rate(PRIORITY_MARKET_DATA)
+            return self._query(command, req)
+        # keep the 6 request per sec limit, the wait for a slot happens before taking the lock
+        self.limit_request_rate(PRIORITY_ORDER if command in ORDER_COMMANDS else PRIORITY_BALANCE)
+        return self._private_query(command, req)
 
+    @ExchangeApi.synchronized
+    def _private_query(self, command, req=None):
+        return self._query(command, req)
+
+    def _query(self, command, req=None):
         if req is None:
             req = {}
 
-        def _read_response(resp):
-            resp_data = json.loads(resp.read())
-            if 'error' in resp_data:
-                raise ApiError(resp_data['error'])
-            return resp_data
-
         try:
-            if command == "returnTicker" or command == "return24hVolume":
-                ret = urllib.request.urlopen(
-                    f'https://poloniex.com/public?command={command}')
-                return _read_response(ret)
-            elif command == "returnOrderBook":
-                ret = urllib.request.urlopen(
-                         'https://poloniex.com/public?command=' +
-                         command + '&currencyPair=' +
-                         str(req['currencyPair']))
-                return _read_response(ret)
-            elif command == "returnMarketTradeHistory":
-                ret = urllib.request.urlopen(
-                          'https://poloniex.com/public?command=' +
-                          "returnTradeHistory" + '&currencyPair=' +
-                          str(req['currencyPair']))
-                return _read_response(ret)
-            elif command == "returnLoanOrders":
-                req_url = ('https://poloniex.com/public?command=' +
-                           "returnLoanOrders" + '&currency=' +
-                           str(req['currency']))
-                if req['limit'] > 0:
-                    req_url += ('&limit=' + str(req['limit']))
-                ret = urllib.request.urlopen(req_url)
-                return _read_response(ret)
+            if command in PUBLIC_COMMANDS:
+                params = {'command': "returnTradeHistory" if command == "returnMarketTradeHistory" else command}
+                if command == "returnOrderBook" or command == "returnMarketTradeHistory":
+                    params['currencyPair'] = str(req['currencyPair'])
+                elif command == "returnLoanOrders":
+                    params['currency'] = str(req['currency'])
+                    if req['limit'] > 0:
+                        params['limit'] = str(req['limit'])
+                ret = self.session.request('GET', 'https://poloniex.com/public', params=params, timeout=self.timeout)
             else:
                 req['command'] = command
                 req['nonce'] = int(time.time() * 1000)
@@ -106,39 +98,41 @@ class Poloniex(ExchangeApi):
                 sign = hmac.new(self.Secret.encode('utf8'),
                                 post_data,
                                 hashlib.sha512).hexdigest()
-                headers = {'Sign': sign, 'Key': self.APIKey}
-
-                ret = urllib.request.urlopen(
-                    urllib.request.Request('https://poloniex.com/tradingApi',
-                                   post_data, headers))
-                json_ret = _read_response(ret)
-                return post_process(json_ret)
+                headers = {'Sign': sign, 'Key': self.APIKey,
+                           'Content-Type': 'application/x-www-form-urlencoded'}
 
-            # Check in case something has gone wrong and the timer is too big
-            self.reset_request_timer()
+                ret = self.session.request('POST', 'https://poloniex.com/tradingApi', data=post_data,
+                                           headers=headers, timeout=self.timeout)
+        except Exception as ex:
+            raise RuntimeError(f'{str(ex)} - Requesting {command}')
 
-        except HTTPError as ex:
-            raw_polo_response = ex.read()
+        if ret.status_code != 200:
             try:
-                data = json.loads(raw_polo_response)
-                polo_error_msg = data['error']
-            except:
-                if hasattr(ex, 'code') and (ex.code == 502
-                                            or ex.code in range(520, 527, 1)):
+                polo_error_msg = ret.json()['error']
+            except Exception:
+                if ret.status_code == 502 or ret.status_code in range(520, 527, 1):
                     # 502 and 520-526 Bad Gateway so response is likely HTML from Cloudflare
-                    polo_error_msg = 'API Error ' + str(ex.code) + \
+                    polo_error_msg = 'API Error ' + str(ret.status_code) + \
                                      ': The web server reported a bad gateway or gateway timeout error.'
-                elif hasattr(ex, 'code') and (ex.code == 429):
-                    self.increase_request_timer()
                 else:
-                    polo_error_msg = raw_polo_response
-            tt, vv, tb = sys.exc_info()
-            raise RuntimeError(f'{str(ex)} - requesting {command} - Poloniex reports {polo_error_msg}')
+                    polo_error_msg = ret.text
+            if ret.status_code == 429:
+                self.increase_request_timer()
+            raise RuntimeError(f'HTTP Error {ret.status_code}: {ret.reason} - requesting {command} - '
+                               f'Poloniex reports {polo_error_msg}')
 
-              
+        try:
+            resp_data = ret.json()
         except Exception as ex:
-            tt, vv, tb = sys.exc_info()
-            raise RuntimeError(f'{str(ex)} - Requesting {request}')
+            raise RuntimeError(f'{str(ex)} - Requesting {command}')
+        if 'error' in resp_data:
+            raise ApiError(resp_data['error'])
+
+        # Check in case something has gone wrong and the timer is too big
+        self.reset_request_timer()
+        if command in PUBLIC_COMMANDS:
+            return resp_data
+        return post_process(resp_data)
 
     def return_ticker(self):
         return self.api_query("returnTicker")
@@ -0,0 +1,79 @@
+# coding=utf-8
+import threading
+
+import numpy
+
+
+class RateHistory(object):
+    """
+    In memory history of the recorded market samples of one currency, one row of (unixtime, rate0, amnt0, rate1, ...)
+    per sample. The rows live in a numpy array twice the needed capacity: new rows are appended and when the end is
+    reached the newest rows are moved back to the start, so any window of the history is a contiguous slice and an
+    append costs O(1) amortised.
+    """
+    def __init__(self, levels, capacity):
+        """
+        :param levels: The depth of offered rates in each sample
+        :param capacity: The number of samples to keep, older ones are dropped as new ones come in
+        """
+        self.levels = levels
+        self.capacity = max(int(capacity), 1)
+        self.times = numpy.zeros(self.capacity * 2, dtype=numpy.int64)
+        self.values = numpy.zeros((self.capacity * 2, levels * 2), dtype=numpy.float64)
+        self.start = 0
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, unixtime, values):
+        """
+        Adds a sample.
+
+        :param unixtime: The time of the sample in seconds since epoch
+        :param values: rate0, amnt0, rate1, amnt1, ... for all levels
+        """
+        with self.lock:
+            if self.end == len(self.times):
+                keep = self.capacity - 1
+                self.times[:keep] = self.times[self.end - keep:self.end]
+                self.values[:keep] = self.values[self.end - keep:self.end]
+                self.start, self.end = 0, keep
+            self.times[self.end] = unixtime
+            self.values[self.end] = values
+            self.end += 1
+            if self.end - self.start > self.capacity:
+                self.start += 1
+
+    def extend(self, rows):
+        """
+        Adds samples in time order, for loading the history from the database.
+
+        :param rows: An iterable of (unixtime, rate0, amnt0, rate1, ...) tuples
+        """
+        for row in rows:
+            self.append(row[0], row[1:])
+
+    def get_window(self, from_date=None, columns=None):
+        """
+        Returns a copy of the samples newer than from_date.
+
+        :param from_date: The earliest data you want, specified in unix time (seconds since epoch), None for all
+        :param columns: The indexes of the value columns to return (0 is rate0, 1 is amnt0, 2 is rate1...), None for all
+        :return: A (times, values) tuple of numpy arrays
+        """
+        with self.lock:
+            times = self.times[self.start:self.end]
+            first = 0 if from_date is None else numpy.searchsorted(times, from_date, side='right')
+            values = self.values[self.start + first:self.end]
+            if columns is not None:
+                values = values[:, columns]
+            return times[first:].copy(), values.copy()
+
+    def get_latest_time(self):
+        """
+        :return: The time of the newest sample, None when there is none
+        """
+        with self.lock:
+            return int(self.times[self.end - 1]) if self.end > self.start else None
@@ -0,0 +1,70 @@
+# coding=utf-8
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+# Request priorities, lower values are served first
+PRIORITY_ORDER = 0
+PRIORITY_BALANCE = 1
+PRIORITY_MARKET_DATA = 2
+
+
+class RequestScheduler(object):
+    """
+    Hands out request slots to all threads sharing an exchange api. It works as a bucket of api.req_per_period tokens
+    where a used token comes back api.req_period milliseconds later, so no more than req_per_period requests start in
+    any req_period. Waiting callers are served by priority, then in order of arrival.
+    """
+    def __init__(self, api):
+        self.api = api
+        self.condition = threading.Condition()
+        self.used_tokens = deque()  # Times (ms) at which the tokens still out were taken
+        self.waiting = []  # Heap of (priority, arrival) tickets
+        self.arrivals = itertools.count()
+
+    def _return_tokens(self, now):
+        while self.used_tokens and now - self.used_tokens[0] >= self.api.req_period:
+            self.used_tokens.popleft()
+
+    def acquire(self, priority=PRIORITY_MARKET_DATA):
+        """
+        Blocks until the caller may send a request. Only the scheduler's own condition is held while waiting, never
+        the api lock.
+        """
+        ticket = (priority, next(self.arrivals))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    now = time.time() * 1000  # milliseconds
+                    self._return_tokens(now)
+                    if self.waiting[0] != ticket:
+                        self.condition.wait()  # Woken up when the caller ahead of us is done
+                    elif len(self.used_tokens) < self.api.req_per_period:
+                        self.used_tokens.append(now)
+                        return
+                    else:
+                        self.condition.wait((self.used_tokens[0] + self.api.req_period - now) / 1000)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def reserve(self, priority=PRIORITY_MARKET_DATA):
+        """
+        Non blocking variant of acquire for callers that cannot block their thread, like coroutines on an event loop.
+        Takes a token when nobody of the same or a higher priority is waiting and one is free.
+
+        :return: 0 when the token was taken, otherwise the number of seconds to wait before trying again
+        """
+        with self.condition:
+            now = time.time() * 1000  # milliseconds
+            self._return_tokens(now)
+            if self.waiting and self.waiting[0][0] <= priority:
+                return self.api.req_period / 1000.0 / self.api.req_per_period
+            if len(self.used_tokens) < self.api.req_per_period:
+                self.used_tokens.append(now)
+                return 0
+            return (self.used_tokens[0] + self.api.req_period - now) / 1000
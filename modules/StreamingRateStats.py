@@ -0,0 +1,258 @@
+# coding=utf-8
+import bisect
+import math
+import random
+
+
+class WeightedNode(object):
+    __slots__ = ['key', 'weight', 'total', 'priority', 'left', 'right']
+
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+        self.total = weight  # Weight of the node and its subtrees
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+
+    def update(self):
+        self.total = self.weight + (self.left.total if self.left else 0) + (self.right.total if self.right else 0)
+
+
+def split(node, key, inclusive):
+    """
+    Splits a treap in the nodes with keys below key (up to key if inclusive) and the others.
+    """
+    if node is None:
+        return None, None
+    if node.key < key or (inclusive and node.key == key):
+        node.right, right = split(node.right, key, inclusive)
+        node.update()
+        return node, right
+    left, node.left = split(node.left, key, inclusive)
+    node.update()
+    return left, node
+
+
+def merge(left, right):
+    """
+    Merges two treaps, all keys of left below the keys of right.
+    """
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        left.update()
+        return left
+    right.left = merge(left, right.left)
+    right.update()
+    return right
+
+
+class WeightedValues(object):
+    """
+    A multiset of values with integer weights, kept in a treap where each node knows the weight of its subtree, so
+    adding or removing weight and reading a percentile are all O(log n), n being the number of distinct values.
+    """
+    def __init__(self):
+        self.root = None
+        self.weights = {}
+        self.total = 0
+
+    def add_to_path(self, value, weight):
+        node = self.root
+        while node.key != value:
+            node.total += weight
+            node = node.left if value < node.key else node.right
+        node.total += weight
+        node.weight += weight
+
+    def add(self, value, weight):
+        if value in self.weights:
+            self.weights[value] += weight
+            self.add_to_path(value, weight)
+        else:
+            self.weights[value] = weight
+            left, right = split(self.root, value, False)
+            self.root = merge(merge(left, WeightedNode(value, weight)), right)
+        self.total += weight
+
+    def remove(self, value, weight):
+        self.weights[value] -= weight
+        self.total -= weight
+        if self.weights[value] <= 0:
+            del self.weights[value]
+            left, rest = split(self.root, value, False)
+            _, right = split(rest, value, True)
+            self.root = merge(left, right)
+        else:
+            self.add_to_path(value, -weight)
+
+    def select(self, rank):
+        """
+        Returns the value at position rank of the list where every value is repeated weight times, in order.
+        """
+        node = self.root
+        while True:
+            left_total = node.left.total if node.left else 0
+            if rank < left_total:
+                node = node.left
+            elif rank < left_total + node.weight:
+                return node.key
+            else:
+                rank -= left_total + node.weight
+                node = node.right
+
+    def percentile(self, percent, extra=None):
+        """
+        Returns the percentile of the values as numpy.percentile (linear interpolation) would return it for the list
+        where every value is repeated weight times.
+
+        :param percent: The percentile wanted, 0 to 100
+        :param extra: An optional (value, weight) taken into account as if it had been added
+        """
+        if extra is not None:
+            self.add(*extra)
+        try:
+            if self.total == 0:
+                return None
+            k = (self.total - 1) * percent / 100.0
+            lower_index = math.floor(k)
+            upper_index = math.ceil(k)
+            lower = self.select(lower_index)
+            upper = self.select(upper_index)
+            return lower + (upper - lower) * (k - lower_index)
+        finally:
+            if extra is not None:
+                self.remove(*extra)
+
+
+class StreamingRateStats(object):
+    """
+    Keeps the statistics of a currency's best rate over a sliding time window up to date sample by sample, giving the
+    same results as the pandas path of MarketAnalysis (1 second resample with forward fill) without building the
+    series. A sample of the resampled series is held until the next one, so it weighs as many seconds as it was held.
+    Adding a sample drops the ones that left the window, so the memory used stays bounded by the window even when the
+    statistics are never read.
+    """
+    def __init__(self, window_seconds):
+        """
+        :param window_seconds: Samples older than this many seconds before the newest one or the time of a query are
+                               dropped
+        """
+        self.window_seconds = window_seconds
+        # Raw samples, as used while there is too little data to resample
+        self.raw_times = []
+        self.raw_rates = []
+        self.raw_head = 0
+        self.raw_values = WeightedValues()
+        # One second buckets, all but the last one are finished and weigh the seconds until the next one
+        self.bucket_secs = []
+        self.bucket_values = []
+        self.bucket_sums = [0.0]  # Running sum of value * weight of the finished buckets
+        self.bucket_head = 0
+        self.last_sum = 0.0
+        self.last_count = 0
+        self.resampled_values = WeightedValues()
+
+    def add(self, unixtime, rate):
+        """
+        Adds a sample in time order.
+
+        :param unixtime: The time of the sample in seconds since epoch
+        :param rate: The best rate of the sample
+        """
+        sec = int(unixtime)
+        self.raw_times.append(sec)
+        self.raw_rates.append(rate)
+        self.raw_values.add(rate, 1)
+        if self.bucket_secs and sec <= self.bucket_secs[-1]:
+            self.last_sum += rate
+            self.last_count += 1
+            self.bucket_values[-1] = self.last_sum / self.last_count
+            return
+        if self.bucket_secs:
+            weight = sec - self.bucket_secs[-1]
+            value = self.bucket_values[-1]
+            self.resampled_values.add(value, weight)
+            self.bucket_sums.append(self.bucket_sums[-1] + value * weight)
+        self.bucket_secs.append(sec)
+        self.bucket_values.append(rate)
+        self.last_sum = rate
+        self.last_count = 1
+        self.expire(sec)
+
+    def expire(self, now):
+        """
+        Drops the samples that left the window, to be called before reading the statistics. Called by add with the
+        time of the new sample.
+
+        :param now: The current time in seconds since epoch
+        """
+        from_date = now - self.window_seconds
+        while self.raw_head < len(self.raw_times) and self.raw_times[self.raw_head] <= from_date:
+            self.raw_values.remove(self.raw_rates[self.raw_head], 1)
+            self.raw_head += 1
+        last = len(self.bucket_secs) - 1
+        while self.bucket_head < last and self.bucket_secs[self.bucket_head] <= from_date:
+            weight = self.bucket_secs[self.bucket_head + 1] - self.bucket_secs[self.bucket_head]
+            self.resampled_values.remove(self.bucket_values[self.bucket_head], weight)
+            self.bucket_head += 1
+        if self.bucket_head == last and self.bucket_secs[last] <= from_date:
+            self.bucket_head += 1
+        self._compact()
+
+    def _compact(self):
+        if self.raw_head > 1024 and self.raw_head * 2 > len(self.raw_times):
+            del self.raw_times[:self.raw_head]
+            del self.raw_rates[:self.raw_head]
+            self.raw_head = 0
+        if self.bucket_head > 1024 and self.bucket_head * 2 > len(self.bucket_secs):
+            del self.bucket_secs[:self.bucket_head]
+            del self.bucket_values[:self.bucket_head]
+            del self.bucket_sums[:self.bucket_head]
+            self.bucket_head = 0
+        if self.bucket_head == len(self.bucket_secs) and self.bucket_secs:
+            self.bucket_secs, self.bucket_values, self.bucket_sums, self.bucket_head = [], [], [0.0], 0
+
+    def get_sample_count(self):
+        """
+        :return: The number of raw samples in the window
+        """
+        return len(self.raw_times) - self.raw_head
+
+    def get_resampled_length(self):
+        """
+        :return: The number of seconds from the first to the last sample in the window, the length of the resampled
+                 series
+        """
+        if self.bucket_head == len(self.bucket_secs):
+            return 0
+        return self.bucket_secs[-1] - self.bucket_secs[self.bucket_head] + 1
+
+    def get_last_rate(self):
+        return self.bucket_values[-1]
+
+    def get_percentile(self, percent, resampled):
+        """
+        :param percent: The percentile wanted, 0 to 100
+        :param resampled: Whether to use the resampled series or the raw samples
+        """
+        if resampled:
+            return self.resampled_values.percentile(percent, extra=(self.bucket_values[-1], 1))
+        return self.raw_values.percentile(percent)
+
+    def get_tail_mean(self, seconds):
+        """
+        Returns the mean of the last seconds of the resampled series, like rates_df.rate0.tail(seconds).mean()
+
+        :param seconds: The length of the tail
+        """
+        last = len(self.bucket_secs) - 1
+        start = max(self.bucket_secs[last] - seconds + 1, self.bucket_secs[self.bucket_head])
+        first = bisect.bisect_right(self.bucket_secs, start, self.bucket_head, last + 1) - 1
+        total = self.bucket_values[last]  # The last bucket is the last second of the series
+        if first < last:
+            total += self.bucket_values[first] * (self.bucket_secs[first + 1] - start)
+            total += self.bucket_sums[last] - self.bucket_sums[first + 1]
+        return total / (self.bucket_secs[last] - start + 1)
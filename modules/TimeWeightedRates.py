@@ -0,0 +1,69 @@
+# coding=utf-8
+import numpy
+
+
+class TimeWeightedRates(object):
+    """
+    The statistics of a window of best rates computed straight from the irregular samples, giving the same results as
+    the pandas path of MarketAnalysis (1 second resample with forward fill) without building the resampled series.
+    Samples in the same second are averaged and each second's value weighs as many seconds as it is held, the last one
+    weighs one second. Offers the same methods as StreamingRateStats, for a window read at once.
+    """
+    def __init__(self, times, rates):
+        """
+        :param times: The times of the samples in seconds since epoch, in time order
+        :param rates: The best rate of each sample
+        """
+        self.rates = numpy.asarray(rates, dtype=numpy.float64)
+        secs = numpy.asarray(times).astype(numpy.int64)
+        self.secs, first, counts = numpy.unique(secs, return_index=True, return_counts=True)
+        self.values = numpy.add.reduceat(self.rates, first) / counts if len(secs) else self.rates
+        self.weights = numpy.append(numpy.diff(self.secs), 1) if len(secs) else secs
+        self.sorted_order = None
+
+    def get_sample_count(self):
+        """
+        :return: The number of raw samples in the window
+        """
+        return len(self.rates)
+
+    def get_resampled_length(self):
+        """
+        :return: The number of seconds from the first to the last sample in the window, the length of the resampled
+                 series
+        """
+        if len(self.secs) == 0:
+            return 0
+        return int(self.secs[-1] - self.secs[0] + 1)
+
+    def get_last_rate(self):
+        return float(self.values[-1])
+
+    def get_percentile(self, percent, resampled):
+        """
+        :param percent: The percentile wanted, 0 to 100
+        :param resampled: Whether to use the resampled series or the raw samples
+        """
+        if not resampled:
+            return float(numpy.percentile(self.rates, percent))
+        if self.sorted_order is None:
+            self.sorted_order = numpy.argsort(self.values, kind='stable')
+            self.cumulative_weights = numpy.cumsum(self.weights[self.sorted_order])
+        # As numpy.percentile with linear interpolation on the list where every value is repeated weight times
+        k = (self.cumulative_weights[-1] - 1) * percent / 100.0
+        lower_index = numpy.floor(k)
+        upper_index = numpy.ceil(k)
+        lower = self.values[self.sorted_order[numpy.searchsorted(self.cumulative_weights, lower_index, side='right')]]
+        upper = self.values[self.sorted_order[numpy.searchsorted(self.cumulative_weights, upper_index, side='right')]]
+        return float(lower + (upper - lower) * (k - lower_index))
+
+    def get_tail_mean(self, seconds):
+        """
+        Returns the mean of the last seconds of the resampled series, like rates_df.rate0.tail(seconds).mean()
+
+        :param seconds: The length of the tail
+        """
+        start = max(self.secs[-1] - seconds + 1, self.secs[0])
+        ends = numpy.append(self.secs[1:], self.secs[-1] + 1)
+        held = numpy.clip(ends - numpy.maximum(self.secs, start), 0, None)
+        return float(numpy.dot(self.values, held) / (self.secs[-1] - start + 1))
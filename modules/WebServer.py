@@ -1,11 +1,30 @@
 # coding=utf-8
+import email.utils
+import gzip
+import hashlib
+import json
+import mimetypes
 import threading
 import os
+try:
+    import brotli
+    BROTLI_LOADED = True
+except ImportError:
+    BROTLI_LOADED = False
 
 server = None
+json_output = None  # The JsonOutput of the bot's log, its status and log lines are served from memory
 web_server_ip = "0.0.0.0"
 web_server_port = "8000"
 web_server_template = "www"
+EVENTS_KEEPALIVE_SECONDS = 15  # An idle event stream gets a comment line this often, so proxies do not close it
+STATIC_MAX_AGE = 604800  # Seconds browsers keep scripts and images without asking again, bump their ?version= on change
+MAX_CACHED_FILE_SIZE = 4 * 1024 * 1024  # Bigger files are read from disk on every request, without compression
+REVALIDATED_EXTENSIONS = ('.html', '.json')  # Pages and the files the bot rewrites, checked on every load
+COMPRESSED_TYPES = ('text/', 'application/json', 'application/javascript', 'application/manifest+json',
+                    'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+static_files = {}  # Path to (mtime, size, ETag, {encoding: body}) of the files served so far
+static_files_lock = threading.Lock()
 
 
 def initialize_web_server(config):
@@ -40,10 +59,83 @@ def initialize_web_server(config):
     thread.start()
 
 
+def set_json_output(output):
+    '''
+    Serve the status and log of output, a JsonOutput, under /api/status and /api/log and push them under /api/events
+    '''
+    global json_output
+    json_output = output
+
+
+def get_static_file(path):
+    '''
+    Returns a file of the template folder from memory, with its compressed variants made when it is first served or
+    after it changed. Only text types and icons are compressed, the images are compressed already.
+
+    :param path: The path of the file
+    :return: (last modified unixtime, ETag, {encoding: body}), the identity body under None. None if the file is too
+             big to keep in memory.
+    '''
+    stat = os.stat(path)
+    if stat.st_size > MAX_CACHED_FILE_SIZE:
+        return None
+    with static_files_lock:
+        cached = static_files.get(path)
+    if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+        with open(path, 'rb') as f:
+            body = f.read()
+        variants = {None: body}
+        if (mimetypes.guess_type(path)[0] or '').startswith(COMPRESSED_TYPES):
+            variants['gzip'] = gzip.compress(body, 9)
+            if BROTLI_LOADED:
+                variants['br'] = brotli.compress(body)
+            variants = dict((encoding, data) for encoding, data in variants.items()
+                            if encoding is None or len(data) < len(body))
+        cached = (stat.st_mtime_ns, stat.st_size, hashlib.sha1(body).hexdigest(), variants)
+        with static_files_lock:
+            static_files[path] = cached
+    return int(stat.st_mtime), cached[2], cached[3]
+
+
+def load_static_files(directory):
+    '''
+    Compresses the files of the template folder ahead of the first page load
+    '''
+    for root, _, names in os.walk(directory):
+        for name in names:
+            try:
+                get_static_file(os.path.join(root, name))
+            except (IOError, OSError):
+                pass  # Served from disk if it can be read later
+
+
+def choose_encoding(accept_encoding, variants):
+    '''
+    :param accept_encoding: The Accept-Encoding header of the request
+    :param variants: The encodings available
+    :return: The smallest of the variants the client accepts, None for the identity
+    '''
+    accepted = []
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']:
+            accepted.append(coding.strip().lower())
+    candidates = [encoding for encoding in variants if encoding is None or encoding in accepted or '*' in accepted]
+    return min(candidates, key=lambda encoding: len(variants[encoding]))
+
+
+def get_cache_control(path):
+    if path.endswith(REVALIDATED_EXTENSIONS):
+        return 'no-cache'
+    return 'public, max-age={0}'.format(STATIC_MAX_AGE)
+
+
 def start_web_server():
     '''
     Start the web server
     '''
+    import io
+    import queue
     import http.server as SimpleHTTPServer
     import socketserver as SocketServer
     import socket
@@ -64,16 +156,163 @@ def start_web_server():
             def translate_path(self, path):
                 return SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, '/' + web_server_template + path)
 
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == '/api/status':
+                    return self.send_status()
+                if path == '/api/log':
+                    return self.send_log(query)
+                if path == '/api/events':
+                    return self.send_events()
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+            def send_status(self):
+                published = json_output.publishedStatus if json_output is not None else None
+                if published is None:
+                    self.send_error(503, "No status published yet")
+                    return
+                etag, body, gzipped = published
+                if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_json(body, gzipped, etag)
+
+            def send_log(self, query):
+                if json_output is None:
+                    self.send_error(503, "No log available")
+                    return
+                params = dict(param.partition('=')[::2] for param in query.split('&'))
+                try:
+                    since = int(params.get('since', -1))
+                except ValueError:
+                    self.send_error(400, "since must be a line number")
+                    return
+                body = json.dumps(json_output.getLogSince(since), ensure_ascii=True).encode('utf-8')
+                self.send_json(body)
+
+            def send_events(self):
+                '''
+                Streams the log lines and statuses as server-sent events until the client goes away, a log event's id
+                is its line number. The stream starts with the current status.
+                '''
+                if json_output is None:
+                    self.send_error(503, "No events available")
+                    return
+                events = json_output.subscribe()
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Cache-Control', 'no-cache')
+                    self.send_header('X-Accel-Buffering', 'no')
+                    self.end_headers()
+                    self.wfile.write(b'retry: 5000\n\n')
+                    published = json_output.publishedStatus
+                    if published is not None:
+                        self.send_event('status', published[1].decode('utf-8'))
+                    while not events.dropped:
+                        try:
+                            event, data, event_id = events.get(timeout=EVENTS_KEEPALIVE_SECONDS)
+                        except queue.Empty:
+                            self.wfile.write(b': keep-alive\n\n')
+                            self.wfile.flush()
+                            continue
+                        self.send_event(event, data, event_id)
+                except (socket.error, ValueError):
+                    pass  # The client went away
+                finally:
+                    json_output.unsubscribe(events)
+
+            def send_event(self, event, data, event_id=None):
+                message = 'event: {0}\n'.format(event)
+                if event_id is not None:
+                    message += 'id: {0}\n'.format(event_id)
+                message += 'data: {0}\n\n'.format(data)
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+
+            def send_json(self, body, gzipped=None, etag=None):
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzipped if gzipped is not None else gzip.compress(body)
+                    encoding = 'gzip'
+                else:
+                    encoding = None
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Vary', 'Accept-Encoding')
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                if etag:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
             def send_head(self):
                 local_path = self.translate_path(self.path)
                 if os.path.commonprefix((os.path.abspath(local_path), self.real_server_path)) != self.real_server_path:
                     self.send_error(404, "These aren't the droids you're looking for")
                     return None
+                try:
+                    static_file = get_static_file(local_path) if os.path.isfile(local_path) else None
+                except (IOError, OSError):
+                    static_file = None  # Let the default handler answer the error
+                if static_file is not None:
+                    return self.send_static_file(local_path, *static_file)
                 return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
 
+            def send_static_file(self, path, last_modified, digest, variants):
+                '''
+                Sends the headers of a file kept in memory, or 304 Not Modified if the client has it already. Every
+                encoding has its own strong ETag, the SHA-1 of the file with the encoding appended.
+
+                :return: The body to send
+                '''
+                encoding = choose_encoding(self.headers.get('Accept-Encoding', ''), variants)
+                etag = '"{0}{1}"'.format(digest, '-' + encoding if encoding else '')
+                headers = [('ETag', etag), ('Cache-Control', get_cache_control(path)),
+                           ('Last-Modified', self.date_time_string(last_modified))]
+                if len(variants) > 1:
+                    headers.append(('Vary', 'Accept-Encoding'))
+                if self.is_not_modified(digest, last_modified):
+                    self.send_response(304)
+                    for header in headers:
+                        self.send_header(*header)
+                    self.end_headers()
+                    return None
+                body = variants[encoding]
+                self.send_response(200)
+                self.send_header('Content-Type', self.guess_type(path))
+                self.send_header('Content-Length', str(len(body)))
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                return io.BytesIO(body)
+
+            def is_not_modified(self, digest, last_modified):
+                if 'If-None-Match' in self.headers:
+                    # Any encoding of the same file will do, the client decodes it
+                    tags = [tag.strip() for tag in self.headers['If-None-Match'].split(',')]
+                    return '*' in tags or any(tag.replace('W/', '', 1).strip('"').split('-')[0] == digest
+                                              for tag in tags)
+                if 'If-Modified-Since' in self.headers:
+                    try:
+                        since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+                    except (TypeError, ValueError, IndexError, OverflowError):
+                        return False
+                    return since is not None and since.timestamp() >= last_modified
+                return False
+
+        load_static_files(web_server_template)
         global server
-        SocketServer.TCPServer.allow_reuse_address = True
-        server = SocketServer.TCPServer((host, port), QuietHandler)
+        # A thread per request, so a slow viewer does not hold up the others
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        SocketServer.ThreadingTCPServer.daemon_threads = True
+        server = SocketServer.ThreadingTCPServer((host, port), QuietHandler)
         if host == "0.0.0.0":
             # Get all addresses that we could listen on the port specified
             addresses = [i[4][0] for i in socket.getaddrinfo(socket.gethostname().split('.')[0], port)]
@@ -0,0 +1,74 @@
+"""
+Compares the per level gap walk with the cumulative array lookup on synthetic 5,000 level order books.
+
+Run from the root of the source code with: python tests/benchmark_gap_rate.py
+"""
+import random
+import timeit
+from decimal import Decimal
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import modules.Lending as Lending
+
+LEVELS = 5000
+RUNS = 20
+MIN_DAILY_RATE = Decimal('0.0005')
+
+
+def synthetic_book(levels):
+    rates = sorted(random.uniform(0.0001, 0.005) for _ in range(levels))
+    return {'rates': ['{0:0.8f}'.format(rate) for rate in rates],
+            'volumes': ['{0:0.8f}'.format(random.uniform(0.01, 50)) for _ in range(levels)]}
+
+
+def loop_gap_rate(order_book, gap_expected):
+    """ The per level walk, including the per level log line it used to format """
+    gap_sum = 0
+    i = 0
+    while gap_sum < gap_expected:
+        if i == len(order_book['volumes']) - 1:
+            return None
+        gap_sum += float(order_book['volumes'][i])
+        if Decimal(order_book['rates'][i]) > MIN_DAILY_RATE:
+            gap_sum += float(order_book['volumes'][i])
+        "Checking ({0}) rate {1}% for gap_sum {2} {3}".format(i, Decimal(order_book['rates'][i]) * 100, gap_sum, 'BTC')
+        i += 1
+    return Decimal(order_book['rates'][i - 1])
+
+
+def array_gap_rate(order_book, gap_expected):
+    gap_sums = Lending.get_gap_sums(order_book, MIN_DAILY_RATE)
+    return Decimal(order_book['rates'][Lending.find_gap_level(gap_sums, gap_expected)])
+
+
+def main():
+    book = synthetic_book(LEVELS)
+    # Bottom and top gap near the end of the book, the worst case for the walk
+    total = float(Lending.get_gap_sums(dict(book), MIN_DAILY_RATE)[-2])
+    gaps = [total * 0.8, total * 0.99]
+
+    def run_loop():
+        for gap in gaps:
+            loop_gap_rate(book, gap)
+
+    def run_arrays():
+        book.pop('gap_sums', None)  # Arrays are built once per book, as in a lending cycle
+        for gap in gaps:
+            array_gap_rate(book, gap)
+
+    for numpy_enabled in [True, False]:
+        Lending.use_numpy = numpy_enabled
+        loop = min(timeit.repeat(run_loop, number=1, repeat=RUNS))
+        arrays = min(timeit.repeat(run_arrays, number=1, repeat=RUNS))
+        print("{0} levels, numpy={1}: loop {2:.2f} ms, arrays {3:.2f} ms ({4:.1f}x)"
+              .format(LEVELS, numpy_enabled, loop * 1000, arrays * 1000, loop / arrays))
+
+
+if __name__ == '__main__':
+    main()
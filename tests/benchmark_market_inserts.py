@@ -0,0 +1,72 @@
+"""
+Compares writing market samples one INSERT and transaction per sample with the batched prepared inserts of
+MarketAnalysis, on a WAL database on disk like the ones in market_data.
+
+Run from the root of the source code with: python tests/benchmark_market_inserts.py
+"""
+import random
+import shutil
+import tempfile
+import time
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from modules.MarketAnalysis import MarketAnalysis
+
+ROWS = 2000
+LEVELS = 10
+
+
+def samples(count):
+    rows = []
+    for i in range(count):
+        row = [int(time.time()) + i]
+        for _ in range(LEVELS):
+            row.extend([random.uniform(0.0001, 0.005), random.uniform(0.01, 50)])
+        row.append(0)
+        rows.append(row)
+    return rows
+
+
+def insert_per_row(db_con, rows):
+    """ The previous insert_into_db, a statement built from strings and a transaction per sample """
+    for row in rows:
+        insert_sql = "INSERT INTO loans ("
+        for level in range(LEVELS):
+            insert_sql += "rate{0}, amnt{0}, ".format(level)
+        insert_sql += "percentile) VALUES ({0});".format(','.join(str(value) for value in row[1:]))
+        with db_con:
+            db_con.execute(insert_sql)
+
+
+def main():
+    ma = object.__new__(MarketAnalysis)
+    ma.recorded_levels = LEVELS
+    ma.partition_by_day = False
+    rows = samples(ROWS)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        runs = [('one transaction per row', lambda db_con: insert_per_row(db_con, rows))]
+        for batch in [12, 100]:
+            runs.append(('batches of {0}'.format(batch),
+                         lambda db_con, batch=batch: [ma.insert_rows_into_db(db_con, rows[i:i + batch])
+                                                      for i in range(0, ROWS, batch)]))
+        for name, run in runs:
+            db_con = ma.create_connection(None, os.path.join(tmp_dir, name.replace(' ', '_') + '.db'))
+            ma.create_rate_table(db_con, LEVELS)
+            start = time.time()
+            run(db_con)
+            elapsed = time.time() - start
+            db_con.close()
+            print("{0}: {1:.0f} rows/sec".format(name, ROWS / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares the size on disk and the time to load a long window of rate0 from the SQLite DB and from the column files
+of storage = columns, for 14 days of 5 second samples of 3 levels.
+
+Run from the root of the source code with: python tests/benchmark_market_storage.py
+"""
+import random
+import shutil
+import tempfile
+import time
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from modules.ColumnStore import ColumnStore
+from modules.MarketAnalysis import MarketAnalysis, MAX_RUN_SECONDS
+
+DAYS = 14
+LEVELS = 3
+
+
+def samples(now):
+    rows = []
+    for unixtime in range(now - DAYS * 86400, now, 5):
+        row = [unixtime]
+        for _ in range(LEVELS):
+            row.extend([round(random.uniform(0.0001, 0.005), 8), round(random.uniform(0.01, 50), 8)])
+        row.append(0)
+        rows.append(row)
+    return rows
+
+
+def get_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def main():
+    ma = object.__new__(MarketAnalysis)
+    ma.recorded_levels = LEVELS
+    ma.partition_by_day = False
+    now = int(time.time())
+    rows = samples(now)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmp_dir, 'BTC.db')
+        db_con = ma.create_connection(None, db_path)
+        ma.create_rate_table(db_con, LEVELS)
+        ma.insert_rows_into_db(db_con, rows)
+        store = ColumnStore(os.path.join(tmp_dir, 'BTC'), LEVELS, MAX_RUN_SECONDS)
+        store.append(rows)
+        print("{0} samples, sqlite: {1:.1f} MB, columns: {2:.1f} MB".format(
+            len(rows), get_size(db_path) / 1e6, get_size(store.directory) / 1e6))
+
+        for days in [1, 7, 14]:
+            from_date = now - days * 86400
+            start = time.time()
+            db_rates = ma.get_rates_from_db(db_con, from_date=from_date)
+            db_elapsed = time.time() - start
+            start = time.time()
+            times, values = store.get_window(from_date, columns=[0])
+            ColumnStore.to_float64(values[:, 0])
+            columns_elapsed = time.time() - start
+            assert len(db_rates) == len(times)
+            print("{0:2d} days: sqlite {1:7.1f} ms, columns {2:6.1f} ms".format(days, db_elapsed * 1000,
+                                                                             columns_elapsed * 1000))
+        db_con.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
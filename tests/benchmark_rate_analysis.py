@@ -0,0 +1,58 @@
+"""
+Compares the pandas engine, which resamples the rate list to 1 second, with the weighted engine, which weighs the
+samples by how long they were held, on 14 days of 5 second samples: time and peak memory of the percentile and MACD
+suggestions.
+
+Run from the root of the source code with: python tests/benchmark_rate_analysis.py
+"""
+import random
+import time
+import tracemalloc
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import modules.Configuration as Config
+import modules.Data as Data
+from modules.MarketAnalysis import MarketAnalysis
+from modules.Poloniex import Poloniex
+from modules.RateHistory import RateHistory
+
+DAYS = 14
+
+
+def main():
+    Config.init('default.cfg', Data)
+    ma = MarketAnalysis(Config, Poloniex(Config, None))
+    ma.currencies_to_analyse = ['BTC']
+    ma.percentile_seconds = DAYS * 86400
+    ma.MACD_long_win_seconds = 1800
+    ma.MACD_short_win_seconds = 150
+    now = int(time.time())
+    first = now - int(ma.percentile_seconds * 1.1)
+    history = RateHistory(1, (now - first) // 5 + 1)
+    rate = 0.0002
+    for unixtime in range(first, now, 5):
+        rate = min(max(rate + random.choice([-1, 0, 0, 0, 1]) * 0.000001, 0.0001), 0.0005)
+        history.append(unixtime, [rate, 1])
+    ma.rate_histories = {'BTC': history}
+    print("{0} samples over {1} days".format(len(history), DAYS))
+
+    for engine in ['pandas', 'weighted']:
+        ma.engine = engine
+        tracemalloc.start()
+        start = time.time()
+        suggestions = [ma.get_rate_suggestion('BTC', method=method) for method in ['percentile', 'MACD']]
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("{0:8s}: {1:7.1f} ms, peak {2:6.1f} MB, percentile {3}, MACD {4}".format(
+            engine, elapsed * 1000, peak / 1e6, *suggestions))
+
+
+if __name__ == '__main__':
+    main()
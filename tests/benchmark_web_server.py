@@ -0,0 +1,93 @@
+"""
+Loads the dashboard and its local files like a browser with a cache would, a first visit then repeated visits, from
+the plain http.server the bot used to run and from the bot's web server: requests made and bytes received.
+
+Run from the root of the source code with: python tests/benchmark_web_server.py
+"""
+import functools
+import http.client
+import http.server
+import threading
+import time
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import modules.WebServer as WebServer
+
+PAGE = ['/lendingbot.html', '/lendingbot.js?version=3', '/manifest.json', '/images/icon.ico', '/images/icon32.png',
+        '/images/icon48.png', '/images/icon192.png', '/images/icon384.png', '/images/ios_splash.png']
+VISITS = 20
+SECONDS_BETWEEN_VISITS = 600
+
+
+class CachingClient(object):
+    """ Keeps the responses like a browser: fresh ones are not asked for again, stale ones are revalidated """
+    def __init__(self, port):
+        self.port = port
+        self.cache = {}  # url to (expiry, ETag, Last-Modified)
+        self.now = time.time()
+        self.requests = 0
+        self.bytes = 0
+
+    def get(self, url):
+        expiry, etag, last_modified = self.cache.get(url, (0, None, None))
+        if expiry > self.now:
+            return
+        headers = {'Accept-Encoding': 'gzip, deflate, br'}
+        if etag:
+            headers['If-None-Match'] = etag
+        elif last_modified:
+            headers['If-Modified-Since'] = last_modified
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        connection.request('GET', url, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        self.requests += 1
+        self.bytes += len(body) + sum(len(name) + len(value) + 4 for name, value in response.getheaders())
+        max_age = 0
+        for directive in (response.getheader('Cache-Control') or '').split(','):
+            if directive.strip().startswith('max-age='):
+                max_age = int(directive.strip()[len('max-age='):])
+        self.cache[url] = (self.now + max_age, response.getheader('ETag') or etag,
+                           response.getheader('Last-Modified') or last_modified)
+
+
+class PlainHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        return
+
+
+def visit(port):
+    client = CachingClient(port)
+    for _ in range(VISITS):
+        for url in PAGE:
+            client.get(url)
+        client.now += SECONDS_BETWEEN_VISITS
+    return client
+
+
+def main():
+    plain = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(PlainHandler, directory='www'))
+    threading.Thread(target=plain.serve_forever, daemon=True).start()
+
+    WebServer.web_server_ip = '127.0.0.1'
+    WebServer.web_server_port = '8765'
+    threading.Thread(target=WebServer.start_web_server, daemon=True).start()
+    time.sleep(1)
+
+    print("{0} visits of {1} files, {2} seconds apart".format(VISITS, len(PAGE), SECONDS_BETWEEN_VISITS))
+    for name, port in [('http.server', plain.server_address[1]), ('WebServer', int(WebServer.web_server_port))]:
+        client = visit(port)
+        print("{0:11s}: {1:4d} requests, {2:7.1f} kB".format(name, client.requests, client.bytes / 1e3))
+    plain.shutdown()
+    WebServer.stop_web_server()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import numpy
+
+from modules.ColumnStore import ColumnStore
+
+DAY = 86400 * 19000  # Midnight UTC
+
+
+def test_get_window_across_days(tmp_path):
+    store = ColumnStore(str(tmp_path), levels=2, max_run_seconds=3600)
+    store.append([[DAY - 10 + t, 0.0002 + t / 1e6, t, None, None, 0] for t in range(20)])
+    assert store.get_days() == [ColumnStore.get_day(DAY - 1), ColumnStore.get_day(DAY)]
+    times, values = store.get_window(from_date=DAY - 3, columns=[0, 2])
+    assert list(times) == list(range(DAY - 2, DAY + 10))
+    assert ColumnStore.to_float64(values[:, 0]).tolist() == [round(0.0002 + t / 1e6, 6) for t in range(8, 20)]
+    assert numpy.isnan(values[:, 1]).all()
+
+    store.delete_before(DAY + 5)
+    assert list(store.get_window()[0]) == list(range(DAY, DAY + 10))
+
+
+def test_runs_are_expanded(tmp_path):
+    store = ColumnStore(str(tmp_path), levels=1, max_run_seconds=3600)
+    store.append([[DAY, 0.01, 1, 0, 4, 15], [DAY + 20, 0.02, 2, 0], [DAY + 25, 0.03, 3, 0, 3, 5]])
+    times, values = store.get_window(from_date=DAY + 5)
+    assert list(times) == [DAY + 10, DAY + 15, DAY + 20, DAY + 25, DAY + 27, DAY + 30]
+    assert ColumnStore.to_float64(values[:, 0]).tolist() == [0.01, 0.01, 0.02, 0.03, 0.03, 0.03]
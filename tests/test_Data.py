@@ -0,0 +1,41 @@
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import modules.Data as Data
+
+
+def book(levels):
+    return {'offers': [{'rate': str(0.0001 * (i + 1)), 'amount': '1'} for i in range(levels)], 'demands': []}
+
+
+def test_store_keeps_deeper_book():
+    Data.clear_order_books()
+    Data.store_loan_orders('BTC', 400, book(400), 1000)
+    # The market recorder's few levels must not replace the book the gap modes walk
+    Data.store_loan_orders('BTC', 3, book(3), 1001)
+    assert len(Data.get_cached_loan_orders('BTC', 400)['offers']) == 400
+    Data.store_loan_orders('BTC', 0, book(500), 1002)
+    assert len(Data.get_cached_loan_orders('BTC', 0)['offers']) == 500
+    Data.clear_order_books()
+    Data.store_loan_orders('BTC', 3, book(3), 1003)
+    assert Data.get_cached_loan_orders('BTC', 3)['offers'] == book(3)['offers']
+    Data.clear_order_books()
+
+
+def test_funding_lookups_counted_apart(monkeypatch):
+    class Api(object):
+        def return_funding_tickers(self):
+            return {'BTC': {}}
+    monkeypatch.setattr(Data, 'api', Api())
+    Data.clear_order_books()
+    order_book_stats = Data.get_order_book_stats()
+    funding_stats = Data.get_funding_stats()
+    Data.get_funding_snapshot()
+    Data.get_funding_snapshot()
+    assert Data.get_order_book_stats() == order_book_stats
+    assert Data.get_funding_stats() == {'hits': funding_stats['hits'] + 1, 'misses': funding_stats['misses'] + 1}
+    Data.clear_order_books()
@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import json
+from hypothesis import given
+from hypothesis.strategies import integers, lists, tuples
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import modules.Configuration as Config
+import modules.Data as Data
+import modules.Lending as Lending
+from modules.Logger import Logger
+
+Config.init('default.cfg', Data)
+Lending.Config = Config
+
+MIN_DAILY_RATE = Decimal('0.0005')
+
+
+def random_book():
+    # Whole volumes keep the float sums exact so both walks see the same boundaries
+    return lists(tuples(integers(min_value=1, max_value=5000), integers(min_value=0, max_value=1000)),
+                 min_size=2, max_size=300).map(sorted)
+
+
+def make_order_book(levels):
+    return {'rates': ['{0:0.8f}'.format(rate / 1000000.0) for rate, _ in levels],
+            'volumes': [str(volume) for _, volume in levels]}
+
+
+def reference_gap_rate(order_book, gap_expected):
+    """ The per level walk get_gap_rate used before the cumulative arrays """
+    gap_sum = 0
+    i = 0
+    while gap_sum < gap_expected:
+        if i == len(order_book['volumes']) - 1:
+            return Lending.max_daily_rate
+        gap_sum += float(order_book['volumes'][i])
+        if Decimal(order_book['rates'][i]) > MIN_DAILY_RATE:
+            gap_sum += float(order_book['volumes'][i])
+        i += 1
+    return Decimal(order_book['rates'][i - 1])
+
+
+@given(random_book(), integers(min_value=1, max_value=100000))
+def test_get_gap_rate(levels, gap):
+    order_book = make_order_book(levels)
+    expected = reference_gap_rate(order_book, gap)
+    get_min_daily_rate, use_numpy = Lending.get_min_daily_rate, Lending.use_numpy
+    Lending.get_min_daily_rate = lambda cur: MIN_DAILY_RATE
+    Lending.loanOrdersRequestLimit['BTC'] = len(levels) + 1  # The whole book, never ask for more
+    try:
+        for numpy_enabled in [True, False]:
+            Lending.use_numpy = numpy_enabled
+            order_book.pop('gap_sums', None)
+            assert Lending.get_gap_rate('BTC', Decimal(gap), order_book, 0, True) == expected
+    finally:
+        Lending.get_min_daily_rate, Lending.use_numpy = get_min_daily_rate, use_numpy
+
+
+class FakeApi(object):
+    def __init__(self):
+        self.cancelled = []
+
+    def cancel_loan_offer(self, currency, order_number):
+        self.cancelled.append(order_number)
+        return {'success': 1, 'message': 'Loan offer canceled.'}
+
+
+def test_reconcile_offers(monkeypatch):
+    monkeypatch.setattr(Lending, 'api', FakeApi())
+    monkeypatch.setattr(Lending, 'log', Logger())
+    monkeypatch.setattr(Lending, 'dry_run', False)
+    monkeypatch.setattr(Lending, 'xday_threshold', 0)
+    monkeypatch.setattr(Lending, 'min_loan_size', Decimal('0.01'))
+    # create_lend_offer places just below the wanted rate, so these are the open offers of an unchanged book
+    monkeypatch.setattr(Lending, 'open_loan_offers', {'BTC': [
+        {'id': 1, 'rate': '0.00019900', 'amount': '0.50000000', 'duration': 2},
+        {'id': 2, 'rate': '0.00029900', 'amount': '0.50000000', 'duration': 2},
+        {'id': 3, 'rate': '0.00039900', 'amount': '0.40000000', 'duration': 2}]})
+    balances = {'BTC': Decimal('1.4')}
+    wanted = [(Decimal('0.5'), Decimal('0.0002')), (Decimal('0.5'), Decimal('0.0003')),
+              (Decimal('0.5'), Decimal('0.0004'))]
+    assert Lending.reconcile_offers('BTC', wanted, balances) == [(Decimal('0.5'), Decimal('0.0004'))]
+    assert Lending.api.cancelled == [3]
+    assert [offer['id'] for offer in Lending.open_loan_offers['BTC']] == [1, 2]
+
+
+def test_reconcile_keeps_stuck_offers(monkeypatch):
+    monkeypatch.setattr(Lending, 'api', FakeApi())
+    monkeypatch.setattr(Lending, 'log', Logger())
+    monkeypatch.setattr(Lending, 'dry_run', False)
+    monkeypatch.setattr(Lending, 'keep_stuck_orders', True)
+    monkeypatch.setattr(Lending, 'min_loan_size', Decimal('0.01'))
+    monkeypatch.setattr(Lending, 'open_loan_offers', {
+        'BTC': [{'id': 1, 'rate': '0.00019900', 'amount': '0.00500000', 'duration': 2}],
+        'ETH': [{'id': 2, 'rate': '0.00019900', 'amount': '1.00000000', 'duration': 2}]})
+    # A partly filled offer below the min loan size could not be placed again once cancelled
+    assert Lending.reconcile_offers('BTC', [], {'BTC': Decimal('0.005')}) == []
+    # A currency no longer lent has its stale offers cancelled
+    Lending.reconcile_offers('ETH', [], {'ETH': Decimal('1')})
+    assert Lending.api.cancelled == [2]
+    assert Lending.open_loan_offers == {'BTC': [{'id': 1, 'rate': '0.00019900', 'amount': '0.00500000',
+                                                 'duration': 2}], 'ETH': []}
+
+
+def test_request_limits_saved_from_workers(monkeypatch, tmp_path):
+    path = str(tmp_path / 'loan_orders_limits.json')
+    monkeypatch.setattr(Lending, 'loanOrdersRequestLimitFile', path)
+    monkeypatch.setattr(Lending, 'loanOrdersRequestLimit', {})
+    monkeypatch.setattr(Lending, 'log', Logger())
+    monkeypatch.setattr(Lending, 'construct_order_book', lambda cur: False)
+    currencies = ['C{0}'.format(i) for i in range(8)]
+    for cur in currencies:
+        Lending.loanOrdersRequestLimit[cur] = Lending.defaultLoanOrdersRequestLimit
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in range(10):
+            list(executor.map(lambda cur: Lending.extend_order_book(cur, {'rates': [], 'volumes': []}), currencies))
+    with open(path) as f:
+        assert json.load(f) == dict((cur, 11 * Lending.defaultLoanOrdersRequestLimit) for cur in currencies)
@@ -0,0 +1,94 @@
+import gzip
+import json
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import modules.Configuration as Config
+import modules.Data as Data
+from modules.Logger import JsonOutput
+
+Config.init('default.cfg', Data)
+
+
+def read_log(output, known_seq=-1):
+    """ Reads the log the way lendingbot.js does, the lines newer than known_seq """
+    with open(output.jsonOutputFile) as f:
+        status = json.load(f)
+    first_seq = max(known_seq + 1, status['log_first_seq'])
+    lines = []
+    for segment in range(first_seq // status['log_segment_size'], status['log_seq'] // status['log_segment_size'] + 1):
+        with open(os.path.join(os.path.dirname(output.jsonOutputFile), status['log_prefix'] + str(segment) + '.json')) as f:
+            data = json.load(f)
+        lines.extend(line for i, line in enumerate(data['lines']) if data['first_seq'] + i >= first_seq)
+    return status['log_seq'], lines
+
+
+def test_log_segments(tmp_path):
+    output = JsonOutput(str(tmp_path / 'botlog.json'), 120)
+    for i in range(70):
+        output.printline('line {0}'.format(i))
+    output.writeJsonFile()
+    seq, lines = read_log(output)
+    assert (seq, lines) == (69, ['line {0}'.format(i) for i in range(70)])
+
+    for i in range(70, 110):
+        output.printline('line {0}'.format(i))
+    output.writeJsonFile()
+    assert read_log(output, seq) == (109, ['line {0}'.format(i) for i in range(70, 110)])
+
+    for i in range(110, 200):
+        output.printline('line {0}'.format(i))
+    output.writeJsonFile()
+    assert read_log(output, 109) == (199, ['line {0}'.format(i) for i in range(110, 200)])
+    assert read_log(output)[1] == ['line {0}'.format(i) for i in range(80, 200)]
+    # Segments 0 (lines 0-49) only held lines older than the 120 kept
+    assert sorted(os.listdir(str(tmp_path))) == ['botlog-log-1.json', 'botlog-log-2.json', 'botlog-log-3.json',
+                                                 'botlog.json']
+
+
+def test_published_status(tmp_path):
+    output = JsonOutput(str(tmp_path / 'botlog.json'), 10)
+    for i in range(12):
+        output.printline('line {0}'.format(i))
+    output.writeJsonFile()
+    etag, body, gzipped = output.publishedStatus
+    with open(output.jsonOutputFile, 'rb') as f:
+        assert f.read() == body == gzip.decompress(gzipped)
+    assert output.getLogSince(8)['lines'] == ['line 9', 'line 10', 'line 11']
+    assert output.getLogSince(-1)['first_seq'] == 2
+
+    output.writeJsonFile()
+    assert output.publishedStatus[0] == etag
+    output.status('Lent 1 BTC', 'now', '')
+    output.writeJsonFile()
+    assert output.publishedStatus[0] != etag
+
+
+def test_events(tmp_path):
+    output = JsonOutput(str(tmp_path / 'botlog.json'), 10)
+    events = output.subscribe()
+    output.printline('line 0')
+    output.writeJsonFile()
+    output.writeJsonFile()  # Unchanged, not pushed again
+    event, data, event_id = events.get_nowait()
+    assert (event, event_id, json.loads(data)['line']) == ('log', 0, 'line 0')
+    assert events.get_nowait() == ('status', output.publishedStatus[1].decode('utf-8'), None)
+    assert events.empty()
+
+    for i in range(JsonOutput.EVENT_QUEUE_SIZE + 1):
+        output.printline('line {0}'.format(i))
+    assert events.dropped and output.subscribers == []
+
+
+def test_status_keeps_newest_lines(tmp_path):
+    output = JsonOutput(str(tmp_path / 'botlog.json'), 120)
+    for i in range(70):
+        output.printline('line {0}'.format(i))
+    output.writeJsonFile()
+    with open(output.jsonOutputFile) as f:
+        assert json.load(f)['log'] == ['line {0}'.format(i) for i in range(70 - JsonOutput.LOG_SEGMENT_SIZE, 70)]
@@ -1,5 +1,5 @@
 from hypothesis import given, settings
-from hypothesis.strategies import floats, lists, integers
+from hypothesis.strategies import floats, lists, integers, tuples, sampled_from
 # from hypothesis.extra.datetime import datetimes
 
 import csv
@@ -8,6 +8,7 @@ import time
 import pytest
 import sqlite3 as sqlite
 from random import randint
+import numpy
 import pandas as pd
 
 # Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
@@ -17,7 +18,10 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
-from modules.MarketAnalysis import MarketAnalysis
+from modules.ColumnStore import ColumnStore
+from modules.MarketAnalysis import MarketAnalysis, MAX_RUN_SECONDS, RATE_LIMIT_SECONDS
+from modules.RateHistory import RateHistory
+from modules.StreamingRateStats import StreamingRateStats, WeightedValues
 from modules.Configuration import get_all_currencies
 from modules.Poloniex import Poloniex
 import modules.Configuration as Config
@@ -117,3 +121,198 @@ def test_get_percentile(rates, lending_style):
     np_perc = MA.get_percentile(rates, lending_style, use_numpy=True)
     math_perc = MA.get_percentile(rates, lending_style, use_numpy=False)
     assert(np_perc == math_perc)
+
+
+@settings(deadline=None, max_examples=50)
+@given(lists(tuples(integers(min_value=0, max_value=12), sampled_from([0.0001, 0.00012, 0.0002, 0.00025, 0.0003])),
+             min_size=1, max_size=400),
+       integers(min_value=1, max_value=99))
+def test_engines_match_pandas(samples, lending_style):
+    ma = MarketAnalysis(Config, api)
+    ma.currencies_to_analyse = ['BTC']
+    ma.percentile_seconds = 600
+    ma.MACD_long_win_seconds = 300
+    ma.MACD_short_win_seconds = 60
+    ma.lending_style = lending_style
+    now = 1500000000
+    history = RateHistory(1, len(samples))
+    rate_stats = {'percentile': StreamingRateStats(660), 'MACD': StreamingRateStats(330)}
+    unixtime = now - sum(gap for gap, _ in samples)
+    for gap, rate in samples:  # A gap of 0 puts two samples in the same second
+        unixtime += gap
+        history.append(unixtime, [rate, 1])
+        for stats in rate_stats.values():
+            stats.add(unixtime, rate)
+
+    real_time = time.time
+    time.time = lambda: now + 0.5
+    try:
+        ma.rate_histories = {'BTC': history}
+        ma.engine = 'pandas'
+        expected = [ma.get_rate_suggestion('BTC', method=method) for method in ['percentile', 'MACD']]
+        ma.engine = 'weighted'
+        weighted = [ma.get_rate_suggestion('BTC', method=method) for method in ['percentile', 'MACD']]
+        ma.engine = 'streaming'
+        ma.rate_stats = {'BTC': rate_stats}
+        streaming = [ma.get_rate_suggestion('BTC', method=method) for method in ['percentile', 'MACD']]
+    finally:
+        time.time = real_time
+    assert weighted == pytest.approx(expected, abs=1.01e-6)  # All are truncated to 6 decimals
+    assert streaming == pytest.approx(expected, abs=1.01e-6)
+
+
+def test_unixtime_index():
+    db_con = new_db()
+    plan = db_con.execute("EXPLAIN QUERY PLAN SELECT rate0 FROM loans WHERE unixtime > 0;").fetchall()
+    assert 'loans_unixtime' in str(plan)
+
+
+def test_partition_by_day():
+    ma = MarketAnalysis(Config, api)
+    db_con = ma.create_connection(None, ':memory:')
+    ma.create_rate_table(db_con, 3)
+    now = int(time.time())
+    days = [now - 86400 * 2, now - 86400, now]
+    ma.insert_rows_into_db(db_con, [[unixtime, 0.01, 1, 0.02, 2, 0.03, 3, 0] for unixtime in days], 3)
+
+    ma.partition_by_day = True
+    ma.move_rows_to_day_tables(db_con, 3)  # Rows recorded before partitioning was turned on
+    ma.insert_rows_into_db(db_con, [[now + 1, 0.04, 4, 0.05, 5, 0.06, 6, 0]], 3)
+    assert ma.get_day_tables(db_con) == [ma.get_table_name(unixtime) for unixtime in days]
+    assert db_con.execute("SELECT COUNT(*) FROM loans;").fetchone()[0] == 0
+    assert [row[0] for row in ma.get_rates_from_db(db_con, from_date=now - 86400 - 1)] == [now - 86400, now, now + 1]
+
+    ma.delete_old_data(db_con, 86400 - 10)
+    assert ma.get_table_name(days[0]) not in ma.get_day_tables(db_con)
+    assert [row[0] for row in ma.get_rates_from_db(db_con)] == [now, now + 1]
+
+
+def test_record_changes_only():
+    ma = MarketAnalysis(Config, api)
+    ma.record_changes_only = True
+    ma.db_flush_rows = 1
+    ma.db_flush_seconds = 60
+    db_con = ma.create_connection(None, ':memory:')
+    ma.create_rate_table(db_con, 2)
+    now = int(time.time()) - 100
+    books = [[{'rate': '0.01', 'amount': '1'}, {'rate': '0.02', 'amount': '2'}]] * 4 + \
+            [[{'rate': '0.03', 'amount': '3'}]] * 3
+    real_time = time.time
+    try:
+        for i, book in enumerate(books):
+            time.time = lambda: now + i * 5
+            ma.record_market_data('BTC', db_con, book, 2)
+    finally:
+        time.time = real_time
+    ma.insert_rows_into_db(db_con, [ma.get_run_row(ma.open_runs.pop('BTC'))], 2)
+
+    assert db_con.execute("SELECT COUNT(*) FROM loans;").fetchone()[0] == 2
+    assert db_con.execute("SELECT rate1, amnt1 FROM loans WHERE rate0 = 0.03;").fetchone() == (None, None)
+    expected = [(now + i * 5, 0.01, 0.02) for i in range(4)] + [(now + i * 5, 0.03, None) for i in range(4, 7)]
+    assert ma.get_rates_from_db(db_con, price_levels=['rate0', 'rate1']) == expected
+    assert ma.get_rates_from_db(db_con, from_date=now + 10, price_levels=['rate0', 'rate1']) == expected[3:]
+
+
+def test_depth_methods():
+    ma = MarketAnalysis(Config, api)
+    ma.currencies_to_analyse = ['BTC']
+    ma.recorded_levels = 3
+    ma.dust_percent = 10
+    history = RateHistory(3, 10)
+    now = int(time.time())
+    history.append(now - 2, [0.01, 0.5, 0.02, 20, 0.03, 10])  # 0.5 out of 30.5 is dust
+    history.append(now - 1, [0.02, 10, 0.04, 10, float('nan'), float('nan')])
+    ma.rate_histories = {'BTC': history}
+    times, rates = ma.get_rate_samples('BTC', 60, 'volumeWeighted')
+    assert list(times) == [now - 2, now - 1]
+    assert rates.tolist() == pytest.approx([(0.005 + 0.4 + 0.3) / 30.5, 0.03])
+    assert ma.get_rate_samples('BTC', 60, 'dustFiltered')[1].tolist() == [0.02, 0.02]
+    assert ma.get_rate_samples('BTC', 60, 'percentile')[1].tolist() == [0.01, 0.02]
+    assert ma.get_rate_suggestion('BTC', method='dustFiltered') == 0.02
+    # The streaming statistics only follow rate0, the depth methods still read the samples
+    ma.engine = 'streaming'
+    ma.rate_stats = {'BTC': {'percentile': StreamingRateStats(60)}}
+    ma.suggestion_cache = {}
+    assert ma.get_rate_suggestion('BTC', method='dustFiltered') == 0.02
+    assert ma.get_rate_suggestion('BTC', method='volumeWeighted') > 0
+
+
+def test_suggestion_cache():
+    ma = MarketAnalysis(Config, api)
+    ma.currencies_to_analyse = ['BTC']
+    ma.rate_histories = {'BTC': RateHistory(3, 10)}
+    ma.queue_market_data = lambda *args: None
+    calculated = []
+    calculate = ma.calculate_rate_suggestion
+    ma.calculate_rate_suggestion = lambda *args: calculated.append(args) or calculate(*args)
+
+    ma.record_market_data('BTC', None, [{'rate': '0.01', 'amount': '1'}], 3)
+    assert ma.get_rate_suggestion('BTC') == ma.get_rate_suggestion('BTC') == 0.01
+    assert len(calculated) == 1
+    ma.get_rate_suggestion('BTC', method='MACD')
+    assert len(calculated) == 2
+    ma.record_market_data('BTC', None, [{'rate': '0.02', 'amount': '1'}], 3)
+    ma.get_rate_suggestion('BTC')
+    assert len(calculated) == 3
+    assert (ma.suggestion_cache_hits, ma.suggestion_cache_misses) == (1, 3)
+
+
+def test_streaming_stats_stay_in_window():
+    stats = StreamingRateStats(600)
+    for i in range(100000):
+        stats.add(1500000000 + i, 0.0001 + (i % 7) * 0.00001)
+    # Never read, the samples that left the window are dropped anyway
+    assert len(stats.raw_times) < 2 * 1024 + 600 and len(stats.bucket_secs) < 2 * 1024 + 600
+    assert stats.get_sample_count() == 600
+    values = WeightedValues()
+    expanded = []
+    for i in range(300):
+        value, weight = randint(1, 3) * 0.0001 + i % 11 * 1e-6, i % 5 + 1
+        values.add(value, weight)
+        expanded.extend([value] * weight)
+    for value in expanded[:100]:
+        values.remove(value, 1)
+    expanded = expanded[100:]
+    for percent in [0, 10, 50, 75, 99, 100]:
+        assert values.percentile(percent) == pytest.approx(numpy.percentile(expanded, percent))
+
+
+def test_market_data_errors_stay_per_currency(monkeypatch):
+    ma = MarketAnalysis(Config, api)
+    ma.exchange = 'POLONIEX'
+    books = {'BTC': {'offers': [{'rate': '0.01', 'amount': '1'}], 'demands': []},
+             'ETH': {'error': 'Invalid currency'},
+             'LTC': Exception('429 Too Many Requests')}
+
+    def get_loan_orders(cur, limit=0, max_age=None):
+        if isinstance(books[cur], Exception):
+            raise books[cur]
+        return books[cur]
+
+    monkeypatch.setattr(Data, 'get_cached_loan_orders', lambda cur, limit=0, max_age=None: None)
+    monkeypatch.setattr(Data, 'get_loan_orders', get_loan_orders)
+    delays = {}
+    assert ma.get_market_data(['ETH', 'BTC', 'LTC'], 3, 5, delays=delays) == {'BTC': books['BTC']['offers']}
+    assert delays == {'LTC': RATE_LIMIT_SECONDS}
+
+
+def test_column_storage_reads_unwritten_samples(tmp_path):
+    ma = MarketAnalysis(Config, api)
+    ma.currencies_to_analyse = ['BTC']
+    ma.recorded_levels = 1
+    ma.record_changes_only = True
+    ma.db_flush_rows = 100
+    ma.db_flush_seconds = 600
+    ma.column_stores = {'BTC': ColumnStore(str(tmp_path), 1, MAX_RUN_SECONDS)}
+    now = int(time.time()) - 100
+    real_time = time.time
+    try:
+        for i, rate in enumerate(['0.01', '0.01', '0.01', '0.02', '0.02']):
+            time.time = lambda: now + i * 5
+            ma.record_market_data('BTC', None, [{'rate': rate, 'amount': '1'}], 1)
+    finally:
+        time.time = real_time
+    assert len(ma.column_stores['BTC'].get_window()[0]) == 0  # Nothing written yet
+    times, rates = ma.get_rate_samples('BTC', 600)
+    assert list(times) == [now + i * 5 for i in range(5)]
+    assert rates.tolist() == [0.01, 0.01, 0.01, 0.02, 0.02]
@@ -0,0 +1,65 @@
+import threading
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import modules.Notify as Notify
+from modules.Notify import NotificationWorker, NotificationException
+
+
+def test_worker_coalesces_and_retries(monkeypatch):
+    sent = {'email': [], 'slack': []}
+    slack_failures = [1]
+    started = threading.Event()
+    release = threading.Event()
+
+    def send_email(msg):
+        started.set()
+        release.wait()  # A slow SMTP server, the notifications queued meanwhile go out together
+        sent['email'].append(msg)
+
+    def post_to_slack(msg):
+        if slack_failures[0]:
+            slack_failures[0] -= 1
+            raise NotificationException('timeout')
+        sent['slack'].append(msg)
+
+    monkeypatch.setattr(Notify, 'get_senders', lambda nc: [('email', send_email), ('slack', post_to_slack)])
+    notify_conf = {'notify_prefix': 'bot1'}
+    worker = NotificationWorker(queue_size=3, coalesce_seconds=0.01, retries=2, retry_seconds=0.01)
+    worker.put('first', notify_conf)
+    assert started.wait(5)
+    for i in range(4):  # The last one does not fit in the queue
+        worker.put('burst {0}'.format(i), notify_conf)
+    assert worker.dropped == 1
+    release.set()
+    worker.flush(5)
+    assert worker.queue.unfinished_tasks == 0
+    assert sent['email'] == ['bot1 first', 'bot1 burst 0\n\nburst 1\n\nburst 2']
+    # Slack failed once and was retried, email was not sent twice
+    assert sent['slack'] == sent['email']
+
+
+def test_retry_only_failed_channels(monkeypatch):
+    posted = []
+    failures = {'b': 1}
+
+    def post_to_slack(msg, channels, token, username):
+        for channel in channels:
+            if failures.get(channel):
+                failures[channel] -= 1
+                raise NotificationException('timeout')
+            posted.append(channel)
+
+    monkeypatch.setattr(Notify, 'post_to_slack', post_to_slack)
+    notify_conf = {'email': False, 'slack': True, 'slack_channels': ['a', 'b', 'c'], 'slack_token': '',
+                   'slack_username': '', 'telegram': False, 'pushbullet': False, 'irc': False}
+    worker = NotificationWorker(coalesce_seconds=5, retries=1, retry_seconds=0.01)
+    worker.put('loan filled', notify_conf)
+    worker.flush(2)  # Does not wait for the end of the coalescing
+    assert worker.queue.unfinished_tasks == 0
+    assert sorted(posted) == ['a', 'b', 'c']
@@ -0,0 +1,27 @@
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from modules.RateHistory import RateHistory
+
+
+def test_keeps_newest_samples_in_order():
+    history = RateHistory(levels=1, capacity=5)
+    for t in range(23):
+        history.append(1000 + t, [t / 100.0, t])
+    times, values = history.get_window()
+    assert list(times) == [1018, 1019, 1020, 1021, 1022]
+    assert list(values[:, 1]) == [18, 19, 20, 21, 22]
+    assert history.get_latest_time() == 1022
+
+
+def test_get_window():
+    history = RateHistory(levels=2, capacity=100)
+    history.extend([(1000 + t, t, 1, t + 1, 2) for t in range(10)])
+    times, values = history.get_window(from_date=1006, columns=[0, 2])
+    assert list(times) == [1007, 1008, 1009]
+    assert values.tolist() == [[7, 8], [8, 9], [9, 10]]
+    assert len(history.get_window(from_date=1009)[0]) == 0
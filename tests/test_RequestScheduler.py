@@ -0,0 +1,58 @@
+import threading
+import time
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from modules.RequestScheduler import RequestScheduler, PRIORITY_ORDER, PRIORITY_BALANCE, PRIORITY_MARKET_DATA
+
+
+class FakeApi(object):
+    req_per_period = 1
+    req_period = 200  # milliseconds
+
+
+def test_priority_order():
+    scheduler = RequestScheduler(FakeApi())
+    scheduler.acquire()  # Use the only token so everybody below has to wait
+    served = []
+
+    def request(name, priority):
+        scheduler.acquire(priority)
+        served.append(name)
+
+    threads = []
+    for name, priority in [('market', PRIORITY_MARKET_DATA), ('balance', PRIORITY_BALANCE), ('order', PRIORITY_ORDER)]:
+        thread = threading.Thread(target=request, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)  # Make sure they queue up in this order
+    for thread in threads:
+        thread.join()
+    assert served == ['order', 'balance', 'market']
+
+
+def test_rate_limit():
+    scheduler = RequestScheduler(FakeApi())
+    start = time.time()
+    for _ in range(4):
+        scheduler.acquire()
+    assert time.time() - start >= 0.6  # First request right away, then one every 200ms
+
+
+def test_reserve_yields_to_waiting_threads():
+    scheduler = RequestScheduler(FakeApi())
+    assert scheduler.reserve() == 0
+    waiter = threading.Thread(target=scheduler.acquire, args=(PRIORITY_ORDER,))
+    waiter.start()
+    time.sleep(0.02)  # The waiter queues up for the token we hold
+    assert scheduler.reserve() > 0
+    time.sleep(0.2)
+    assert scheduler.reserve() > 0  # The token came back but the waiter goes first
+    waiter.join()
+    time.sleep(0.2)
+    assert scheduler.reserve() == 0
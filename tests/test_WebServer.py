@@ -0,0 +1,31 @@
+import gzip
+
+# Hack to get relative imports - probably need to fix the dir structure instead but we need this at the minute for
+# pytest to work
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from modules.WebServer import choose_encoding, get_static_file
+
+
+def test_static_file(tmp_path):
+    path = str(tmp_path / 'lendingbot.js')
+    with open(path, 'w') as f:
+        f.write('var refreshRate = 30;\n' * 100)
+    last_modified, digest, variants = get_static_file(path)
+    assert gzip.decompress(variants['gzip']) == variants[None]
+    assert choose_encoding('gzip, deflate', variants) == 'gzip'
+    assert choose_encoding('gzip;q=0, deflate', variants) is None
+    assert choose_encoding('', variants) is None
+
+    with open(path, 'a') as f:
+        f.write('var timespans = [];\n')
+    os.utime(path, (last_modified + 10, last_modified + 10))
+    assert get_static_file(path)[1] != digest
+
+    png = str(tmp_path / 'icon32.png')
+    with open(png, 'wb') as f:
+        f.write(b'\x89PNG' * 100)
+    assert list(get_static_file(png)[2]) == [None]
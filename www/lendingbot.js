@@ -1,6 +1,11 @@
 // vim: ts=4:sw=4:et
 
 var localFile, reader;
+var logId, logSeq = -1, logLines = [], logSize;
+// the bot's web server serves the status from memory, other web servers only have the files
+var statusUrl = 'api/status';
+// the bot's web server also pushes the status and log lines, null once we know it does not
+var events;
 
 var Hour = new Timespan("Hour", 1/24);
 var Day = new Timespan("Day", 1);
@@ -30,11 +35,12 @@ function updateJson(data) {
     $('#title').text(data.exchange + ' ' + data.label)
     document.title = data.exchange + ' ' + data.label
 
-    var rowCount = data.log.length;
-    var table = $('#logtable');
-    table.empty();
-    for (var i = rowCount - 1; i >=0; i--) {
-        table.append($('<tr/>').append($('<td colspan="2" />').text(data.log[i])));
+    if (data.log_prefix && !localFile) {
+        loadLogSegments(data);
+    } else if (data.log) {
+        // a local file, the segments next to it cannot be read, or the botlog.json of an older bot
+        logLines = data.log;
+        updateLog();
     }
 
     updateOutputCurrency(data.outputCurrency);
@@ -42,6 +48,81 @@ function updateJson(data) {
     updateNavbar(data.plugins);
 }
 
+function updateLog() {
+    var table = $('#logtable');
+    table.empty();
+    for (var i = logLines.length - 1; i >=0; i--) {
+        table.append($('<tr/>').append($('<td colspan="2" />').text(logLines[i])));
+    }
+}
+
+// fetches the log segments holding the lines newer than the ones we have
+function loadLogSegments(data) {
+    if (data.log_id != logId) {
+        // the bot restarted, its line numbers start over
+        logId = data.log_id;
+        logSeq = -1;
+        logLines = [];
+    }
+    logSize = data.log_size || data.log_seq - data.log_first_seq + 1;
+    if (data.log_seq <= logSeq) {
+        return;
+    }
+    if (statusUrl == 'api/status') {
+        loadLogSince();
+        return;
+    }
+    var firstSeq = Math.max(logSeq + 1, data.log_first_seq);
+    var requests = [];
+    for (var segment = Math.floor(firstSeq / data.log_segment_size); segment <= Math.floor(data.log_seq / data.log_segment_size); segment++) {
+        // the line number makes the url change whenever the segment may have changed
+        requests.push($.getJSON(data.log_prefix + segment + '.json?seq=' + data.log_seq));
+    }
+    $.when.apply($, requests).done(function () {
+        var segments = requests.length == 1 ? [arguments] : arguments;
+        for (var i = 0; i < segments.length; i++) {
+            var segment = segments[i][0];
+            addLogLines(segment.first_seq, segment.lines, firstSeq, data.log_seq - data.log_first_seq + 1);
+        }
+    });
+}
+
+// fetches the lines newer than the ones we have from the bot's web server
+function loadLogSince() {
+    $.getJSON('api/log?since=' + logSeq, function (log) {
+        if (log.log_id == logId) {
+            addLogLines(log.first_seq, log.lines, logSeq + 1, logSize);
+        }
+    });
+}
+
+// a line pushed by the bot's web server, fetches the ones we missed if there is a gap
+function addLogEvent(event) {
+    if (event.log_id != logId) {
+        logId = event.log_id;
+        logSeq = -1;
+        logLines = [];
+    }
+    if (event.seq == logSeq + 1) {
+        addLogLines(event.seq, [event.line], event.seq, logSize);
+    } else if (event.seq > logSeq) {
+        loadLogSince();
+    }
+}
+
+// adds the lines numbered from firstSeq, keeping the newest maxLines lines
+function addLogLines(lineSeq, lines, firstSeq, maxLines) {
+    for (var i = 0; i < lines.length; i++) {
+        // lines pushed while they were being fetched are already there
+        if (lineSeq + i >= firstSeq && lineSeq + i > logSeq) {
+            logLines.push(lines[i]);
+            logSeq = lineSeq + i;
+        }
+    }
+    logLines = logLines.slice(-maxLines);
+    updateLog();
+}
+
 function updateNavbar(plugins) {
 
     // No plugins enabled. Nothing to do.
@@ -257,14 +338,21 @@ function loadData() {
     if (localFile) {
         reader.readAsText(localFile, 'utf-8');
         setTimeout('loadData()', refreshRate * 1000)
+    } else if (statusUrl == 'api/status' && window.EventSource && events !== null) {
+        loadEvents();
     } else {
         // expect the botlog.json to be in the same folder on the webserver
-        var file = 'botlog.json';
-        $.getJSON(file, function (data) {
+        $.getJSON(statusUrl, function (data) {
             updateJson(data);
             // reload every 30sec
             setTimeout('loadData()', refreshRate * 1000)
         }).fail( function(d, textStatus, error) {
+            if (statusUrl == 'api/status' && d.status != 503) {
+                // not served by the bot, read the file instead
+                statusUrl = 'botlog.json';
+                loadData();
+                return;
+            }
             $('#status').text("getJSON failed, status: " + textStatus + ", error: "+error);
             // retry after 60sec
             setTimeout('loadData()', 60000)
@@ -272,6 +360,29 @@ function loadData() {
     }
 }
 
+// gets the status and log lines as the bot's web server pushes them, the browser reconnects if the stream drops
+function loadEvents() {
+    if (events) {
+        // settings changed, the new stream starts with the status to show with them
+        events.close();
+    }
+    events = new EventSource('api/events');
+    events.addEventListener('status', function (e) {
+        updateJson(JSON.parse(e.data));
+    });
+    events.addEventListener('log', function (e) {
+        addLogEvent(JSON.parse(e.data));
+    });
+    events.onerror = function () {
+        if (events.readyState == EventSource.CLOSED) {
+            // no event stream on this web server, poll instead
+            events.close();
+            events = null;
+            loadData();
+        }
+    };
+}
+
 function Timespan(name, multiplier) {
     this.name = name;
     this.multiplier = multiplier;